@@ -0,0 +1,54 @@
+"""
+Peak memory and time of building the data URI of a vision image.
+
+    TELEGRAM_BOT_TOKEN=x python benchmarks/bench_base64.py [MiB]
+"""
+
+import base64
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers._utils import image_to_base64, image_to_data_uri  # noqa: E402
+
+MiB = 1024 * 1024
+ROUNDS = 5
+
+
+def whole_at_once(image: bytes) -> str:
+    # how the data uri was built before, encoded and decoded in one piece
+    return f"data:image/jpeg;base64,{base64.b64encode(image).decode('utf-8')}"
+
+
+def measure(name: str, func, image: bytes) -> str:
+    expected = whole_at_once(image)
+    peaks, seconds = [], []
+    for _ in range(ROUNDS):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func(image)
+        seconds.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert result == expected, name
+        del result
+    print(
+        f"{name:<18} peak {min(peaks) / MiB:6.2f} MiB  "
+        f"{min(seconds) * 1000:6.1f} ms  (result {len(expected) / MiB:.2f} MiB)"
+    )
+
+
+def main() -> None:
+    size = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    image = os.urandom(int(size * MiB))
+    print(f"{size:g} MiB image, best of {ROUNDS}")
+    measure("whole at once", whole_at_once, image)
+    measure("image_to_data_uri", image_to_data_uri, image)
+    assert image_to_base64(image) == base64.b64encode(image).decode("ascii")
+
+
+if __name__ == "__main__":
+    main()
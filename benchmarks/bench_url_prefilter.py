@@ -0,0 +1,103 @@
+"""
+Time of looking for urls in chat messages, with and without the cheap
+prefilter in front of URLExtract, and a check that both find the same urls
+in every message of the corpus.
+
+    TELEGRAM_BOT_TOKEN=x python benchmarks/bench_url_prefilter.py [rounds]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers._utils import extract_url_from_text, url_extractor  # noqa: E402
+
+# most messages are questions without links
+PLAIN = [
+    "what is the difference between a process and a thread",
+    "explain this to me like I am five",
+    "帮我写一首关于秋天的诗",
+    "为什么天空是蓝色的？",
+    "translate to english: 今天天气很好，我们去公园吧",
+    "can you fix this: for i in range(10) print(i)",
+    "def f(x): return x*2  # why does this not work",
+    "summarize the meeting: we agreed on Q3 goals, then lunch",
+    "ok thanks!!! 👍👍",
+    "new what about rust vs go for a cli tool?",
+    "clear",
+    "the price went from 3.5 to 4.25 dollars",
+    "version 1.2.3 broke my build, pinning 1.2.2 fixed it",
+    "e.g. this, i.e. that, etc. and so on",
+    "Mr. Smith said hi. Then he left.",
+    "他说：好的。然后就走了。",
+    "```python\nimport os\nprint(os.getcwd())\n```",
+    "use a.b.c = 1 to set the nested field",
+    "file is at ~/notes/todo.txt",
+    "email me at someone@example.com",
+]
+# and some carry links, often right next to punctuation
+LINKS = [
+    "what does https://example.com/docs/intro say",
+    "summarize https://en.wikipedia.org/wiki/Python_(programming_language)",
+    "(see https://github.com/python/cpython/pull/1)",
+    "look: www.example.org, and also example.net.",
+    "compare https://a.example.com/x?y=1&z=2#frag and http://b.example.com/",
+    "链接：https://www.example.cn/文章/123，请总结",
+    # urlextract itself misses this one, the prefilter only has to agree
+    "是这个吗https://example.com。",
+    "my server is at 192.168.1.10:8080/status",
+    "try http://10.0.0.1/admin or localhost:8000/health",
+    "open http://localhost:3000/",
+    "<https://example.com/in/angle/brackets>",
+    '"https://example.com/quoted"',
+    "[link](https://example.com/markdown)",
+    "see docs.python.org/3/library/re.html!",
+    "https://t.me/some_channel/42?",
+    "gpt: what is on https://news.ycombinator.com",
+]
+MESSAGES_PER_ROUND = 10_000
+LINK_SHARE = 0.1
+
+
+def corpus(seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [
+        rng.choice(LINKS if rng.random() < LINK_SHARE else PLAIN)
+        for _ in range(MESSAGES_PER_ROUND)
+    ]
+
+
+def timed(find, messages: list[str]) -> float:
+    start = time.perf_counter()
+    for text in messages:
+        find(text)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    mismatches = [
+        text
+        for text in PLAIN + LINKS
+        if extract_url_from_text(text) != url_extractor.find_urls(text)
+    ]
+    for text in mismatches:
+        print(f"MISMATCH {text!r}: {url_extractor.find_urls(text)}")
+
+    messages = corpus()
+    plain = min(timed(url_extractor.find_urls, messages) for _ in range(rounds))
+    filtered = min(timed(extract_url_from_text, messages) for _ in range(rounds))
+    print(
+        f"{len(messages)} messages, {LINK_SHARE:.0%} with links, best of {rounds}\n"
+        f"URLExtract only  {plain * 1000:8.1f} ms\n"
+        f"with prefilter   {filtered * 1000:8.1f} ms  ({plain / filtered:.1f}x)"
+    )
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
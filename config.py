@@ -1,18 +1,49 @@
 from functools import cached_property
 
+import httpx
 import openai
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+# idle connections stay open this long, the keep-alive pings come more often
+KEEPALIVE_EXPIRY = 300.0
+KEEPALIVE_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=KEEPALIVE_EXPIRY,
+)
+
+
+class ModelRoute(BaseModel):
+    """A model variant of a provider and the requests it is picked for."""
+
+    model: str
+    # the largest estimated prompt in tokens it takes, any if unset
+    max_tokens: int | None = None
+    # whether it takes images
+    vision: bool = True
+    # skipped while the p95 of its seconds to the first token is above this
+    target_ttft: float | None = None
+
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
     telegram_bot_token: str
     timezone: str = "Asia/Shanghai"
+    # seconds one message may spend on outbound calls, shared by all its stages
+    request_deadline: float = 180.0
+    # prompts of a user for the same bot within this many milliseconds of each
+    # other are merged into one question, 0 answers every message right away
+    debounce_ms: int = 0
 
     openai_api_key: str | None = None
     openai_model: str = "gpt-4o-mini"
     openai_base_url: str = "https://api.openai.com/v1"
+    # hedge slow /gpt requests with another provider, e.g. "Claude" or "Gemini"
+    openai_fallback_provider: str | None = None
+    # seconds to wait for the first token, the p95 of the recent ones if unset
+    openai_hedge_budget: float | None = None
 
     google_gemini_api_key: str | None = None
     anthropic_api_key: str | None = None
@@ -20,12 +51,36 @@ class Settings(BaseSettings):
     ollama_web_search_api_key: str | None = None
     ollama_web_search_max_results: int = 5
     ollama_web_search_timeout: int = 10
+    # open the provider connections at startup and ping them every interval
+    # seconds so the first answer after an idle period skips the handshakes
+    provider_warmup: bool = False
+    provider_keepalive_interval: float = 60.0
+    # downloaded telegram files are cached in memory up to this many bytes, the
+    # evicted ones move to the directory, if set, up to the disk bytes
+    telegram_file_cache_bytes: int = 64 * 1024 * 1024
+    telegram_file_cache_dir: str | None = None
+    telegram_file_cache_disk_bytes: int = 512 * 1024 * 1024
+    # text of the pages linked in questions, kept on disk for the ttl seconds
+    # up to the bytes, the pages of one question share about this many tokens
+    url_cache_dir: str = "data/url_cache"
+    url_cache_ttl: int = 6 * 60 * 60
+    url_cache_bytes: int = 64 * 1024 * 1024
+    url_tokens: int = 4000
+    # sqlite files, created when first used
+    jobs_db: str = "data/jobs.db"
+    gemini_sessions_db: str = "data/gemini_sessions.db"
+    # model variants by command, "ChatGPT" for /gpt and "ChatGPT-pro" for
+    # /gpt_pro and photos, the first one fitting a request answers it, e.g.
+    # {"ChatGPT": [{"model": "gpt-4o-mini", "max_tokens": 4000,
+    # "target_ttft": 2}, {"model": "gpt-4.1"}]}, without them nothing changes
+    model_routes: dict[str, list[ModelRoute]] = {}
 
     @cached_property
     def openai_client(self) -> openai.OpenAI:
         return openai.OpenAI(
             api_key=self.openai_api_key,
             base_url=self.openai_base_url,
+            http_client=openai.DefaultHttpxClient(limits=KEEPALIVE_LIMITS),
         )
 
     @cached_property
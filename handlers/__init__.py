@@ -4,6 +4,7 @@ from pathlib import Path
 from telebot import TeleBot
 from telebot.types import BotCommand
 
+from ._jobs import resume_jobs
 from ._utils import logger, wrap_handler
 
 DEFAULT_LOAD_PRIORITY = 10
@@ -35,6 +36,8 @@ def load_handlers(bot: TeleBot, disable_commands: list[str]) -> None:
             logger.debug(f"Loading {name} handlers with priority {priority}.")
             module.register(bot)
     logger.info("Loading handlers done.")
+    # every job type is registered by now
+    resume_jobs(bot)
 
     all_commands: list[BotCommand] = []
     for handler in bot.message_handlers:
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, TypeVar
+
+import requests
+
+T = TypeVar("T")
+
+MAX_POOLED_CLIENTS = 100
+
+
+class ClientPool:
+    """
+    Keeps API clients, and with them their open connections, between messages.
+    Clients are keyed by something like (kind, api key, base url), the least
+    recently used one is dropped when the pool is full.
+    """
+
+    def __init__(self, max_size: int = MAX_POOLED_CLIENTS) -> None:
+        self.max_size = max_size
+        self._clients: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def get(self, key: Hashable, factory: Callable[[], T]) -> T:
+        with self._lock:
+            if key in self._clients:
+                self._clients.move_to_end(key)
+                return self._clients[key]
+        # built outside the lock, factories may use the pool themselves
+        client = factory()
+        with self._lock:
+            client = self._clients.setdefault(key, client)
+            self._clients.move_to_end(key)
+            # a dropped client may still be streaming, so it is not closed here
+            if len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+            return client
+
+
+client_pool = ClientPool()
+
+
+def pooled_session(*key: Hashable) -> requests.Session:
+    """A shared `requests.Session` for the requests based SDKs and APIs."""
+    return client_pool.get(("session", *key), requests.Session)
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from config import settings
+
+from ._utils import SingleFlight, logger
+
+
+class FileCache:
+    """
+    Downloaded telegram files by `file_unique_id`, which is the same for the
+    same file in every message, so e.g. one photo forwarded to several models
+    is downloaded once. The least recently used files are dropped once the
+    cached bytes pass `max_bytes`, or moved to `spill_dir` when it is set,
+    which keeps up to `spill_max_bytes` on disk.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        spill_dir: str | None = None,
+        spill_max_bytes: int = 0,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._files: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        # key -> size of the files in `spill_dir`, oldest first
+        self._spilled: OrderedDict[str, int] = OrderedDict()
+        self._spilled_size = 0
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        # the disk is only scanned by the first lookup, not at import
+        self._spill_ready = spill_dir is None
+        self._spill_init_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def fetch(self, key: str, download: Callable[[], bytes]) -> bytes:
+        """The cached file for `key`, or `download` it once for all callers."""
+        data = self.get(key)
+        if data is None:
+            data = self._flight.do(key, self._download, key, download)
+        return data
+
+    def get(self, key: str) -> bytes | None:
+        self._ensure_spilled()
+        with self._lock:
+            data = self._files.get(key)
+            if data is not None:
+                self._files.move_to_end(key)
+                self.hits += 1
+                return data
+            spilled = key in self._spilled
+        if spilled and (data := self._read_spilled(key)) is not None:
+            with self._lock:
+                self.hits += 1
+            self.put(key, data)
+            return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+                return
+            self._files[key] = data
+            self._size += len(data)
+            evicted = []
+            while self._size > self.max_bytes:
+                old_key, old_data = self._files.popitem(last=False)
+                self._size -= len(old_data)
+                evicted.append((old_key, old_data))
+        # disk writes happen outside the lock
+        for old_key, old_data in evicted:
+            self._spill(old_key, old_data)
+
+    def _download(self, key: str, download: Callable[[], bytes]) -> bytes:
+        data = download()
+        self.put(key, data)
+        return data
+
+    def _path(self, key: str) -> str:
+        # file_unique_id only has url safe base64 characters
+        return os.path.join(self.spill_dir, key)
+
+    def _ensure_spilled(self) -> None:
+        if not self._spill_ready:
+            with self._spill_init_lock:
+                if not self._spill_ready:
+                    self._load_spilled()
+                    self._spill_ready = True
+
+    def _load_spilled(self) -> None:
+        os.makedirs(self.spill_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._spilled[key] = size
+            self._spilled_size += size
+        self._prune_spilled()
+
+    def _spill(self, key: str, data: bytes) -> None:
+        if self.spill_dir is None or len(data) > self.spill_max_bytes:
+            return
+        self._ensure_spilled()
+        try:
+            with open(self._path(key), "wb") as f:
+                f.write(data)
+        except OSError:
+            logger.warning("Could not spill telegram file %s to disk", key)
+            return
+        with self._lock:
+            self._spilled_size += len(data) - self._spilled.pop(key, 0)
+            self._spilled[key] = len(data)
+        self._prune_spilled()
+
+    def _read_spilled(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            with self._lock:
+                self._spilled_size -= self._spilled.pop(key, 0)
+            return None
+
+    def _prune_spilled(self) -> None:
+        removed = []
+        with self._lock:
+            while self._spilled_size > self.spill_max_bytes:
+                key, size = self._spilled.popitem(last=False)
+                self._spilled_size -= size
+                removed.append(key)
+        for key in removed:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+file_cache = FileCache(
+    settings.telegram_file_cache_bytes,
+    settings.telegram_file_cache_dir,
+    settings.telegram_file_cache_disk_bytes,
+)
@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from telebot import TeleBot
+from telebot.types import Message
+
+from config import settings
+
+from ._utils import logger
+
+QUEUED = "queued"
+RUNNING = "running"
+# the run returned but something else finishes the job, see `detach_job`
+WAITING = "waiting"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobError(Exception):
+    """An expected failure of a job, its message is shown to the user."""
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    chat_id: int
+    message_id: int
+    status_message_id: int | None
+    payload: dict[str, Any]
+    state: str = QUEUED
+
+    def progress(self, bot: TeleBot, text: str) -> None:
+        """Show how the job is going in its status message."""
+        if self.status_message_id is None:
+            return
+        try:
+            bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.status_message_id
+            )
+        except Exception:
+            # e.g. the same text again, the progress is only informative
+            logger.debug("Could not update the progress of job %s", self.id)
+
+    def reply(self, bot: TeleBot, text: str) -> Message:
+        return bot.send_message(self.chat_id, text, reply_to_message_id=self.message_id)
+
+
+@dataclass
+class JobType:
+    name: str
+    # returns WAITING when the job is finished later, see `detach_job`
+    run: Callable[[Job, TeleBot], str | None]
+    # how many jobs of this type may run at the same time
+    concurrency: int = 1
+    # safe to run again when a restart interrupted it
+    resumable: bool = False
+
+
+class JobStore:
+    """The jobs in SQLite, the file is created by the first connection."""
+
+    def __init__(self, db_file: str):
+        self._db_file = db_file
+        self._ready = False
+        self._init_lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """Create a new database connection, the caller closes it."""
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return sqlite3.connect(self._db_file)
+
+    def _init_db(self):
+        parent_folder = os.path.dirname(self._db_file)
+        if parent_folder:
+            os.makedirs(parent_folder, exist_ok=True)
+        with closing(sqlite3.connect(self._db_file)) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT,
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    status_message_id INTEGER,
+                    payload TEXT,
+                    state TEXT,
+                    error TEXT,
+                    created_at TEXT,
+                    updated_at TEXT
+                );
+            """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state);
+            """
+            )
+            conn.commit()
+
+    def add(
+        self,
+        kind: str,
+        chat_id: int,
+        message_id: int,
+        status_message_id: int | None,
+        payload: dict[str, Any],
+    ) -> Job:
+        now = datetime.now(timezone.utc).isoformat()
+        with closing(self.connect()) as conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO jobs (kind, chat_id, message_id, status_message_id,
+                    payload, state, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                """,
+                (
+                    kind,
+                    chat_id,
+                    message_id,
+                    status_message_id,
+                    json.dumps(payload),
+                    QUEUED,
+                    now,
+                    now,
+                ),
+            )
+            conn.commit()
+        return Job(
+            cursor.lastrowid, kind, chat_id, message_id, status_message_id, payload
+        )
+
+    def set_state(self, job_id: int, state: str, error: str | None = None) -> None:
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ?;",
+                (state, error, datetime.now(timezone.utc).isoformat(), job_id),
+            )
+            conn.commit()
+
+    def update_payload(self, job_id: int, payload: dict[str, Any]) -> None:
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET payload = ?, updated_at = ? WHERE id = ?;",
+                (json.dumps(payload), datetime.now(timezone.utc).isoformat(), job_id),
+            )
+            conn.commit()
+
+    def unfinished(self) -> list[Job]:
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                """
+                SELECT id, kind, chat_id, message_id, status_message_id, payload, state
+                FROM jobs WHERE state IN (?, ?, ?) ORDER BY id;
+                """,
+                (QUEUED, RUNNING, WAITING),
+            ).fetchall()
+        return [
+            Job(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]), row[6])
+            for row in rows
+        ]
+
+
+store = JobStore(settings.jobs_db)
+JOB_TYPES: dict[str, JobType] = {}
+# one small pool per job type, so its concurrency limit is the pool size
+_executors: dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def register_job_type(
+    name: str,
+    run: Callable[[Job, TeleBot], str | None],
+    concurrency: int = 1,
+    resumable: bool = False,
+) -> JobType:
+    job_type = JobType(name, run, concurrency, resumable)
+    JOB_TYPES[name] = job_type
+    return job_type
+
+
+def _executor(kind: str) -> ThreadPoolExecutor:
+    with _executors_lock:
+        if kind not in _executors:
+            _executors[kind] = ThreadPoolExecutor(
+                max_workers=JOB_TYPES[kind].concurrency,
+                thread_name_prefix=f"job-{kind}",
+            )
+        return _executors[kind]
+
+
+def _run_job(bot: TeleBot, job: Job) -> None:
+    store.set_state(job.id, RUNNING)
+    try:
+        state = JOB_TYPES[job.kind].run(job, bot)
+    except JobError as e:
+        store.set_state(job.id, FAILED, str(e))
+        job.progress(bot, str(e))
+    except Exception as e:
+        logger.exception("Job %s (%s) failed", job.id, job.kind)
+        store.set_state(job.id, FAILED, str(e))
+        job.progress(bot, "Something wrong, please check the log")
+    else:
+        if state != WAITING:
+            store.set_state(job.id, DONE)
+
+
+def detach_job(job: Job) -> str:
+    """
+    Let something else finish the job with `finish_job`, the run returns what
+    this returns. Called before handing the job over so the finish wins.
+    """
+    store.set_state(job.id, WAITING)
+    return WAITING
+
+
+def finish_job(job: Job, error: str | None = None) -> None:
+    store.set_state(job.id, FAILED if error else DONE, error)
+
+
+def submit_job(
+    bot: TeleBot, message: Message, kind: str, payload: dict[str, Any], status: str
+) -> Job:
+    """
+    Queue a long-running job and return right away, the `status` reply is
+    edited with its progress and the result is sent as a reply later.
+    """
+    status_message = bot.reply_to(message, status)
+    job = store.add(
+        kind, message.chat.id, message.message_id, status_message.message_id, payload
+    )
+    _executor(kind).submit(_run_job, bot, job)
+    return job
+
+
+def resume_jobs(bot: TeleBot) -> None:
+    """Run the jobs a restart interrupted again, or tell their users they are lost."""
+    for job in store.unfinished():
+        job_type = JOB_TYPES.get(job.kind)
+        if job_type is not None and job_type.resumable:
+            logger.info("Resuming job %s (%s)", job.id, job.kind)
+            job.progress(bot, "Resuming after a restart, please wait")
+            _executor(job.kind).submit(_run_job, bot, job)
+            continue
+        store.set_state(job.id, FAILED, "interrupted by a restart")
+        try:
+            job.reply(bot, "Sorry, a restart interrupted this, please send it again.")
+        except Exception:
+            logger.exception("Could not report the interrupted job %s", job.id)
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from config import settings
+
+from ._utils import logger
+
+
+class PageCache:
+    """
+    Text of the fetched web pages by url, kept in `cache_dir` for `ttl`
+    seconds, so a link sent again, or asked about by several models, is not
+    fetched again. The oldest pages are removed once the files pass `max_bytes`.
+    The directory is read, and created, when the cache is first used.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # key -> (mtime, size) of the files in `cache_dir`, oldest first
+        self._pages: OrderedDict[str, tuple[float, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._pages)
+
+    @property
+    def size(self) -> int:
+        self._ensure_loaded()
+        return self._size
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self._load()
+                self._loaded = True
+
+    def _load(self) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._pages[key] = (mtime, size)
+            self._size += size
+        self._prune()
+
+    def get(self, url: str) -> str | None:
+        key = self._key(url)
+        self._ensure_loaded()
+        with self._lock:
+            page = self._pages.get(key)
+            fresh = page is not None and time.time() - page[0] < self.ttl
+            if not fresh:
+                self.misses += 1
+        if not fresh:
+            return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, url: str, text: str) -> None:
+        key = self._key(url)
+        data = text.encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        self._ensure_loaded()
+        try:
+            with open(self._path(key), "wb") as f:
+                f.write(data)
+        except OSError:
+            logger.warning("Could not cache the page of %s", url)
+            return
+        with self._lock:
+            self._forget(key)
+            self._pages[key] = (time.time(), len(data))
+            self._size += len(data)
+        self._prune()
+
+    def _forget(self, key: str) -> None:
+        _, size = self._pages.pop(key, (0.0, 0))
+        self._size -= size
+
+    def _prune(self) -> None:
+        removed = []
+        expires_before = time.time() - self.ttl
+        with self._lock:
+            while self._pages:
+                key, (mtime, size) = next(iter(self._pages.items()))
+                if self._size <= self.max_bytes and mtime >= expires_before:
+                    break
+                self._forget(key)
+                removed.append(key)
+        for key in removed:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+page_cache = PageCache(
+    settings.url_cache_dir, settings.url_cache_ttl, settings.url_cache_bytes
+)
@@ -0,0 +1,490 @@
+from __future__ import annotations
+
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, TypeVar
+
+from ._utils import current_deadline
+
+ChatMessages = list[dict[str, Any]]
+StreamFunc = Callable[[ChatMessages], Iterator[str]]
+WarmupFunc = Callable[[], Any]
+S = TypeVar("S")
+
+logger = logging.getLogger("bot")
+
+# used as the hedge budget until a provider has enough latency samples
+DEFAULT_HEDGE_BUDGET = 8.0
+MIN_HEDGE_BUDGET = 1.0
+MIN_LATENCY_SAMPLES = 20
+
+# circuit breaker defaults, a call slower than SLOW_CALL_SECONDS counts as failed
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_RESET_TIMEOUT = 30.0
+SLOW_CALL_SECONDS = 30.0
+
+
+class LatencyHistogram:
+    """
+    Keeps the most recent time-to-first-token samples of a provider, and with
+    `max_age` only those of the last `max_age` seconds.
+    """
+
+    def __init__(self, max_samples: int = 200, max_age: float | None = None) -> None:
+        self.max_age = max_age
+        # (monotonic time recorded, seconds)
+        self._samples: deque[tuple[float, float]] = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire()
+            return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append((time.monotonic(), seconds))
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            self._expire()
+            samples = sorted(seconds for _, seconds in self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * q / 100))
+        return samples[index]
+
+    def _expire(self) -> None:
+        if self.max_age is None:
+            return
+        oldest = time.monotonic() - self.max_age
+        while self._samples and self._samples[0][0] < oldest:
+            self._samples.popleft()
+
+    def hedge_budget(self) -> float:
+        """How long to wait for the first token before asking somebody else."""
+        if len(self) < MIN_LATENCY_SAMPLES:
+            return DEFAULT_HEDGE_BUDGET
+        return max(MIN_HEDGE_BUDGET, self.percentile(95))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f"{name} is unavailable right now, please try again later.")
+        self.name = name
+
+
+class CircuitBreaker:
+    """
+    Stops calling a backend after too many of its recent calls failed or were
+    too slow. While open every call fails fast, after `reset_timeout` seconds
+    a single half-open probe is let through to decide whether to close again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        window: int = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+        slow_call_seconds: float = SLOW_CALL_SECONDS,
+    ) -> None:
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.slow_call_seconds = slow_call_seconds
+        self.state = self.CLOSED
+        self._results: deque[bool] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Every allowed call must be followed by `record_*` or `release`."""
+        with self._lock:
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                # a probe that never reported back does not block forever
+                if (
+                    self._probing
+                    and time.monotonic() - self._probe_started < self.reset_timeout
+                ):
+                    return False
+                self._probing = True
+                self._probe_started = time.monotonic()
+                return True
+            return self.state == self.CLOSED
+
+    def check(self) -> None:
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+
+    def release(self) -> None:
+        """The allowed call was given up before telling anything about the backend."""
+        with self._lock:
+            self._probing = False
+
+    @contextmanager
+    def call(self) -> Iterator[Callable[[], None]]:
+        """
+        Gates the block as one call of the backend, raises `CircuitOpenError`
+        when it is open. Streams call the yielded function at their first
+        token so slow ones count, a block leaving with an error is a failure
+        and any other block a success, so the slot is always given back.
+        """
+        self.check()
+        start = time.monotonic()
+        recorded = False
+
+        def first_token() -> None:
+            nonlocal recorded
+            if not recorded:
+                recorded = True
+                self.record_success(time.monotonic() - start)
+
+        try:
+            yield first_token
+        except BaseException:
+            if not recorded:
+                self.record_failure()
+            raise
+        if not recorded:
+            self._record(True)
+
+    def record_success(self, seconds: float) -> None:
+        self._record(seconds <= self.slow_call_seconds)
+
+    def record_failure(self) -> None:
+        self._record(False)
+
+    def _record(self, ok: bool) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    logger.info("Circuit breaker for %s closed", self.name)
+                    self.state = self.CLOSED
+                    self._results.clear()
+                else:
+                    self._open()
+                return
+            self._results.append(ok)
+            failures = self._results.count(False)
+            if (
+                self.state == self.CLOSED
+                and len(self._results) >= self.min_calls
+                and failures / len(self._results) >= self.failure_rate
+            ):
+                self._open()
+
+    def _open(self) -> None:
+        logger.warning("Circuit breaker for %s opened", self.name)
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._results.clear()
+
+
+@dataclass
+class Provider:
+    """A streaming LLM backend that can be asked by multi-provider commands."""
+
+    name: str
+    func: StreamFunc
+    breaker: CircuitBreaker | None = None
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # a cheap request that opens the connection, see `start_keepalive`
+    warmup: WarmupFunc | None = None
+
+    def __post_init__(self) -> None:
+        if self.breaker is None:
+            self.breaker = CircuitBreaker(self.name)
+
+    def stream(
+        self,
+        messages: ChatMessages,
+        allowed: bool = False,
+        cancel: threading.Event | None = None,
+    ) -> Iterator[str]:
+        """
+        `allowed` when the caller already got `breaker.allow()` for it. Once
+        `cancel` is set an error comes from closing the stream, not the backend.
+        """
+        if not allowed:
+            self.breaker.check()
+        start = time.monotonic()
+        first_token = None
+        try:
+            with closing(self.func(messages)) as pieces:
+                for piece in pieces:
+                    if first_token is None:
+                        first_token = time.monotonic() - start
+                        self.latency.record(first_token)
+                    yield piece
+        except GeneratorExit:
+            self._given_up(start, first_token)
+            raise
+        except Exception:
+            if cancel is not None and cancel.is_set():
+                self._given_up(start, first_token)
+            else:
+                self.breaker.record_failure()
+            raise
+        self.breaker.record_success(
+            time.monotonic() - start if first_token is None else first_token
+        )
+
+    def _given_up(self, start: float, first_token: float | None) -> None:
+        # only a started answer tells the breaker something
+        if first_token is not None:
+            self.breaker.record_success(first_token)
+            return
+        self.breaker.release()
+        # the first token would have taken at least this long, leaving the
+        # slow ones out makes the hedge budget shrink and hedge ever more often
+        self.latency.record(time.monotonic() - start)
+
+
+# Filled by the handler modules at import time when their API key is configured
+PROVIDERS: dict[str, Provider] = {}
+
+
+def register_provider(
+    name: str,
+    func: StreamFunc,
+    breaker: CircuitBreaker | None = None,
+    warmup: WarmupFunc | None = None,
+) -> Provider:
+    provider = Provider(name=name, func=func, breaker=breaker, warmup=warmup)
+    PROVIDERS[name] = provider
+    return provider
+
+
+def get_provider(name: str) -> Provider | None:
+    return PROVIDERS.get(name)
+
+
+def available_providers() -> list[Provider]:
+    return list(PROVIDERS.values())
+
+
+def _warm_up(provider: Provider) -> None:
+    start = time.monotonic()
+    try:
+        provider.warmup()
+    except Exception as e:
+        logger.warning("Warming up %s failed: %s", provider.name, e)
+    else:
+        logger.debug("Warmed up %s in %.2fs", provider.name, time.monotonic() - start)
+
+
+def warm_up_providers() -> None:
+    """Open the connections of every provider so the next answer skips the handshakes."""
+    providers = [p for p in available_providers() if p.warmup is not None]
+    if not providers:
+        return
+    with ThreadPoolExecutor(
+        max_workers=len(providers), thread_name_prefix="warmup"
+    ) as executor:
+        executor.map(_warm_up, providers)
+
+
+def start_keepalive(interval: float) -> threading.Thread:
+    """
+    Warm up the providers now and then again every `interval` seconds, so
+    their pooled connections are still open after an idle period. A zero
+    interval only warms them up once.
+    """
+
+    def run() -> None:
+        warm_up_providers()
+        while interval > 0:
+            time.sleep(interval)
+            warm_up_providers()
+
+    thread = threading.Thread(target=run, name="provider-keepalive", daemon=True)
+    thread.start()
+    return thread
+
+
+_DONE = object()
+# the `close` of the sdk streams opened by a hedged request, see `close_on_cancel`
+_stream_closers: ContextVar[list[Callable[[], Any]] | None] = ContextVar(
+    "stream_closers", default=None
+)
+
+
+def close_on_cancel(stream: S) -> S:
+    """
+    Let `hedged_stream` close `stream`, and with it its connection, as soon as
+    its request lost. Without it the loser stops with its next chunk.
+    """
+    closers = _stream_closers.get()
+    if closers is not None:
+        closers.append(stream.close)
+    return stream
+
+
+def _pump(
+    provider: Provider,
+    messages: ChatMessages,
+    out: queue.Queue,
+    cancel: threading.Event,
+    closers: list[Callable[[], Any]],
+    allowed: bool,
+) -> None:
+    _stream_closers.set(closers)
+    try:
+        with closing(
+            provider.stream(messages, allowed=allowed, cancel=cancel)
+        ) as pieces:
+            for piece in pieces:
+                # the loser notices the cancellation with its next chunk
+                if cancel.is_set():
+                    break
+                out.put((provider.name, piece))
+    except Exception as e:
+        if not cancel.is_set() and not isinstance(e, CircuitOpenError):
+            logger.warning("Hedged request to %s failed: %s", provider.name, e)
+        out.put((provider.name, e))
+    finally:
+        out.put((provider.name, _DONE))
+
+
+def hedged_stream(
+    primary: Provider,
+    fallback: Provider | None,
+    messages: ChatMessages,
+    budget: float | None = None,
+) -> Iterator[tuple[str, str]]:
+    """
+    Stream the answer of `primary`, but if its first token does not arrive
+    within `budget` seconds (the p95 of its latency histogram by default)
+    send the same request to `fallback` too. Whoever streams first wins and
+    the other one is cancelled. A primary with an open circuit breaker goes
+    to the fallback right away. Nothing waits past the deadline of the
+    handled message. Yields `(provider_name, piece)`.
+    """
+    if budget is None:
+        budget = primary.latency.hedge_budget()
+    deadline = current_deadline()
+    out: queue.Queue = queue.Queue()
+    cancels: dict[str, threading.Event] = {}
+    closers: dict[str, list[Callable[[], Any]]] = {}
+
+    def start(provider: Provider, allowed: bool = False) -> None:
+        cancels[provider.name] = threading.Event()
+        closers[provider.name] = []
+        # the provider thread keeps the deadline of the handled message
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(
+                _pump,
+                provider,
+                messages,
+                out,
+                cancels[provider.name],
+                closers[provider.name],
+                allowed,
+            ),
+            name=f"hedge-{provider.name}",
+            daemon=True,
+        ).start()
+
+    def cancel(name: str) -> None:
+        cancels[name].set()
+        # a hanging request would keep its thread and connection otherwise
+        for close in closers[name]:
+            try:
+                close()
+            except Exception:
+                logger.debug("Could not close the stream of %s", name)
+
+    def hedge() -> bool:
+        if fallback is None or fallback.name in cancels:
+            return False
+        # lets an open breaker whose reset timeout passed try its probe
+        if not fallback.breaker.allow():
+            return False
+        logger.info(
+            "No first token from %s after %.1fs, hedging with %s",
+            primary.name,
+            time.monotonic() - started_at,
+            fallback.name,
+        )
+        start(fallback, allowed=True)
+        return True
+
+    started_at = time.monotonic()
+    start(primary)
+    winner = None
+    running = 1
+    errors: dict[str, Exception] = {}
+    try:
+        while True:
+            hedging = winner is None and len(cancels) == 1
+            timeout = deadline.remaining()
+            if hedging:
+                timeout = min(budget, timeout)
+            try:
+                name, item = out.get(timeout=timeout)
+            except queue.Empty:
+                if hedging and hedge():
+                    running += 1
+                    continue
+                if not deadline.expired():
+                    continue
+                logger.warning("%s did not finish in time", " and ".join(cancels))
+                if winner is None:
+                    raise TimeoutError("No provider answered in time")
+                break
+            if winner is None and isinstance(item, str):
+                winner = name
+                for other in cancels:
+                    if other != winner:
+                        cancel(other)
+            if winner is not None and name != winner:
+                continue
+            if isinstance(item, str):
+                yield name, item
+            elif isinstance(item, Exception):
+                errors[name] = item
+            elif winner is not None:
+                break
+            else:
+                running -= 1
+                # failed before the first token, fail over right away
+                if hedge():
+                    running += 1
+                elif running == 0:
+                    break
+        if winner in errors:
+            raise errors[winner]
+        if winner is None and errors:
+            raise errors.get(primary.name) or next(iter(errors.values()))
+    finally:
+        for name in cancels:
+            cancel(name)
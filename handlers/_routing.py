@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import math
+import threading
+from typing import Any
+
+from config import ModelRoute, settings
+
+from ._providers import MIN_LATENCY_SAMPLES, ChatMessages, LatencyHistogram
+from ._utils import estimate_tokens, logger
+
+# what a picture costs at the sizes the vision models get, see VISION_MAX_SIDES
+ATTACHMENT_TOKENS = 765
+# role and separators of every message
+MESSAGE_TOKENS = 4
+# seconds a first token counts for the routes, a route skipped for being slow
+# runs out of samples after this and gets requests again to show it recovered
+ROUTE_LATENCY_WINDOW = 300.0
+
+# seconds to the first token by model, shared by every router picking it
+_model_latency: dict[str, LatencyHistogram] = {}
+_model_latency_lock = threading.Lock()
+
+
+def model_latency(model: str) -> LatencyHistogram:
+    with _model_latency_lock:
+        if model not in _model_latency:
+            _model_latency[model] = LatencyHistogram(max_age=ROUTE_LATENCY_WINDOW)
+        return _model_latency[model]
+
+
+def estimate_prompt(messages: ChatMessages) -> tuple[int, int]:
+    """Estimated tokens and number of pictures of a chat request."""
+    tokens = attachments = 0
+    for message in messages:
+        tokens += MESSAGE_TOKENS
+        content: Any = message.get("content") or ""
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                tokens += estimate_tokens(part.get("text", ""))
+            else:
+                attachments += 1
+    return tokens + attachments * ATTACHMENT_TOKENS, attachments
+
+
+class ModelRouter:
+    """
+    Picks the model variant of a provider for a request. The routes are tried
+    in order, so the fast ones come first and the long context ones last: the
+    first one that takes the estimated prompt and its pictures, and whose
+    p95 time to the first token in the last `ROUTE_LATENCY_WINDOW` seconds is
+    within its target, answers. Every decision is logged, to tune the routes
+    from.
+    """
+
+    def __init__(self, name: str, default_model: str, routes: list[ModelRoute]) -> None:
+        self.name = name
+        self.default_model = default_model
+        self.routes = routes
+
+    def choose(self, messages: ChatMessages) -> str:
+        if not self.routes:
+            return self.default_model
+        tokens, attachments = estimate_prompt(messages)
+        fitting = [
+            route
+            for route in self.routes
+            if (route.max_tokens is None or tokens <= route.max_tokens)
+            and (route.vision or not attachments)
+        ]
+        if not fitting:
+            route = max(self.routes, key=lambda r: r.max_tokens or math.inf)
+            reason = "too long for every route"
+        else:
+            route = next((r for r in fitting if self._within_target(r)), None)
+            reason = "first fitting"
+            if route is None:
+                route = min(fitting, key=lambda r: self.ttft(r.model))
+                reason = "every target missed, fastest"
+        ttft = self.ttft(route.model)
+        logger.info(
+            "Routed %s request of ~%d tokens and %d pictures to %s (%s, p95 %s)",
+            self.name,
+            tokens,
+            attachments,
+            route.model,
+            reason,
+            "n/a" if ttft is None else f"{ttft:.2f}s",
+        )
+        return route.model
+
+    def record(self, model: str, seconds: float) -> None:
+        """
+        Seconds to the first streamed token of `model`, the routes skip slow
+        ones. The whole time of a request answered at once is not one of them.
+        """
+        model_latency(model).record(seconds)
+
+    def ttft(self, model: str) -> float | None:
+        latency = model_latency(model)
+        if len(latency) < MIN_LATENCY_SAMPLES:
+            return None
+        return latency.percentile(95)
+
+    def _within_target(self, route: ModelRoute) -> bool:
+        ttft = self.ttft(route.model)
+        return route.target_ttft is None or ttft is None or ttft <= route.target_ttft
+
+
+def model_router(name: str, default_model: str) -> ModelRouter:
+    """The router of the routes under `name` in `settings.model_routes`."""
+    return ModelRouter(name, default_model, settings.model_routes.get(name, []))
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+# like the ExpiringDicts the sessions used to live in
+SESSION_MAX_AGE = 600
+
+
+class SessionStore:
+    """
+    Conversations as short json lists of turns by (kind, player id), instead
+    of live sdk objects in memory, so they also outlive a restart. Sessions
+    idle for longer than `max_age` seconds are forgotten.
+    """
+
+    def __init__(self, db_file: str, max_age: float = SESSION_MAX_AGE):
+        self._db_file = db_file
+        self.max_age = max_age
+        self._ready = False
+        self._init_lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """Create a new database connection, the first one creates the database."""
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return sqlite3.connect(self._db_file)
+
+    def _init_db(self):
+        parent_folder = os.path.dirname(self._db_file)
+        if parent_folder:
+            os.makedirs(parent_folder, exist_ok=True)
+        with closing(sqlite3.connect(self._db_file)) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    kind TEXT,
+                    player_id TEXT,
+                    turns TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (kind, player_id)
+                );
+            """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at);
+            """
+            )
+            conn.commit()
+
+    def _cutoff(self) -> str:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.max_age)
+        return cutoff.isoformat()
+
+    def load(self, kind: str, player_id: str) -> list[dict[str, Any]]:
+        with closing(self.connect()) as conn:
+            row = conn.execute(
+                """
+                SELECT turns FROM sessions
+                WHERE kind = ? AND player_id = ? AND updated_at >= ?;
+                """,
+                (kind, player_id, self._cutoff()),
+            ).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def save(self, kind: str, player_id: str, turns: list[dict[str, Any]]) -> None:
+        with closing(self.connect()) as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO sessions (kind, player_id, turns, updated_at)
+                VALUES (?, ?, ?, ?);
+                """,
+                (
+                    kind,
+                    player_id,
+                    json.dumps(turns, ensure_ascii=False, separators=(",", ":")),
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+            # the forgotten ones go on the way
+            conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?;", (self._cutoff(),)
+            )
+            conn.commit()
+
+    def clear(self, kind: str, player_id: str) -> None:
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "DELETE FROM sessions WHERE kind = ? AND player_id = ?;",
+                (kind, player_id),
+            )
+            conn.commit()
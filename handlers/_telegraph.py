@@ -6,7 +6,7 @@ import markdown
 import requests
 from bs4 import BeautifulSoup
 
-from ._utils import logger
+from ._utils import current_deadline, logger
 
 
 class TelegraphAPI:
@@ -30,6 +30,10 @@ class TelegraphAPI:
         self.author_name = account_info.get("author_name")
         self.author_url = account_info.get("author_url")
 
+    @staticmethod
+    def _timeout() -> float:
+        return current_deadline().timeout("telegraph")
+
     def _create_ph_account(self, short_name, author_name, author_url):
         Store_Token = False
         TELEGRAPH_API_URL = "https://api.telegra.ph/createAccount"
@@ -52,7 +56,7 @@ class TelegraphAPI:
         }
 
         # Make API request
-        response = requests.post(TELEGRAPH_API_URL, data=data)
+        response = requests.post(TELEGRAPH_API_URL, data=data, timeout=self._timeout())
         response.raise_for_status()
 
         account = response.json()
@@ -94,7 +98,7 @@ class TelegraphAPI:
             data["content"] = json.dumps(content)
 
         try:
-            response = requests.post(url, data=data)
+            response = requests.post(url, data=data, timeout=self._timeout())
             response.raise_for_status()
             response = response.json()
             page_url = response["result"]["url"]
@@ -104,7 +108,7 @@ class TelegraphAPI:
 
     def get_account_info(self):
         url = f'{self.base_url}/getAccountInfo?access_token={self.access_token}&fields=["short_name","author_name","author_url","auth_url"]'
-        response = requests.get(url)
+        response = requests.get(url, timeout=self._timeout())
 
         if response.status_code == 200:
             return response.json()["result"]
@@ -132,7 +136,7 @@ class TelegraphAPI:
             "author_url": author_url if author_url else self.author_url,
         }
 
-        response = requests.post(url, data=data)
+        response = requests.post(url, data=data, timeout=self._timeout())
         response.raise_for_status()
         response = response.json()
 
@@ -141,7 +145,7 @@ class TelegraphAPI:
 
     def get_page(self, path):
         url = f"{self.base_url}/getPage/{path}?return_content=true"
-        response = requests.get(url)
+        response = requests.get(url, timeout=self._timeout())
         response.raise_for_status()
         return response.json()["result"]["content"]
 
@@ -172,7 +176,7 @@ class TelegraphAPI:
 
     def authorize_browser(self):
         url = f'{self.base_url}/getAccountInfo?access_token={self.access_token}&fields=["auth_url"]'
-        response = requests.get(url)
+        response = requests.get(url, timeout=self._timeout())
         response.raise_for_status()
         return response.json()["result"]["auth_url"]
 
@@ -240,7 +244,9 @@ class TelegraphAPI:
             content_type = guess_type(file_name)[0]
             with open(file_name, "rb") as f:
                 response = requests.post(
-                    upload_url, files={"file": ("blob", f, content_type)}
+                    upload_url,
+                    files={"file": ("blob", f, content_type)},
+                    timeout=self._timeout(),
                 )
                 response.raise_for_status()
                 # [{'src': '/file/xx.jpg'}]
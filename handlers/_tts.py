@@ -1,12 +1,15 @@
 import glob
 import threading
 import subprocess
+from io import BytesIO
 from os import environ, remove
 
 from telebot import TeleBot
 from telebot.types import Message
 
 from . import *
+from ._jobs import Job, JobError, register_job_type, submit_job
+from ._utils import logger, upload_file
 
 import wave
 import numpy as np
@@ -33,16 +36,17 @@ if USE_CHATTTS:
     chat.load_models()
     lock = threading.Lock()  # Initialize a lock
 
-    def save_data_to_wav(filename, data):
+    def save_data_to_wav(output, data):
         sample_rate = 24000
-        # Open a .wav file to write into
-        with wave.open(filename, "w") as wf:
+        # Open a .wav file or buffer to write into
+        with wave.open(output, "w") as wf:
             wf.setnchannels(1)  # Mono channel
             wf.setsampwidth(2)  # 2 bytes per sample
             wf.setframerate(sample_rate)
             wf.writeframes(data.tobytes())
 
-    def generate_tts_wav(prompt, output_filename, seed=None):
+    def generate_tts_wav(prompt, output, seed=None):
+        """`output` is a file name or a buffer, e.g. a `BytesIO`."""
         texts = [
             prompt,
         ]
@@ -65,12 +69,12 @@ if USE_CHATTTS:
         )  # Ensure the data type is correct
         # Normalize the audio data to 16-bit PCM range
         audio_data = (audio_data * 32767).astype(np.int16)
-        save_data_to_wav(output_filename, audio_data)
+        save_data_to_wav(output, audio_data)
 
         if seed:
-            print(f"Audio has been saved to {output_filename} with seed {seed}")
+            print(f"Audio has been generated with seed {seed}")
         else:
-            print(f"Audio has been saved to {output_filename}")
+            print("Audio has been generated")
 
     def tts_handler(message: Message, bot: TeleBot):
         """pretty tts: /tts <prompt>"""
@@ -83,98 +87,105 @@ if USE_CHATTTS:
             bot.reply_to(message, "prompt too long must length < 150")
             return
         try:
+            audio = BytesIO()
             with lock:
-                generate_tts_wav(prompt, "tts.wav")
-            with open("tts.wav", "rb") as audio:
-                bot.send_audio(
-                    message.chat.id, audio, reply_to_message_id=message.message_id
-                )
+                generate_tts_wav(prompt, audio)
+            bot.send_audio(
+                message.chat.id,
+                upload_file(audio.getbuffer(), "tts.wav"),
+                reply_to_message_id=message.message_id,
+            )
         except Exception as e:
             print(e)
             bot.reply_to(message, "tts error")
 
+    def run_tts_pro_job(job: Job, bot: TeleBot):
+        seed = job.payload["seed"]
+        prompt = job.payload["prompt"]
+        # split the prompt by 100 characters
+        prompt_split = [prompt[i : i + 50] for i in range(0, len(prompt), 50)]
+        with lock:
+            if len(prompt_split) > 1:
+                job.progress(
+                    bot,
+                    "Will split the text and use the same to generate the audio and use ffmpeg to combin them pleas wait more time",
+                )
+                for k, v in enumerate(prompt_split):
+                    generate_tts_wav(v, f"{k}.wav", seed)
+                    with open("input.txt", "a") as f:
+                        f.write(f"file {k}.wav\n")
+                output_file = "tts_pro.wav"
+                # Run the FFmpeg command
+                try:
+                    # make sure remove it
+                    try:
+                        remove("tts_pro.wav")
+                    except:
+                        pass
+                    subprocess.run(
+                        [
+                            "ffmpeg",
+                            "-f",
+                            "concat",
+                            "-safe",
+                            "0",
+                            "-i",
+                            "input.txt",
+                            "-c",
+                            "copy",
+                            "tts_pro.wav",
+                        ],
+                        check=True,
+                    )
+                except Exception as e:
+                    logger.exception("Error combining audio files")
+                    remove("input.txt")
+                    raise JobError("tts error please check the log") from e
+                print(f"Combined audio saved as {output_file}")
+                with open("tts_pro.wav", "rb") as audio:
+                    bot.send_audio(
+                        job.chat_id,
+                        audio,
+                        reply_to_message_id=job.message_id,
+                    )
+                remove("input.txt")
+                for file in glob.glob("*.wav"):
+                    try:
+                        remove(file)
+                    except OSError as e:
+                        print(e)
+            else:
+                audio = BytesIO()
+                generate_tts_wav(prompt, audio, seed)
+                bot.send_audio(
+                    job.chat_id,
+                    upload_file(audio.getbuffer(), "tts_pro.wav"),
+                    reply_to_message_id=job.message_id,
+                )
+
+    # the model is shared behind `lock` anyway
+    register_job_type("tts_pro", run_tts_pro_job, concurrency=1, resumable=True)
+
     def tts_pro_handler(message: Message, bot: TeleBot):
         """pretty tts_pro: /tts_pro <seed>,<prompt>"""
         m = message.text.strip()
         prompt = m.strip()
         seed = prompt.split(",")[0]
-        bot.reply_to(
-            message,
-            f"Generating ChatTTS with seed: {seed} may take some time please wait some time.",
-        )
         if not seed.isdigit():
             bot.reply_to(message, "first argument must be a number")
             return
         prompt = prompt[len(str(seed)) + 1 :]
-        # split the prompt by 100 characters
-        prompt_split = [prompt[i : i + 50] for i in range(0, len(prompt), 50)]
         if not HAS_FFMPEG:
             if len(prompt) > 150:
                 bot.reply_to(message, "prompt too long must length < 150")
                 return
-        try:
-            with lock:
-                if len(prompt_split) > 1:
-                    bot.reply_to(
-                        message,
-                        "Will split the text and use the same to generate the audio and use ffmpeg to combin them pleas wait more time",
-                    )
-                    for k, v in enumerate(prompt_split):
-                        generate_tts_wav(v, f"{k}.wav", seed)
-                        with open("input.txt", "a") as f:
-                            f.write(f"file {k}.wav\n")
-                    output_file = "tts_pro.wav"
-                    # Run the FFmpeg command
-                    try:
-                        # make sure remove it
-                        try:
-                            remove("tts_pro.wav")
-                        except:
-                            pass
-                        subprocess.run(
-                            [
-                                "ffmpeg",
-                                "-f",
-                                "concat",
-                                "-safe",
-                                "0",
-                                "-i",
-                                "input.txt",
-                                "-c",
-                                "copy",
-                                "tts_pro.wav",
-                            ],
-                            check=True,
-                        )
-                    except Exception as e:
-                        print(f"Error combining audio files, {e}")
-                        bot.reply_to(message, "tts error please check the log")
-                        remove("input.txt")
-                        return
-                    print(f"Combined audio saved as {output_file}")
-                    with open("tts_pro.wav", "rb") as audio:
-                        bot.send_audio(
-                            message.chat.id,
-                            audio,
-                            reply_to_message_id=message.message_id,
-                        )
-                    remove("input.txt")
-                    for file in glob.glob("*.wav"):
-                        try:
-                            remove(file)
-                        except OSError as e:
-                            print(e)
-                else:
-                    generate_tts_wav(prompt, "tts_pro.wav", seed)
-                    with open("tts_pro.wav", "rb") as audio:
-                        bot.send_audio(
-                            message.chat.id,
-                            audio,
-                            reply_to_message_id=message.message_id,
-                        )
-        except Exception as e:
-            print(e)
-            bot.reply_to(message, "tts error")
+        submit_job(
+            bot,
+            message,
+            "tts_pro",
+            {"seed": seed, "prompt": prompt},
+            f"Generating ChatTTS with seed: {seed} may take some time please wait some time.",
+        )
 
     def register(bot: TeleBot) -> None:
         bot.register_message_handler(tts_handler, commands=["tts"], pass_bot=True)
@@ -1,21 +1,42 @@
 from __future__ import annotations
 
-import base64
+import binascii
+import contextvars
+import hashlib
 import logging
 import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from functools import update_wrapper
+from io import BytesIO
 from mimetypes import guess_type
-from typing import Any, Callable, TypeVar
+from typing import Any, BinaryIO, Callable, Hashable, Iterator, TypeVar
 
 import requests
 import telegramify_markdown
 from expiringdict import ExpiringDict
-from telebot import TeleBot
-from telebot.types import Message
+from PIL import Image
+from telebot import TeleBot, apihelper
+from telebot.types import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputFile,
+    Message,
+    PhotoSize,
+)
 from telebot.util import smart_split
 from telegramify_markdown.customize import get_runtime_config
 from urlextract import URLExtract
 
+from config import settings
+
+from ._clients import pooled_session
+
 get_runtime_config().markdown_symbol.head_level_1 = (
     "📌"  # If you want, Customizing the head level 1 symbol
 )
@@ -24,6 +45,7 @@ get_runtime_config().markdown_symbol.link = (
 )
 
 T = TypeVar("T", bound=Callable)
+S = TypeVar("S")
 logger = logging.getLogger("bot")
 
 
@@ -32,10 +54,207 @@ BOT_MESSAGE_LENGTH = 4000
 REPLY_MESSAGE_CACHE = ExpiringDict(max_len=1000, max_age_seconds=600)
 
 
-def bot_reply_first(message: Message, who: str, bot: TeleBot) -> Message:
+class SingleFlight:
+    """Concurrent callers asking for the same key share one call and its result."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args: Any) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+# share of the remaining request time and cap in seconds of every stage, the
+# provider leaves a bit for the telegraph upload and the final edits after it
+STAGE_BUDGETS: dict[str, tuple[float, float | None]] = {
+    "enrich": (0.25, 30.0),
+    "tools": (0.3, 30.0),
+    "provider": (0.9, None),
+    "telegraph": (1.0, 15.0),
+}
+MIN_STAGE_TIMEOUT = 1.0
+# stage name -> how many times it took longer than its budget
+STAGE_OVERRUNS: Counter[str] = Counter()
+_stage_overruns_lock = threading.Lock()
+
+
+class Deadline:
+    """
+    The time budget of one handled message. Every outbound call takes its
+    timeout from here, so a slow stage leaves less time for the next ones
+    instead of stretching the whole answer.
+    """
+
+    def __init__(self, seconds: float) -> None:
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() == 0
+
+    def timeout(self, stage: str, cap: float | None = None) -> float:
+        """Seconds the next call of `stage` may take."""
+        share, stage_cap = STAGE_BUDGETS[stage]
+        seconds = self.remaining() * share
+        for limit in (stage_cap, cap):
+            if limit is not None:
+                seconds = min(seconds, limit)
+        return max(MIN_STAGE_TIMEOUT, seconds)
+
+    @contextmanager
+    def stage(self, stage: str, cap: float | None = None) -> Iterator[float]:
+        """Yield the budget of `stage` and record it when it was overrun."""
+        budget = self.timeout(stage, cap)
+        start = time.monotonic()
+        try:
+            yield budget
+        finally:
+            elapsed = time.monotonic() - start
+            if elapsed > budget:
+                with _stage_overruns_lock:
+                    STAGE_OVERRUNS[stage] += 1
+                logger.warning(
+                    "Stage %s took %.1fs, over its %.1fs budget", stage, elapsed, budget
+                )
+
+
+_current_deadline: ContextVar[Deadline | None] = ContextVar(
+    "current_deadline", default=None
+)
+
+
+def current_deadline() -> Deadline:
+    """The deadline of the message being handled, a fresh one outside handlers."""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        deadline = Deadline(settings.request_deadline)
+    return deadline
+
+
+STOP_CALLBACK_DATA = "stop_generation"
+STOPPED_MARK = "\n\n_(stopped)_"
+TIMEOUT_MARK = "\n\n_(out of time)_"
+# placeholder (chat id, message id) -> (user id, cancel event) of running streams
+_running_generations: dict[tuple[int, int], tuple[int, Generation]] = {}
+_running_generations_lock = threading.Lock()
+
+
+def stop_markup() -> InlineKeyboardMarkup:
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("Stop", callback_data=STOP_CALLBACK_DATA))
+    return markup
+
+
+class Generation(threading.Event):
+    """
+    The cancel event of a running stream. Stopping it, or its deadline running
+    out, closes the responses given to `close_on_stop` right away instead of
+    with their next chunk, so a stalled stream is dropped too.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._closers: list[Callable[[], Any]] = []
+        self._closed = False
+        self._closers_lock = threading.Lock()
+
+    def close_on_stop(self, stream: S) -> S:
+        with self._closers_lock:
+            if not self._closed:
+                self._closers.append(stream.close)
+                return stream
+        stream.close()
+        return stream
+
+    def set(self) -> None:
+        super().set()
+        self.close_streams()
+
+    def close_streams(self) -> None:
+        with self._closers_lock:
+            self._closed = True
+            closers, self._closers = self._closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                logger.debug("Closing a stopped stream failed", exc_info=True)
+
+
+@contextmanager
+def cancellable_generation(
+    reply_id: Message, user_id: int, bot: TeleBot
+) -> Iterator[Generation]:
+    """Register a running stream, the event is set when the user stops it."""
+    key = (reply_id.chat.id, reply_id.message_id)
+    cancel = Generation()
+    expiry = threading.Timer(current_deadline().remaining(), cancel.close_streams)
+    expiry.daemon = True
+    expiry.start()
+    with _running_generations_lock:
+        _running_generations[key] = (user_id, cancel)
+    try:
+        yield cancel
+    except BaseException:
+        # nothing listens to the stop button of a failed answer anymore
+        try:
+            bot.edit_message_reply_markup(
+                reply_id.chat.id, reply_id.message_id, reply_markup=None
+            )
+        except Exception:
+            logger.debug("Removing the stop button failed", exc_info=True)
+        raise
+    finally:
+        expiry.cancel()
+        with _running_generations_lock:
+            _running_generations.pop(key, None)
+
+
+def cancel_generations(
+    chat_id: int, user_id: int, message_id: int | None = None
+) -> int:
+    """Stop the user's streams in the chat, or only the one of that placeholder."""
+    cancelled = 0
+    with _running_generations_lock:
+        for (chat, message), (owner, cancel) in _running_generations.items():
+            if chat != chat_id or owner != user_id:
+                continue
+            if message_id is not None and message != message_id:
+                continue
+            cancel.set()
+            cancelled += 1
+    return cancelled
+
+
+def bot_reply_first(
+    message: Message, who: str, bot: TeleBot, cancellable: bool = False
+) -> Message:
     """Create the first reply message which make user feel the bot is working."""
     return bot.reply_to(
-        message, f"*{who}* is _thinking_ \\.\\.\\.", parse_mode="MarkdownV2"
+        message,
+        f"*{who}* is _thinking_ \\.\\.\\.",
+        parse_mode="MarkdownV2",
+        reply_markup=stop_markup() if cancellable else None,
     )
 
 
@@ -46,6 +265,7 @@ def bot_reply_markdown(
     bot: TeleBot,
     split_text: bool = True,
     disable_web_page_preview: bool = False,
+    reply_markup: InlineKeyboardMarkup | None = None,
 ) -> bool:
     """
     reply the Markdown by take care of the message length.
@@ -53,10 +273,15 @@ def bot_reply_markdown(
     """
     try:
         cache_key = f"{reply_id.chat.id}_{reply_id.message_id}"
-        if cache_key in REPLY_MESSAGE_CACHE and REPLY_MESSAGE_CACHE[cache_key] == text:
+        # the same text still needs an edit to drop the stop button
+        cache_value = (text, reply_markup is not None)
+        if (
+            cache_key in REPLY_MESSAGE_CACHE
+            and REPLY_MESSAGE_CACHE[cache_key] == cache_value
+        ):
             logger.info(f"Skipping duplicate message for {cache_key}")
             return True
-        REPLY_MESSAGE_CACHE[cache_key] = text
+        REPLY_MESSAGE_CACHE[cache_key] = cache_value
         if len(text.encode("utf-8")) <= BOT_MESSAGE_LENGTH or not split_text:
             bot.edit_message_text(
                 f"*{who}*:\n{telegramify_markdown.markdownify(text)}",
@@ -64,6 +289,7 @@ def bot_reply_markdown(
                 message_id=reply_id.message_id,
                 parse_mode="MarkdownV2",
                 disable_web_page_preview=disable_web_page_preview,
+                reply_markup=reply_markup,
             )
             return True
 
@@ -92,6 +318,7 @@ def bot_reply_markdown(
             chat_id=reply_id.chat.id,
             message_id=reply_id.message_id,
             disable_web_page_preview=disable_web_page_preview,
+            reply_markup=reply_markup,
         )
         return False
 
@@ -145,9 +372,37 @@ def non_llm_handler(handler: T) -> T:
     return handler
 
 
+def _resets_history(prompt: str) -> bool:
+    """`clear` and `new ...` change the history, they are never merged."""
+    prompt = prompt.strip()
+    return prompt == "clear" or prompt[:4].lower() == "new "
+
+
+def _merge_prompts(messages: list[Message]) -> Message:
+    """The first message, asking what all of them asked."""
+    message = messages[0]
+    message.text = "\n".join(m.text for m in messages)
+    return message
+
+
 def wrap_handler(handler: T, bot: TeleBot) -> T:
-    def wrapper(message: Message, *args: Any, **kwargs: Any) -> None:
+    def answer_debounced(messages: list[Message], *args: Any, **kwargs: Any) -> None:
+        if len(messages) > 1:
+            logger.info(
+                "Merged %d prompts of %s for %s",
+                len(messages),
+                messages[0].from_user.id,
+                handler.__name__,
+            )
+        wrapper(_merge_prompts(messages), *args, debounced=True, **kwargs)
+
+    def wrapper(
+        message: Message, *args: Any, debounced: bool = False, **kwargs: Any
+    ) -> None:
+        token = _current_deadline.set(Deadline(settings.request_deadline))
         try:
+            if debounced:
+                return handler(message, *args, **kwargs)
             if getattr(handler, "__is_llm_handler__", True):
                 m = ""
 
@@ -165,6 +420,20 @@ def wrap_handler(handler: T, bot: TeleBot) -> T:
                 if not m:
                     bot.reply_to(message, "Please provide info after start words.")
                     return
+                if settings.debounce_ms > 0 and message.text is not None:
+                    key = (message.chat.id, message.from_user.id, handler.__name__)
+                    if _resets_history(m):
+                        # the prompts before it are answered first, in order
+                        debounced_prompts.flush(key)
+                        return handler(message, *args, **kwargs)
+                    # wait a moment for the rest of a question sent in pieces
+                    debounced_prompts.add(
+                        message,
+                        lambda messages: answer_debounced(messages, *args, **kwargs),
+                        key=key,
+                        bot=bot,
+                    )
+                    return
             return handler(message, *args, **kwargs)
         except Exception as e:
             logger.exception("Error in handler %s: %s", handler.__name__, e)
@@ -173,41 +442,439 @@ def wrap_handler(handler: T, bot: TeleBot) -> T:
                 bot.reply_to(message, "Your prompt `RECITATION` please check the log")
             else:
                 bot.reply_to(message, "Something wrong, please check the log")
+        finally:
+            _current_deadline.reset(token)
 
     return update_wrapper(wrapper, handler)
 
 
+# the pages of the urls in a message are fetched at once, each one is read up
+# to `URL_PAGE_MAX_BYTES` and they share a budget of `settings.url_tokens`
+MAX_URL_FETCHES = 8
+URL_FETCH_TIMEOUT = 15.0
+URL_PAGE_MAX_BYTES = 256 * 1024
+URL_CHUNK_SIZE = 16 * 1024
+# ascii text is about four characters a token, the others about one each
+CHARS_PER_TOKEN = 4
+# share of a cut page kept from its start, the rest comes from its end
+PAGE_HEAD_SHARE = 0.75
+_url_fetcher = ThreadPoolExecutor(
+    max_workers=MAX_URL_FETCHES, thread_name_prefix="url-fetch"
+)
+_page_flight = SingleFlight()
+
+
+# urlextract only finds a known tld after a dot, or localhost, so a message
+# with neither, which is most of them, skips its scan
+_URL_HINT = re.compile(r"\.\w|localhost", re.IGNORECASE)
+# loading the tld list is the slow part, it is done once
+url_extractor = URLExtract()
+
+
 def extract_url_from_text(text: str) -> list[str]:
-    extractor = URLExtract()
-    urls = extractor.find_urls(text)
-    return urls
+    if not _URL_HINT.search(text):
+        return []
+    return url_extractor.find_urls(text)
 
 
-def get_text_from_jina_reader(url: str):
+def get_text_from_jina_reader(
+    url: str, timeout: float | None = None, max_bytes: int = URL_PAGE_MAX_BYTES
+):
+    if timeout is None:
+        timeout = current_deadline().timeout("enrich")
     try:
-        r = requests.get(f"https://r.jina.ai/{url}")
-        return r.text
+        with pooled_session("jina").get(
+            f"https://r.jina.ai/{url}", timeout=timeout, stream=True
+        ) as r:
+            r.raise_for_status()
+            content = bytearray()
+            for chunk in r.iter_content(URL_CHUNK_SIZE):
+                content += chunk
+                if len(content) >= max_bytes:
+                    # the rest of a long page would be cut from the prompt anyway
+                    logger.info("Stopped reading %s at %d bytes", url, max_bytes)
+                    del content[max_bytes:]
+                    break
+            # a character split by the cap is dropped
+            return content.decode(r.encoding or "utf-8", errors="ignore")
     except Exception as e:
         logger.exception("Error fetching text from Jina reader: %s", e)
         return None
 
 
-def enrich_text_with_urls(text: str) -> str:
-    urls = extract_url_from_text(text)
-    for u in urls:
-        try:
-            url_text = get_text_from_jina_reader(u)
-            url_text = f"\n```markdown\n{url_text}\n```\n"
-            text = text.replace(u, url_text)
-        except Exception:
-            # just ignore the error
-            pass
+def estimate_tokens(text: str) -> int:
+    ascii_chars = len(text.encode("ascii", errors="ignore"))
+    return ascii_chars // CHARS_PER_TOKEN + len(text) - ascii_chars
 
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Cut `text` to about `tokens` tokens, keeping its start and its end."""
+    estimated = estimate_tokens(text)
+    if estimated <= tokens:
+        return text
+    keep = len(text) * tokens // estimated
+    head = int(keep * PAGE_HEAD_SHARE)
+    tail = keep - head
+    return f"{text[:head]}\n...\n{text[len(text) - tail:]}"
+
+
+def fetch_page(url: str, timeout: float) -> str | None:
+    """The text of the page at `url`, from the page cache when it is there."""
+    from ._pages import page_cache
+
+    text = page_cache.get(url)
+    if text is None:
+        text = _page_flight.do(url, _fetch_page, url, timeout)
     return text
 
 
-def image_to_data_uri(file_path):
-    content_type = guess_type(file_path)[0]
-    with open(file_path, "rb") as image_file:
-        encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"data:{content_type};base64,{encoded_image}"
+def _fetch_page(url: str, timeout: float) -> str | None:
+    from ._pages import page_cache
+
+    text = get_text_from_jina_reader(url, timeout=timeout)
+    if text is not None:
+        page_cache.put(url, text)
+    return text
+
+
+def enrich_text_with_urls(text: str, token_budget: int | None = None) -> str:
+    """
+    Put the pages of the urls into `text`. They share `token_budget` tokens,
+    `settings.url_tokens` by default, so models with a small context or a
+    high price can ask for less.
+    """
+    urls = list(dict.fromkeys(extract_url_from_text(text)))
+    if not urls:
+        return text
+    if token_budget is None:
+        token_budget = settings.url_tokens
+    with current_deadline().stage("enrich") as budget:
+        # all the urls are fetched at once, each within the budget of the stage
+        timeout = min(budget, URL_FETCH_TIMEOUT)
+        pages = {u: _url_fetcher.submit(fetch_page, u, timeout) for u in urls}
+        done, _ = wait(pages.values(), timeout=budget)
+    url_texts = {}
+    for u, page in pages.items():
+        if page not in done:
+            logger.warning("No time left to fetch %s", u)
+        elif (url_text := page.result()) is not None:
+            url_texts[u] = url_text
+    # the pages that could not be read leave their share to the others
+    for u, url_text in url_texts.items():
+        url_text = truncate_to_tokens(url_text, token_budget // len(url_texts))
+        text = text.replace(u, f"\n```markdown\n{url_text}\n```\n")
+    return text
+
+
+# media goes download -> bytes -> optional transform -> upload, each request
+# keeps its own buffers instead of sharing a fixed file in the working directory
+ImageTransform = Callable[[bytes], bytes]
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def download_telegram_file(
+    bot: TeleBot, file_id: str, file_unique_id: str | None = None
+) -> bytes:
+    """
+    Download a telegram file into memory. With its `file_unique_id` the file
+    comes from the cache, and concurrent downloads of it are shared.
+    """
+    from ._files import file_cache
+
+    def download() -> bytes:
+        file_path = bot.get_file(file_id).file_path
+        return bot.download_file(file_path)
+
+    if file_unique_id is None:
+        return download()
+    return file_cache.fetch(file_unique_id, download)
+
+
+def stream_telegram_file(bot: TeleBot, file_id: str, output: BinaryIO) -> str:
+    """
+    Write a telegram file to `output` as it arrives, for files too large to
+    hold in memory, and return the sha256 of its content.
+    """
+    file_path = bot.get_file(file_id).file_path
+    if apihelper.FILE_URL is None:
+        url = f"https://api.telegram.org/file/bot{bot.token}/{file_path}"
+    else:
+        url = apihelper.FILE_URL.format(bot.token, file_path)
+    digest = hashlib.sha256()
+    with requests.get(
+        url,
+        stream=True,
+        proxies=apihelper.proxy,
+        timeout=current_deadline().timeout("provider"),
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            output.write(chunk)
+    return digest.hexdigest()
+
+
+# longest and shortest side the providers scale an image down to before they
+# look at it, sending more only costs upload bytes, base64 and tokens
+VISION_MAX_SIDES: dict[str, tuple[int, int | None]] = {
+    "openai": (2048, 768),
+    "yi": (2048, 768),
+    "claude": (1568, None),
+    "gemini": (3072, None),
+}
+# a size up to this much larger than needed is sent as it is, re-encoding it
+# would hardly save anything
+DOWNSCALE_SLACK = 1.2
+JPEG_QUALITY = 90
+MAX_PHOTO_DOWNLOADS = 4
+# a multiple of 3 bytes, so the chunks encode without padding in between
+BASE64_CHUNK = 3 * 64 * 1024
+# seconds to wait for more photos of an album after the last one arrived
+MEDIA_GROUP_WINDOW = 1.0
+# provider -> bytes of photos not uploaded thanks to the smaller sizes
+VISION_BYTES_SAVED: Counter[str] = Counter()
+_vision_bytes_saved_lock = threading.Lock()
+
+
+def vision_size(width: int, height: int, provider: str) -> tuple[int, int]:
+    """The size `provider` scales a `width` x `height` image down to."""
+    max_long, max_short = VISION_MAX_SIDES[provider]
+    scale = min(1.0, max_long / max(width, height))
+    if max_short is not None:
+        scale = min(scale, max_short / min(width, height))
+    return round(width * scale), round(height * scale)
+
+
+def downscale_image(data: bytes, size: tuple[int, int]) -> bytes:
+    """Re-encode a jpeg to fit in `size`, `draft` already decodes it smaller."""
+    with Image.open(BytesIO(data)) as image:
+        image.draft("RGB", size)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def _download_vision_photo(
+    photos: list[PhotoSize], bot: TeleBot, provider: str
+) -> bytes:
+    from ._files import file_cache
+
+    largest = max(photos, key=lambda p: p.width * p.height)
+    width, height = vision_size(largest.width, largest.height, provider)
+    # telegram keeps every photo in a few sizes, the smallest one as large as
+    # what the provider looks at loses nothing, 2px for the rounding
+    photo = min(
+        (p for p in photos if p.width >= width - 2 and p.height >= height - 2),
+        key=lambda p: p.width * p.height,
+    )
+    if photo.width * photo.height <= width * height * DOWNSCALE_SLACK**2:
+        data = download_telegram_file(bot, photo.file_id, photo.file_unique_id)
+    else:
+
+        def downscale() -> bytes:
+            original = download_telegram_file(bot, photo.file_id, photo.file_unique_id)
+            smaller = downscale_image(original, (width, height))
+            return smaller if len(smaller) < len(original) else original
+
+        data = file_cache.fetch(f"{photo.file_unique_id}.{width}x{height}", downscale)
+    saved = (largest.file_size or 0) - len(data)
+    if saved > 0:
+        with _vision_bytes_saved_lock:
+            VISION_BYTES_SAVED[provider] += saved
+        logger.debug(
+            "Sending %s a %dx%d photo saved %d bytes", provider, width, height, saved
+        )
+    return data
+
+
+def download_photo(
+    message: Message,
+    bot: TeleBot,
+    transform: ImageTransform | None = None,
+    provider: str | None = None,
+) -> bytes:
+    """
+    Download the photo in `message`, then `transform` it. For a vision
+    `provider` of `VISION_MAX_SIDES` it is no larger than the provider needs,
+    otherwise it is the largest size.
+    """
+    if provider is not None:
+        data = _download_vision_photo(message.photo, bot, provider)
+    else:
+        max_size_photo = max(message.photo, key=lambda p: p.file_size)
+        data = download_telegram_file(
+            bot, max_size_photo.file_id, max_size_photo.file_unique_id
+        )
+    return transform(data) if transform is not None else data
+
+
+def _encode_base64(prefix: str, data: bytes | memoryview) -> str:
+    """`prefix` and then `data` in base64, with a single full encoded copy."""
+    view = memoryview(data)
+    head = prefix.encode("ascii")
+    # the exact size is known, so the chunks go straight into their place and
+    # nothing is grown or joined, the only other copy is the decoded result
+    out = bytearray(len(head) + (len(view) + 2) // 3 * 4)
+    out[: len(head)] = head
+    pos = len(head)
+    for start in range(0, len(view), BASE64_CHUNK):
+        chunk = binascii.b2a_base64(view[start : start + BASE64_CHUNK], newline=False)
+        out[pos : pos + len(chunk)] = chunk
+        pos += len(chunk)
+    return out.decode("ascii")
+
+
+def image_to_base64(image: bytes | memoryview) -> str:
+    return _encode_base64("", image)
+
+
+def image_to_data_uri(
+    image: bytes | memoryview | str, content_type: str = "image/jpeg"
+) -> str:
+    """`image` is the image itself, or the path of a file with it."""
+    if isinstance(image, str):
+        content_type = guess_type(image)[0] or content_type
+        with open(image, "rb") as image_file:
+            image = image_file.read()
+    return _encode_base64(f"data:{content_type};base64,", image)
+
+
+def upload_file(data: bytes | memoryview, file_name: str) -> InputFile:
+    """Send `data` without writing it to disk, `file_name` tells telegram the type."""
+    return InputFile(BytesIO(data), file_name=file_name)
+
+
+def download_photos(
+    messages: list[Message], bot: TeleBot, provider: str | None = None
+) -> list[bytes]:
+    """Download the photos of several messages, e.g. an album, at the same time."""
+    if len(messages) == 1:
+        return [download_photo(messages[0], bot, provider=provider)]
+    with ThreadPoolExecutor(max_workers=min(len(messages), MAX_PHOTO_DOWNLOADS)) as ex:
+        futures = [
+            ex.submit(
+                contextvars.copy_context().run,
+                download_photo,
+                m,
+                bot,
+                provider=provider,
+            )
+            for m in messages
+        ]
+        return [f.result() for f in futures]
+
+
+@dataclass
+class _Batch:
+    messages: list[Message] = field(default_factory=list)
+    callback: Callable[[list[Message]], None] | None = None
+    bot: TeleBot | None = None
+    timer: threading.Timer | None = None
+
+
+class MessageBatcher:
+    """
+    Collects messages that belong together until none arrived for `window`
+    seconds, then hands them to the callback on the workers of the bot.
+    Telegram sends an album as one message per photo, and only one of them
+    has the caption, so messages are batched by `media_group_id` by default
+    and the album goes to the callback of the captioned one, see
+    `on_complete`. Prompts sent in quick succession are batched by any key.
+    """
+
+    def __init__(self, window: float = MEDIA_GROUP_WINDOW) -> None:
+        self.window = window
+        self._batches: dict[Hashable, _Batch] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def add(
+        self,
+        message: Message,
+        callback: Callable[[list[Message]], None] | None = None,
+        key: Hashable | None = None,
+        bot: TeleBot | None = None,
+    ) -> None:
+        """
+        Batch `message` by `key`, its `media_group_id` by default. The callback
+        runs on the worker pool of `bot`, without one on the timer thread.
+        """
+        if key is None:
+            key = message.media_group_id
+        with self._lock:
+            batch = self._batches.setdefault(key, _Batch())
+            batch.messages.append(message)
+            if callback is not None:
+                batch.callback = callback
+                batch.bot = bot
+            if batch.timer is not None:
+                batch.timer.cancel()
+            batch.timer = threading.Timer(self.window, self._flush, (key,))
+            batch.timer.daemon = True
+            batch.timer.start()
+
+    def on_complete(
+        self, message: Message, bot: TeleBot, callback: Callable[[list[Message]], None]
+    ) -> None:
+        """Call `callback` with all messages of the album of `message`, in order."""
+        context = contextvars.copy_context()
+
+        def run(messages: list[Message]) -> None:
+            try:
+                # with the deadline of the captioned message
+                context.run(callback, messages)
+            except Exception as e:
+                logger.exception("Error in the album of %s: %s", message.message_id, e)
+                bot.reply_to(message, "Something wrong, please check the log")
+
+        self.add(message, run, bot=bot)
+
+    def flush(self, key: Hashable) -> None:
+        """Answer what is batched by `key` right away, in this thread."""
+        with self._lock:
+            batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        if batch.callback is not None:
+            batch.callback(sorted(batch.messages, key=lambda m: m.message_id))
+
+    def drop(self, match: Callable[[Hashable], bool]) -> int:
+        """Forget the batches whose key matches, returns how many messages they had."""
+        with self._lock:
+            batches = [self._batches.pop(k) for k in list(self._batches) if match(k)]
+        for batch in batches:
+            batch.timer.cancel()
+        return sum(len(batch.messages) for batch in batches)
+
+    def _flush(self, key: Hashable) -> None:
+        with self._lock:
+            batch = self._batches.get(key)
+            # a message arrived while this timer fired, the new timer flushes
+            if batch is None or batch.timer is not threading.current_thread():
+                return
+            del self._batches[key]
+        # an album nobody asked about is just dropped
+        if batch.callback is None:
+            return
+        messages = sorted(batch.messages, key=lambda m: m.message_id)
+        if batch.bot is not None and batch.bot.threaded:
+            # the timer thread only hands the batch over, the workers answer it
+            batch.bot.worker_pool.put(batch.callback, messages)
+        else:
+            batch.callback(messages)
+
+
+media_groups = MessageBatcher()
+# prompts for the same handler sent within the window are answered at once
+debounced_prompts = MessageBatcher(settings.debounce_ms / 1000)
+
+
+def drop_debounced_prompts(chat_id: int, user_id: int) -> int:
+    """Forget the user's prompts in the chat still waiting to be answered."""
+    return debounced_prompts.drop(lambda key: key[:2] == (chat_id, user_id))
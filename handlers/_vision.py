@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from expiringdict import ExpiringDict
+from telebot.types import Message
+
+# (photo, provider) and (chat, answer message, provider) -> what an answer
+# said about the photo, follow-ups replying to either carry it as text
+photo_descriptions = ExpiringDict(max_len=1000, max_age_seconds=6 * 60 * 60)
+
+
+def photo_key(message: Message) -> str:
+    """The same for every message with the same photo."""
+    return max(message.photo, key=lambda p: p.width * p.height).file_unique_id
+
+
+def replied_photo(message: Message) -> Message | None:
+    """The photo message `message` replies to, if it replies to one."""
+    reply = message.reply_to_message
+    if reply is not None and reply.photo:
+        return reply
+    return None
+
+
+def remember_description(
+    photos: list[Message], answer: Message, provider: str, description: str
+) -> None:
+    """
+    Keep the vision answer about `photos` for the follow-ups, it costs nothing
+    more than the answer itself. Telegram does not tell which photo a reply to
+    the answer is about, so the answer message is a key of its own.
+    """
+    for photo in photos:
+        photo_descriptions[(photo_key(photo), provider)] = description
+    photo_descriptions[(answer.chat.id, answer.message_id, provider)] = description
+
+
+def known_description(message: Message, provider: str) -> str | None:
+    """
+    What an earlier answer said about the photo, or the vision answer,
+    `message` replies to. Nothing is described on the spot, a follow-up must
+    not cost another vision call before its answer.
+    """
+    reply = message.reply_to_message
+    if reply is None:
+        return None
+    if reply.photo:
+        return photo_descriptions.get((photo_key(reply), provider))
+    return photo_descriptions.get((reply.chat.id, reply.message_id, provider))
+
+
+def with_image_description(text: str, description: str) -> str:
+    return f"[The user refers to an image, about it you said: {description}]\n\n{text}"
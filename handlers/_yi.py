@@ -9,6 +9,7 @@ from telebot.types import Message
 from telegramify_markdown import markdownify
 
 from . import *
+from ._utils import download_photo, image_to_data_uri
 
 YI_BASE_URL = environ.get("YI_BASE_URL")
 YI_API_KEY = environ.get("YI_API_KEY")
@@ -48,11 +49,11 @@ def yi_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "Yi"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -113,10 +114,10 @@ def yi_pro_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "yi Pro"
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -167,12 +168,8 @@ def yi_photo_handler(message: Message, bot: TeleBot) -> None:
     who = "Yi Vision"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
-    # get the high quaility picture.
-    max_size_photo = max(message.photo, key=lambda p: p.file_size)
-    file_path = bot.get_file(max_size_photo.file_id).file_path
-    downloaded_file = bot.download_file(file_path)
-    with open("yi_temp.jpg", "wb") as temp_file:
-        temp_file.write(downloaded_file)
+    # the smallest picture the model still sees in full
+    image = download_photo(message, bot, provider="yi")
 
     headers = {
         "Content-Type": "application/json",
@@ -188,7 +185,7 @@ def yi_photo_handler(message: Message, bot: TeleBot) -> None:
                     {"type": "text", "text": prompt},
                     {
                         "type": "image_url",
-                        "image_url": {"url": image_to_data_uri("yi_temp.jpg")},
+                        "image_url": {"url": image_to_data_uri(image)},
                     },
                 ],
             }
@@ -0,0 +1,24 @@
+from telebot import TeleBot
+from telebot.types import Message
+
+from config import settings
+
+from ._utils import media_groups, non_llm_handler
+
+
+@non_llm_handler
+def album_photo_handler(message: Message, bot: TeleBot) -> None:
+    # the captioned photo of the album asks the model, it needs the others too
+    media_groups.add(message)
+
+
+# only chatgpt answers albums, without it the photos need not be collected
+if settings.openai_api_key:
+
+    def register(bot: TeleBot) -> None:
+        bot.register_message_handler(
+            album_photo_handler,
+            content_types=["photo"],
+            func=lambda m: m.media_group_id is not None and not m.caption,
+            pass_bot=True,
+        )
@@ -1,7 +1,10 @@
+import contextvars
 import json
 import time
 import uuid
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
 
 import requests
 from expiringdict import ExpiringDict
@@ -10,19 +13,48 @@ from telebot.types import Message
 
 from config import settings
 
+from ._providers import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Provider,
+    close_on_cancel,
+    get_provider,
+    hedged_stream,
+    register_provider,
+)
+from ._routing import model_router
 from ._utils import (
+    STOPPED_MARK,
+    TIMEOUT_MARK,
+    Generation,
+    SingleFlight,
     bot_reply_first,
     bot_reply_markdown,
+    cancellable_generation,
+    current_deadline,
+    download_photos,
     enrich_text_with_urls,
     image_to_data_uri,
     logger,
+    media_groups,
+    stop_markup,
 )
+from ._vision import known_description, remember_description, with_image_description
 
 CHATGPT_MODEL = settings.openai_model
 CHATGPT_PRO_MODEL = settings.openai_model
+CHATGPT_PROVIDER_NAME = "ChatGPT"
+# the answers of /gpt, hedged or not, save me some money
+CHATGPT_MAX_TOKENS = 1024
 
 
 client = settings.openai_client
+# the models of the `model_routes` setting, or the ones above without them
+chatgpt_router = model_router(CHATGPT_PROVIDER_NAME, CHATGPT_MODEL)
+# /gpt_pro, albums and photo descriptions have routes of their own
+chatgpt_pro_router = model_router(f"{CHATGPT_PROVIDER_NAME}-pro", CHATGPT_PRO_MODEL)
+# shared by the handlers and the provider so a dead upstream fails fast everywhere
+chatgpt_breaker = CircuitBreaker(CHATGPT_PROVIDER_NAME)
 
 
 # Web search / tool-calling configuration
@@ -65,11 +97,17 @@ WEB_SEARCH_TOOL = {
 }
 STREAMING_UPDATE_INTERVAL = 1.2
 MAX_TOOL_ITERATIONS = 3
+# all tool calls of one model turn share this deadline
+TOOL_CALLS_TIMEOUT = settings.ollama_web_search_timeout + 5
+MAX_PARALLEL_TOOL_CALLS = 4
 
 
 # Global history cache
 chatgpt_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
 chatgpt_pro_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
+# formatted web search results keyed by (normalized query, max_results)
+web_search_cache = ExpiringDict(max_len=500, max_age_seconds=600)
+_web_search_flight = SingleFlight()
 
 
 def _web_search_available() -> bool:
@@ -109,6 +147,20 @@ def _format_web_search_results(payload: dict[str, Any]) -> str:
     return json.dumps(payload, ensure_ascii=False)
 
 
+def _fetch_ollama_web_search(payload: dict[str, Any], timeout: float) -> str:
+    headers = {
+        "Authorization": f"Bearer {settings.ollama_web_search_api_key}",
+    }
+    response = requests.post(
+        OLLAMA_WEB_SEARCH_URL,
+        json=payload,
+        headers=headers,
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    return _format_web_search_results(response.json())
+
+
 def _call_ollama_web_search(query: str, max_results: int | None = None) -> str:
     if not _web_search_available():
         return "Web search is not configured."
@@ -118,31 +170,25 @@ def _call_ollama_web_search(query: str, max_results: int | None = None) -> str:
         limit = settings.ollama_web_search_max_results
     if limit:
         payload["max_results"] = int(limit)
-    headers = {
-        "Authorization": f"Bearer {settings.ollama_web_search_api_key}",
-    }
+    key = (" ".join(query.lower().split()), limit)
+    if (cached := web_search_cache.get(key)) is not None:
+        logger.debug("Web search cache hit for %r", query)
+        return cached
     try:
-        response = requests.post(
-            OLLAMA_WEB_SEARCH_URL,
-            json=payload,
-            headers=headers,
-            timeout=settings.ollama_web_search_timeout,
+        # users asking about the same news at the same time share one request
+        # a call the turn stopped waiting for gives its worker back in time
+        timeout = current_deadline().timeout(
+            "tools", cap=settings.ollama_web_search_timeout
         )
-        response.raise_for_status()
-        data = response.json()
+        result = _web_search_flight.do(key, _fetch_ollama_web_search, payload, timeout)
     except requests.RequestException as exc:
         logger.exception("Ollama web search failed: %s", exc)
         return f"Web search error: {exc}"
     except ValueError:
         logger.exception("Invalid JSON payload from Ollama web search")
         return "Web search error: invalid payload."
-    return _format_web_search_results(data)
-
-
-def _available_tools() -> list[dict[str, Any]]:
-    if not _web_search_available():
-        return []
-    return [WEB_SEARCH_TOOL]
+    web_search_cache[key] = result
+    return result
 
 
 def _accumulate_tool_call_deltas(
@@ -193,6 +239,50 @@ def _finalize_tool_calls(buffer: dict[int, dict[str, Any]]) -> list[dict[str, An
     return tool_calls
 
 
+@dataclass
+class Tool:
+    """A function the model may call, `parallel_safe` ones run concurrently."""
+
+    schema: dict[str, Any]
+    func: Callable[[dict[str, Any]], str]
+    available: Callable[[], bool] = lambda: True
+    parallel_safe: bool = True
+
+    @property
+    def name(self) -> str:
+        return self.schema["function"]["name"]
+
+
+TOOLS: dict[str, Tool] = {}
+_tool_executor = ThreadPoolExecutor(
+    max_workers=MAX_PARALLEL_TOOL_CALLS, thread_name_prefix="chatgpt_tool"
+)
+
+
+def register_tool(tool: Tool) -> Tool:
+    TOOLS[tool.name] = tool
+    return tool
+
+
+def _web_search_tool(arguments: dict[str, Any]) -> str:
+    query = (arguments.get("query") or "").strip()
+    if not query:
+        return "Web search error: no query provided."
+    max_results = arguments.get("max_results")
+    if isinstance(max_results, str):
+        max_results = int(max_results) if max_results.isdigit() else None
+    elif not isinstance(max_results, int):
+        max_results = None
+    return _call_ollama_web_search(query, max_results)
+
+
+register_tool(Tool(WEB_SEARCH_TOOL, _web_search_tool, _web_search_available))
+
+
+def _available_tools() -> list[dict[str, Any]]:
+    return [tool.schema for tool in TOOLS.values() if tool.available()]
+
+
 def _execute_tool(function_name: str, arguments_json: str) -> str:
     try:
         arguments = json.loads(arguments_json or "{}")
@@ -200,18 +290,52 @@ def _execute_tool(function_name: str, arguments_json: str) -> str:
         logger.exception("Invalid tool arguments for %s: %s", function_name, exc)
         return f"Invalid arguments for {function_name}: {exc}"
 
-    if function_name == WEB_SEARCH_TOOL_NAME:
-        query = (arguments.get("query") or "").strip()
-        if not query:
-            return "Web search error: no query provided."
-        max_results = arguments.get("max_results")
-        if isinstance(max_results, str):
-            max_results = int(max_results) if max_results.isdigit() else None
-        elif not isinstance(max_results, int):
-            max_results = None
-        return _call_ollama_web_search(query, max_results)
+    tool = TOOLS.get(function_name)
+    if tool is None:
+        return f"Function {function_name} is not implemented."
+    try:
+        return tool.func(arguments)
+    except Exception as exc:
+        logger.exception("Tool %s failed", function_name)
+        return f"Function {function_name} failed: {exc}"
+
+
+def _execute_tool_calls(tool_calls: list[dict[str, Any]]) -> list[str]:
+    """Run the tool calls of one turn, results keep the order of the calls."""
+    with current_deadline().stage("tools", cap=TOOL_CALLS_TIMEOUT) as budget:
+        deadline = time.monotonic() + budget
+        results: list[str | None] = [None] * len(tool_calls)
+        futures = {}
+        serial = []
+        for idx, call in enumerate(tool_calls):
+            name = call["function"]["name"]
+            arguments = call["function"].get("arguments", "{}")
+            tool = TOOLS.get(name)
+            if tool is not None and tool.parallel_safe and len(tool_calls) > 1:
+                # the workers see the deadline of the message being handled
+                future = _tool_executor.submit(
+                    contextvars.copy_context().run, _execute_tool, name, arguments
+                )
+                futures[future] = idx
+            else:
+                serial.append((idx, name, arguments))
 
-    return f"Function {function_name} is not implemented."
+        for idx, name, arguments in serial:
+            if time.monotonic() > deadline:
+                results[idx] = f"Function {name} was skipped: out of time."
+                continue
+            results[idx] = _execute_tool(name, arguments)
+
+        if futures:
+            done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+            for future in done:
+                results[futures[future]] = future.result()
+            for future in not_done:
+                future.cancel()
+                name = tool_calls[futures[future]]["function"]["name"]
+                logger.warning("Tool call %s timed out", name)
+                results[futures[future]] = f"Function {name} timed out."
+    return results
 
 
 def _append_tool_messages(
@@ -226,10 +350,7 @@ def _append_tool_messages(
             "tool_calls": tool_calls,
         }
     )
-    for call in tool_calls:
-        result = _execute_tool(
-            call["function"]["name"], call["function"].get("arguments", "{}")
-        )
+    for call, result in zip(tool_calls, _execute_tool_calls(tool_calls)):
         conversation.append(
             {
                 "role": "tool",
@@ -244,49 +365,92 @@ def _stream_chatgpt_pro_response(
     reply_id: Message,
     who: str,
     bot: TeleBot,
+    cancel: Generation | None = None,
 ) -> str:
     tools = _available_tools()
     tool_loops_remaining = MAX_TOOL_ITERATIONS if tools else 0
     final_response = ""
+    reply_markup = stop_markup() if cancel is not None else None
+    deadline = current_deadline()
     if tools:
         conversation.insert(0, WEB_SEARCH_SYSTEM_PROMPT)
+    model = chatgpt_pro_router.choose(conversation)
     while True:
         request_payload: dict[str, Any] = {
             "messages": conversation,
-            "model": CHATGPT_PRO_MODEL,
+            "model": model,
             "stream": True,
         }
         if tools:
             request_payload.update(tools=tools, tool_choice="auto")
 
-        stream = client.chat.completions.create(**request_payload)
-        buffer = ""
-        pending_tool_call = False
-        tool_buffer: dict[int, dict[str, Any]] = {}
-        last_update = time.time()
-
-        for chunk in stream:
-            if not chunk.choices:
-                continue
-            delta = chunk.choices[0].delta
-            if delta is None:
-                continue
-            if delta.tool_calls:
-                pending_tool_call = True
-                _accumulate_tool_call_deltas(tool_buffer, delta.tool_calls)
-                continue
-            content_piece = delta.content
-            if isinstance(content_piece, list):
-                content_piece = "".join(
-                    getattr(part, "text", "") for part in content_piece
-                )
-            if not content_piece:
-                continue
-            buffer += content_piece
-            now = time.time()
-            if not pending_tool_call and now - last_update > STREAMING_UPDATE_INTERVAL:
-                last_update = now
-                bot_reply_markdown(reply_id, who, buffer, bot, split_text=False)
+        with (
+            deadline.stage("provider") as timeout,
+            chatgpt_breaker.call() as breaker_first_token,
+        ):
+            request_start = time.monotonic()
+            first_token = None
+            stream = client.chat.completions.create(**request_payload, timeout=timeout)
+            if cancel is not None:
+                # stop drops the http connection so openai stops generating
+                cancel.close_on_stop(stream)
+            buffer = ""
+            pending_tool_call = False
+            tool_buffer: dict[int, dict[str, Any]] = {}
+            last_update = time.time()
+
+            try:
+                for chunk in stream:
+                    if (cancel is not None and cancel.is_set()) or deadline.expired():
+                        stream.close()
+                        break
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta is None:
+                        continue
+                    if delta.tool_calls:
+                        pending_tool_call = True
+                        _accumulate_tool_call_deltas(tool_buffer, delta.tool_calls)
+                        continue
+                    content_piece = delta.content
+                    if isinstance(content_piece, list):
+                        content_piece = "".join(
+                            getattr(part, "text", "") for part in content_piece
+                        )
+                    if not content_piece:
+                        continue
+                    if first_token is None:
+                        first_token = time.monotonic() - request_start
+                        chatgpt_pro_router.record(model, first_token)
+                        breaker_first_token()
+                    buffer += content_piece
+                    now = time.time()
+                    if (
+                        not pending_tool_call
+                        and now - last_update > STREAMING_UPDATE_INTERVAL
+                    ):
+                        last_update = now
+                        bot_reply_markdown(
+                            reply_id,
+                            who,
+                            buffer,
+                            bot,
+                            split_text=False,
+                            reply_markup=reply_markup,
+                        )
+            except Exception:
+                # stop or the deadline closed the stream under us
+                if not ((cancel is not None and cancel.is_set()) or deadline.expired()):
+                    raise
+
+        if cancel is not None and cancel.is_set():
+            final_response = buffer + STOPPED_MARK
+            break
+        if deadline.expired():
+            logger.warning("chatgpt_pro_handler ran out of time")
+            final_response = buffer + TIMEOUT_MARK
+            break
 
         if pending_tool_call and tools:
             if tool_loops_remaining <= 0:
@@ -306,6 +470,7 @@ def _stream_chatgpt_pro_response(
                     bot,
                     split_text=False,
                     disable_web_page_preview=True,
+                    reply_markup=reply_markup,
                 )
             _append_tool_messages(conversation, tool_calls)
             tool_loops_remaining -= 1
@@ -320,6 +485,47 @@ def _stream_chatgpt_pro_response(
     return final_response
 
 
+def chatgpt_stream(messages: list[dict[str, Any]]) -> Iterator[str]:
+    model = chatgpt_router.choose(messages)
+    start = time.monotonic()
+    first_token = None
+    # leaving the `with` block closes the connection when the caller gives up
+    with (
+        current_deadline().stage("provider") as timeout,
+        close_on_cancel(
+            client.chat.completions.create(
+                messages=messages,
+                max_tokens=CHATGPT_MAX_TOKENS,
+                model=model,
+                stream=True,
+                timeout=timeout,
+            )
+        ) as stream,
+    ):
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token is None:
+                    first_token = time.monotonic() - start
+                    chatgpt_router.record(model, first_token)
+                yield chunk.choices[0].delta.content
+
+
+def _hedged_chatgpt_answer(
+    messages: list[dict[str, Any]], fallback: Provider
+) -> tuple[str, str]:
+    """Ask ChatGPT, or the fallback provider if it starts streaming first."""
+    winner = CHATGPT_PROVIDER_NAME
+    content = ""
+    for winner, piece in hedged_stream(
+        get_provider(CHATGPT_PROVIDER_NAME),
+        fallback,
+        messages,
+        budget=settings.openai_hedge_budget,
+    ):
+        content += piece
+    return winner, content
+
+
 def chatgpt_handler(message: Message, bot: TeleBot) -> None:
     """gpt : /gpt <question>"""
     logger.debug(message)
@@ -343,11 +549,12 @@ def chatgpt_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "ChatGPT"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m)
+    m = _with_replied_photo(message, m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -356,10 +563,15 @@ def chatgpt_handler(message: Message, bot: TeleBot) -> None:
 
     chatgpt_reply_text = ""
     try:
-        r = client.chat.completions.create(
-            messages=player_message, max_tokens=1024, model=CHATGPT_MODEL
-        )
-        content = r.choices[0].message.content.encode("utf8").decode()
+        fallback = get_provider(settings.openai_fallback_provider or "")
+        if fallback is None:
+            # through the provider, so its breaker and latency see every /gpt
+            provider = get_provider(CHATGPT_PROVIDER_NAME)
+            content = "".join(provider.stream(player_message[:]))
+        else:
+            winner, content = _hedged_chatgpt_answer(player_message[:], fallback)
+            if winner == fallback.name:
+                who = f"{who} (via {winner})"
         if not content:
             chatgpt_reply_text = f"{who} did not answer."
             player_message.pop()
@@ -405,10 +617,11 @@ def chatgpt_pro_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "ChatGPT Pro"
-    reply_id = bot_reply_first(message, who, bot)
+    reply_id = bot_reply_first(message, who, bot, cancellable=True)
+    m = enrich_text_with_urls(m)
+    m = _with_replied_photo(message, m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 3, every has two ask and answer.
@@ -417,7 +630,10 @@ def chatgpt_pro_handler(message: Message, bot: TeleBot) -> None:
         player_message = player_message[2:]
 
     try:
-        reply_text = _stream_chatgpt_pro_response(player_message[:], reply_id, who, bot)
+        with cancellable_generation(reply_id, message.from_user.id, bot) as cancel:
+            reply_text = _stream_chatgpt_pro_response(
+                player_message[:], reply_id, who, bot, cancel
+            )
         player_message.append(
             {
                 "role": "assistant",
@@ -425,6 +641,10 @@ def chatgpt_pro_handler(message: Message, bot: TeleBot) -> None:
             }
         )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.clear()
+        return
     except Exception:
         logger.exception("ChatGPT handler error")
         # bot.reply_to(message, "answer wrong maybe up to the max token")
@@ -432,58 +652,86 @@ def chatgpt_pro_handler(message: Message, bot: TeleBot) -> None:
         return
 
 
+def _with_replied_photo(message: Message, m: str) -> str:
+    # a follow-up about a photo chatgpt answered carries that answer
+    if (description := known_description(message, "openai")) is None:
+        return m
+    return with_image_description(m, description)
+
+
 def chatgpt_photo_handler(message: Message, bot: TeleBot) -> None:
+    if message.media_group_id is not None:
+        # answer the whole album at once when all of it arrived
+        media_groups.on_complete(
+            message, bot, lambda album: chatgpt_album_answer(message, album, bot)
+        )
+        return
+    chatgpt_album_answer(message, [message], bot)
+
+
+def chatgpt_album_answer(message: Message, album: list[Message], bot: TeleBot) -> None:
     s = message.caption
     prompt = s.strip()
     who = "ChatGPT Vision"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
-    # get the high quaility picture.
-    max_size_photo = max(message.photo, key=lambda p: p.file_size)
-    file_path = bot.get_file(max_size_photo.file_id).file_path
-    downloaded_file = bot.download_file(file_path)
-    with open("chatgpt_temp.jpg", "wb") as temp_file:
-        temp_file.write(downloaded_file)
+    # the smallest pictures the model still sees in full
+    images = download_photos(album, bot, provider="openai")
+    content = [{"type": "text", "text": prompt}]
+    for image in images:
+        content.append(
+            {"type": "image_url", "image_url": {"url": image_to_data_uri(image)}}
+        )
 
+    messages = [{"role": "user", "content": content}]
+    model = chatgpt_pro_router.choose(messages)
     try:
-        r = client.chat.completions.create(
-            max_tokens=2048,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": image_to_data_uri("chatgpt_temp.jpg")},
-                        },
-                    ],
-                }
-            ],
-            model=CHATGPT_PRO_MODEL,
-            stream=True,
-        )
-        s = ""
-        start = time.time()
-        for chunk in r:
-            if chunk.choices[0].delta.content is None:
-                break
-            s += chunk.choices[0].delta.content
-            if time.time() - start > 2.0:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
+        with chatgpt_breaker.call() as first_token:
+            request_start = time.monotonic()
+            r = client.chat.completions.create(
+                max_tokens=2048,
+                messages=messages,
+                model=model,
+                stream=True,
+                timeout=current_deadline().timeout("provider"),
+            )
+            s = ""
+            start = time.time()
+            for chunk in r:
+                if chunk.choices[0].delta.content is None:
+                    break
+                if not s:
+                    chatgpt_pro_router.record(model, time.monotonic() - request_start)
+                    first_token()
+                s += chunk.choices[0].delta.content
+                if time.time() - start > 2.0:
+                    start = time.time()
+                    bot_reply_markdown(reply_id, who, s, bot, split_text=False)
         # maybe not complete
         try:
             bot_reply_markdown(reply_id, who, s, bot)
         except Exception:
             pass
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        return
     except Exception:
         logger.exception("ChatGPT handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
+        return
+    # ready for the follow-ups replying to the photos or to this answer
+    if s:
+        remember_description(album, reply_id, "openai", s)
 
 
 if settings.openai_api_key:
+    register_provider(
+        CHATGPT_PROVIDER_NAME,
+        chatgpt_stream,
+        breaker=chatgpt_breaker,
+        warmup=client.models.list,
+    )
 
     def register(bot: TeleBot) -> None:
         bot.register_message_handler(chatgpt_handler, commands=["gpt"], pass_bot=True)
@@ -1,14 +1,34 @@
 import time
 from os import environ
-from pathlib import Path
+from typing import Any, Iterator
 
-from anthropic import Anthropic, APITimeoutError
+from anthropic import Anthropic, APITimeoutError, DefaultHttpxClient
 from expiringdict import ExpiringDict
 from telebot import TeleBot
 from telebot.types import Message
 from telegramify_markdown import markdownify
 
-from ._utils import bot_reply_first, bot_reply_markdown, enrich_text_with_urls
+from config import KEEPALIVE_LIMITS
+
+from ._providers import (
+    CircuitBreaker,
+    CircuitOpenError,
+    close_on_cancel,
+    register_provider,
+)
+from ._utils import (
+    STOPPED_MARK,
+    TIMEOUT_MARK,
+    bot_reply_first,
+    bot_reply_markdown,
+    cancellable_generation,
+    current_deadline,
+    download_photo,
+    enrich_text_with_urls,
+    image_to_base64,
+    logger,
+    stop_markup,
+)
 
 
 ANTHROPIC_API_KEY = environ.get("ANTHROPIC_API_KEY")
@@ -17,16 +37,44 @@ ANTHROPIC_MODEL = "claude-3-haiku-20240307"
 ANTHROPIC_PRO_MODEL = "claude-3-opus-20240229"
 
 if environ.get("ANTHROPIC_BASE_URL"):
-    client = Anthropic(base_url=ANTHROPIC_BASE_URL, api_key=ANTHROPIC_API_KEY)
+    client = Anthropic(
+        base_url=ANTHROPIC_BASE_URL,
+        api_key=ANTHROPIC_API_KEY,
+        http_client=DefaultHttpxClient(limits=KEEPALIVE_LIMITS),
+    )
 else:
-    client = Anthropic(api_key=ANTHROPIC_API_KEY)
+    client = Anthropic(
+        api_key=ANTHROPIC_API_KEY,
+        http_client=DefaultHttpxClient(limits=KEEPALIVE_LIMITS),
+    )
+
 
+# shared by the handlers and the provider so a dead upstream fails fast everywhere
+claude_breaker = CircuitBreaker("Claude")
 
 # Global history cache
 claude_player_dict = ExpiringDict(max_len=1000, max_age_seconds=300)
 claude_pro_player_dict = ExpiringDict(max_len=1000, max_age_seconds=300)
 
 
+def claude_stream(messages: list[dict[str, Any]]) -> Iterator[str]:
+    with (
+        current_deadline().stage("provider") as timeout,
+        close_on_cancel(
+            client.messages.create(
+                max_tokens=4096,
+                messages=messages,
+                model=ANTHROPIC_MODEL,
+                stream=True,
+                timeout=timeout,
+            )
+        ) as r,
+    ):
+        for e in r:
+            if e.type == "content_block_delta":
+                yield e.delta.text
+
+
 def claude_handler(message: Message, bot: TeleBot) -> None:
     """claude : /claude <question>"""
     m = message.text.strip()
@@ -49,11 +97,11 @@ def claude_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "Claude"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -66,9 +114,13 @@ def claude_handler(message: Message, bot: TeleBot) -> None:
             if player_message[-1]["role"] == player_message[-2]["role"]:
                 # tricky
                 player_message.pop()
-        r = client.messages.create(
-            max_tokens=4096, messages=player_message, model=ANTHROPIC_MODEL
-        )
+        with claude_breaker.call():
+            r = client.messages.create(
+                max_tokens=4096,
+                messages=player_message,
+                model=ANTHROPIC_MODEL,
+                timeout=current_deadline().timeout("provider"),
+            )
         if not r.content:
             claude_reply_text = f"{who} did not answer."
             player_message.pop()
@@ -81,6 +133,10 @@ def claude_handler(message: Message, bot: TeleBot) -> None:
                 }
             )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.pop()
+        return
     except APITimeoutError:
         bot_reply_markdown(reply_id, who, "answer timeout", bot)
         # pop my user
@@ -111,11 +167,11 @@ def claude_pro_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "Claude Pro"
     # show something, make it more responsible
-    reply_id = bot_reply_first(message, who, bot)
+    reply_id = bot_reply_first(message, who, bot, cancellable=True)
+    m = enrich_text_with_urls(m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 2, every has two ask and answer.
@@ -128,20 +184,50 @@ def claude_pro_handler(message: Message, bot: TeleBot) -> None:
             if player_message[-1]["role"] == player_message[-2]["role"]:
                 # tricky
                 player_message.pop()
-        r = client.messages.create(
-            max_tokens=2048,
-            messages=player_message,
-            model=ANTHROPIC_PRO_MODEL,
-            stream=True,
-        )
-        s = ""
-        start = time.time()
-        for e in r:
-            if e.type == "content_block_delta":
-                s += e.delta.text
-            if time.time() - start > 1.7:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
+        deadline = current_deadline()
+        with (
+            claude_breaker.call() as first_token,
+            cancellable_generation(reply_id, message.from_user.id, bot) as cancel,
+        ):
+            # stop drops the http connection so claude stops generating
+            r = cancel.close_on_stop(
+                client.messages.create(
+                    max_tokens=2048,
+                    messages=player_message,
+                    model=ANTHROPIC_PRO_MODEL,
+                    stream=True,
+                    timeout=deadline.timeout("provider"),
+                )
+            )
+            s = ""
+            start = time.time()
+            finished = False
+            try:
+                for e in r:
+                    if cancel.is_set() or deadline.expired():
+                        r.close()
+                        break
+                    if e.type == "content_block_delta":
+                        first_token()
+                        s += e.delta.text
+                    if time.time() - start > 1.7:
+                        start = time.time()
+                        bot_reply_markdown(
+                            reply_id,
+                            who,
+                            s,
+                            bot,
+                            split_text=False,
+                            reply_markup=stop_markup(),
+                        )
+                else:
+                    finished = True
+            except Exception:
+                # stop or the deadline closed the stream under us
+                if not (cancel.is_set() or deadline.expired()):
+                    raise
+            if not finished:
+                s += STOPPED_MARK if cancel.is_set() else TIMEOUT_MARK
 
         if not bot_reply_markdown(reply_id, who, s, bot):
             # maybe not complete
@@ -156,6 +242,10 @@ def claude_pro_handler(message: Message, bot: TeleBot) -> None:
             }
         )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.clear()
+        return
     except APITimeoutError:
         bot.reply_to(message, "answer wrong maybe up to the max token")
         # pop my user
@@ -169,16 +259,10 @@ def claude_photo_handler(message: Message, bot: TeleBot) -> None:
     who = "Claude Vision"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
-    # get the high quaility picture.
-    max_size_photo = max(message.photo, key=lambda p: p.file_size)
-    file_path = bot.get_file(max_size_photo.file_id).file_path
-    downloaded_file = bot.download_file(file_path)
-    with open("claude_temp.jpg", "wb") as temp_file:
-        temp_file.write(downloaded_file)
-
-    f = Path("claude_temp.jpg")
+    # the smallest picture the model still sees in full
+    image = image_to_base64(download_photo(message, bot, provider="claude"))
     try:
-        with f:
+        with claude_breaker.call() as first_token:
             r = client.messages.create(
                 max_tokens=1024,
                 messages=[
@@ -194,7 +278,7 @@ def claude_photo_handler(message: Message, bot: TeleBot) -> None:
                                 "source": {
                                     "type": "base64",
                                     "media_type": "image/jpeg",
-                                    "data": f,
+                                    "data": image,
                                 },
                             },
                         ],
@@ -202,23 +286,33 @@ def claude_photo_handler(message: Message, bot: TeleBot) -> None:
                 ],
                 model=ANTHROPIC_MODEL,
                 stream=True,
+                timeout=current_deadline().timeout("provider"),
             )
             s = ""
             start = time.time()
             for e in r:
                 if e.type == "content_block_delta":
+                    first_token()
                     s += e.delta.text
                 if time.time() - start > 1.7:
                     start = time.time()
                     bot_reply_markdown(reply_id, who, s, bot, split_text=False)
 
-            bot_reply_markdown(reply_id, who, s, bot)
-    except Exception as e:
-        print(e)
+        bot_reply_markdown(reply_id, who, s, bot)
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+    except Exception:
+        logger.exception("Claude photo handler error")
         bot_reply_markdown(reply_id, who, "answer wrong", bot)
 
 
 if ANTHROPIC_API_KEY:
+    register_provider(
+        "Claude",
+        claude_stream,
+        breaker=claude_breaker,
+        warmup=lambda: client.models.list(limit=1),
+    )
 
     def register(bot: TeleBot) -> None:
         bot.register_message_handler(claude_handler, commands=["claude"], pass_bot=True)
@@ -2,23 +2,36 @@ import datetime
 import re
 import time
 from os import environ
+from typing import Any, Iterator
 
 import cohere
+import httpx
 from expiringdict import ExpiringDict
 from telebot import TeleBot
 from telebot.types import Message
 from telegramify_markdown import markdownify
 
-from config import settings
+from config import KEEPALIVE_LIMITS, settings
 
-from ._utils import bot_reply_first, bot_reply_markdown, enrich_text_with_urls
+from ._providers import CircuitBreaker, CircuitOpenError, register_provider
+from ._utils import (
+    bot_reply_first,
+    bot_reply_markdown,
+    current_deadline,
+    enrich_text_with_urls,
+)
 
 
 COHERE_API_KEY = environ.get("COHERE_API_KEY")
 COHERE_MODEL = "command-r-plus"  # command-r may cause Chinese garbled code, and non stream mode also may cause garbled code.
 if COHERE_API_KEY:
-    co = cohere.Client(api_key=COHERE_API_KEY)
+    co = cohere.Client(
+        api_key=COHERE_API_KEY,
+        httpx_client=httpx.Client(limits=KEEPALIVE_LIMITS, follow_redirects=True),
+    )
 
+# shared by the handler and the provider so a dead upstream fails fast everywhere
+cohere_breaker = CircuitBreaker("Command R Plus")
 
 # Global history cache
 cohere_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
@@ -43,6 +56,29 @@ def clean_text(text):
         return text
 
 
+def cohere_stream(messages: list[dict[str, Any]]) -> Iterator[str]:
+    chat_history = [
+        {
+            "role": "Chatbot" if m["role"] == "assistant" else "User",
+            "message": m["content"],
+        }
+        for m in messages[:-1]
+    ]
+    with current_deadline().stage("provider") as timeout:
+        stream = co.chat_stream(
+            model=COHERE_MODEL,
+            message=messages[-1]["content"],
+            chat_history=chat_history,
+            prompt_truncation="AUTO",
+            request_options={"timeout_in_seconds": int(timeout)},
+        )
+        for event in stream:
+            if event.event_type == "text-generation":
+                yield event.text
+            elif event.event_type == "stream-end":
+                break
+
+
 def cohere_handler(message: Message, bot: TeleBot) -> None:
     """cohere : /cohere_pro <question> Come with a telegraph link"""
     m = message.text.strip()
@@ -65,10 +101,9 @@ def cohere_handler(message: Message, bot: TeleBot) -> None:
         m = m[4:].strip()
         player_message.clear()
 
-    m = enrich_text_with_urls(m)
-
     who = "Command R Plus"
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m)
 
     player_message.append({"role": "User", "message": m})
     # keep the last 5, every has two ask and answer.
@@ -84,61 +119,67 @@ def cohere_handler(message: Message, bot: TeleBot) -> None:
             f"UTC-7 (e.g. Los Angeles) is {current_time.astimezone(datetime.timezone(datetime.timedelta(hours=-7))).strftime('%Y-%m-%d %H:%M:%S')}, "
             f"and UTC+8 (e.g. Beijing) is {current_time.astimezone(datetime.timezone(datetime.timedelta(hours=8))).strftime('%Y-%m-%d %H:%M:%S')}."
         )
-        stream = co.chat_stream(
-            model=COHERE_MODEL,
-            message=m,
-            temperature=0.8,
-            chat_history=player_message,
-            prompt_truncation="AUTO",
-            connectors=[{"id": "web-search"}],
-            citation_quality="accurate",
-            preamble=preamble,
-        )
+        with cohere_breaker.call() as first_token:
+            stream = co.chat_stream(
+                model=COHERE_MODEL,
+                message=m,
+                temperature=0.8,
+                chat_history=player_message,
+                prompt_truncation="AUTO",
+                connectors=[{"id": "web-search"}],
+                citation_quality="accurate",
+                preamble=preamble,
+                request_options={
+                    "timeout_in_seconds": int(current_deadline().timeout("provider"))
+                },
+            )
 
-        s = ""
-        source = ""
-        start = time.time()
-        for event in stream:
-            if event.event_type == "stream-start":
-                bot_reply_markdown(reply_id, who, "Thinking...", bot)
-            elif event.event_type == "search-queries-generation":
-                bot_reply_markdown(reply_id, who, "Searching online...", bot)
-            elif event.event_type == "search-results":
-                bot_reply_markdown(reply_id, who, "Reading...", bot)
-                for doc in event.documents:
-                    source += f"\n{doc['title']}\n{doc['url']}\n"
-            elif event.event_type == "text-generation":
-                s += event.text.encode("utf-8").decode("utf-8")
-                if time.time() - start > 1.4:
-                    start = time.time()
-                    s = clean_text(s)
-                    if len(s) > 3900:
-                        bot_reply_markdown(
-                            reply_id,
-                            who,
-                            f"\nStill thinking{len(s)}...\n",
-                            bot,
-                            split_text=True,
-                        )
-                    else:
-                        bot_reply_markdown(
-                            reply_id,
-                            who,
-                            f"\nStill thinking{len(s)}...\n{s}",
-                            bot,
-                            split_text=True,
-                        )
-            elif event.event_type == "stream-end":
-                break
+            s = ""
+            source = ""
+            start = time.time()
+            for event in stream:
+                if event.event_type == "stream-start":
+                    bot_reply_markdown(reply_id, who, "Thinking...", bot)
+                elif event.event_type == "search-queries-generation":
+                    bot_reply_markdown(reply_id, who, "Searching online...", bot)
+                elif event.event_type == "search-results":
+                    bot_reply_markdown(reply_id, who, "Reading...", bot)
+                    for doc in event.documents:
+                        source += f"\n{doc['title']}\n{doc['url']}\n"
+                elif event.event_type == "text-generation":
+                    first_token()
+                    s += event.text.encode("utf-8").decode("utf-8")
+                    if time.time() - start > 1.4:
+                        start = time.time()
+                        s = clean_text(s)
+                        if len(s) > 3900:
+                            bot_reply_markdown(
+                                reply_id,
+                                who,
+                                f"\nStill thinking{len(s)}...\n",
+                                bot,
+                                split_text=True,
+                            )
+                        else:
+                            bot_reply_markdown(
+                                reply_id,
+                                who,
+                                f"\nStill thinking{len(s)}...\n{s}",
+                                bot,
+                                split_text=True,
+                            )
+                elif event.event_type == "stream-end":
+                    break
         content = (
             s
             + "\n\n---\n"
             + source
             + f"\nLast Update{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} at UTC+8\n"
         )
-        ph_s = settings.telegraph_client.create_page_md(
-            title="Cohere", markdown_text=content
-        )  # or edit_page with get_page so not producing massive pages
+        with current_deadline().stage("telegraph"):
+            ph_s = settings.telegraph_client.create_page_md(
+                title="Cohere", markdown_text=content
+            )  # or edit_page with get_page so not producing massive pages
         s += f"\n\n[View]({ph_s})"
 
         try:
@@ -155,6 +196,10 @@ def cohere_handler(message: Message, bot: TeleBot) -> None:
             }
         )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.clear()
+        return
     except Exception as e:
         print(e)
         bot.reply_to(message, "answer wrong maybe up to the max token")
@@ -163,6 +208,12 @@ def cohere_handler(message: Message, bot: TeleBot) -> None:
 
 
 if COHERE_API_KEY:
+    register_provider(
+        "Command R Plus",
+        cohere_stream,
+        breaker=cohere_breaker,
+        warmup=lambda: co.models.list(page_size=1),
+    )
 
     def register(bot: TeleBot) -> None:
         bot.register_message_handler(cohere_handler, commands=["cohere"], pass_bot=True)
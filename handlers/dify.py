@@ -1,14 +1,95 @@
 import json
 import re
 import time
+from typing import Any, Iterator
 
 # TODO: update requirements.txt and setup tools
 # pip install dify-client
+import requests
 from dify_client import ChatClient
+from expiringdict import ExpiringDict
 from telebot import TeleBot
 from telebot.types import Message
 
-from ._utils import bot_reply_first, bot_reply_markdown, enrich_text_with_urls
+from ._clients import client_pool, pooled_session
+from ._utils import (
+    STOPPED_MARK,
+    TIMEOUT_MARK,
+    bot_reply_first,
+    bot_reply_markdown,
+    cancellable_generation,
+    current_deadline,
+    enrich_text_with_urls,
+    stop_markup,
+)
+
+# (user id, app key) -> dify conversation id, so dify keeps the context itself
+dify_conversation_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
+# events carrying a piece of the answer, agent apps send `agent_message`
+DIFY_ANSWER_EVENTS = ("message", "agent_message")
+
+
+class DifyStreamError(Exception):
+    """Dify reported an error in the middle of a streaming answer."""
+
+
+class PooledChatClient(ChatClient):
+    """A dify client sharing one session, so the connections are reused."""
+
+    def __init__(self, api_key: str) -> None:
+        super().__init__(api_key)
+        self.session = pooled_session("dify", self.base_url)
+
+    def _send_request(self, method, endpoint, json=None, params=None, stream=False):
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+        return self.session.request(
+            method,
+            f"{self.base_url}{endpoint}",
+            json=json,
+            params=params,
+            headers=headers,
+            stream=stream,
+            timeout=current_deadline().timeout("provider"),
+        )
+
+
+def get_dify_client(api_key: str) -> PooledChatClient:
+    return client_pool.get(("dify", api_key), lambda: PooledChatClient(api_key))
+
+
+def iter_dify_events(response: requests.Response) -> Iterator[dict[str, Any]]:
+    """Parse the server-sent events of a streaming answer as they arrive."""
+    data: list[str] = []
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("data:"):
+            data.append(line[5:].removeprefix(" "))
+        elif not line and data:
+            # a blank line ends the event, `event: ping` and the like carry no data
+            yield json.loads("\n".join(data))
+            data.clear()
+    if data:
+        yield json.loads("\n".join(data))
+
+
+def send_dify_message(
+    client: PooledChatClient, query: str, user: str, conversation_id: str | None
+) -> requests.Response:
+    r = client.create_chat_message(
+        inputs={},
+        query=query,
+        user=user,
+        response_mode="streaming",
+        conversation_id=conversation_id,
+    )
+    if r.status_code == 404 and conversation_id:
+        # the conversation is gone on dify, start a new one
+        r.close()
+        return send_dify_message(client, query, user, None)
+    r.raise_for_status()
+    return r
 
 
 def dify_handler(message: Message, bot: TeleBot) -> None:
@@ -27,37 +108,64 @@ def dify_handler(message: Message, bot: TeleBot) -> None:
     else:
         bot.reply_to(message, "Please provide a valid API key.")
         return
-    client = ChatClient(api_key=Dify_API_KEY)
-    # Init client with API key
-
-    m = enrich_text_with_urls(m)
+    client = get_dify_client(Dify_API_KEY)
+    conversation_key = (message.from_user.id, Dify_API_KEY)
+    if m.strip() == "clear":
+        bot.reply_to(message, "just clear you dify conversation")
+        dify_conversation_dict.pop(conversation_key, None)
+        return
+    if m[:4].lower() == "new ":
+        m = m[4:].strip()
+        dify_conversation_dict.pop(conversation_key, None)
+    conversation_id = dify_conversation_dict.get(conversation_key)
 
     who = "dify"
     # show something, make it more responsible
-    reply_id = bot_reply_first(message, who, bot)
+    reply_id = bot_reply_first(message, who, bot, cancellable=True)
+    m = enrich_text_with_urls(m)
 
     try:
-        r = client.create_chat_message(
-            inputs={},
-            query=m,
-            user=str(message.from_user.id),
-            response_mode="streaming",
-        )
-        s = ""
-        start = time.time()
-        overall_start = time.time()
-        for chunk in r.iter_lines(decode_unicode=True):
-            chunk = chunk.split("data:", 1)[-1]
-            if chunk.strip():
-                chunk = json.loads(chunk.strip())
-                answer_chunk = chunk.get("answer", "")
-                s += answer_chunk
-            if time.time() - start > 1.5:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
-            if time.time() - overall_start > 120:  # Timeout
-                s += "\n\nTimeout"
-                break
+        deadline = current_deadline()
+        with cancellable_generation(reply_id, message.from_user.id, bot) as cancel:
+            # closing the response drops the connection to dify
+            r = cancel.close_on_stop(
+                send_dify_message(client, m, str(message.from_user.id), conversation_id)
+            )
+            s = ""
+            start = time.time()
+            finished = False
+            try:
+                for event in iter_dify_events(r):
+                    if cancel.is_set() or deadline.expired():
+                        r.close()
+                        break
+                    new_conversation_id = event.get("conversation_id")
+                    if new_conversation_id and new_conversation_id != conversation_id:
+                        conversation_id = new_conversation_id
+                        dify_conversation_dict[conversation_key] = conversation_id
+                    if event.get("event") in DIFY_ANSWER_EVENTS:
+                        s += event.get("answer", "")
+                    elif event.get("event") == "error":
+                        r.close()
+                        raise DifyStreamError(event.get("message", "unknown error"))
+                    if time.time() - start > 1.5:
+                        start = time.time()
+                        bot_reply_markdown(
+                            reply_id,
+                            who,
+                            s,
+                            bot,
+                            split_text=False,
+                            reply_markup=stop_markup(),
+                        )
+                else:
+                    finished = True
+            except Exception:
+                # stop or the deadline closed the stream under us
+                if not (cancel.is_set() or deadline.expired()):
+                    raise
+            if not finished:
+                s += STOPPED_MARK if cancel.is_set() else TIMEOUT_MARK
         # maybe not complete
         try:
             bot_reply_markdown(reply_id, who, s, bot)
@@ -1,11 +1,14 @@
 import random
 import re
+from io import BytesIO
 from os import listdir
 
 from PIL import Image, ImageDraw, ImageFont
 from telebot import TeleBot
 from telebot.types import Message
 
+from ._utils import download_photo, upload_file
+
 
 def split_lines(text, max_length=30):
     def split_line(line):
@@ -117,8 +120,10 @@ class ImageRenderer:
 
         return canvas
 
-    def save_image(self, image, filename="fake.jpg"):
-        image.save(filename)
+    def save_image(self, image) -> bytes:
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG")
+        return buffer.getvalue()
 
     def get_random_quote(self):
         return random.choice(self.quotes)
@@ -140,14 +145,12 @@ def fake_handler(message: Message, bot: TeleBot) -> None:
     else:
         text = renderer.get_random_quote()
     rendered_image = renderer.render_image(image_path, text)
-    renderer.save_image(rendered_image)
-    with open("fake.jpg", "rb") as f:
-        bot.send_photo(
-            message.chat.id,
-            f,
-            reply_to_message_id=message.message_id,
-            caption="Generated image",
-        )
+    bot.send_photo(
+        message.chat.id,
+        upload_file(renderer.save_image(rendered_image), "fake.jpg"),
+        reply_to_message_id=message.message_id,
+        caption="Generated image",
+    )
 
 
 def fake_photo_handler(message: Message, bot: TeleBot) -> None:
@@ -158,22 +161,15 @@ def fake_photo_handler(message: Message, bot: TeleBot) -> None:
     prompt = s.strip()
     bot.reply_to(message, "Generating LiuNeng's fake image")
     # get the high quaility picture.
-    max_size_photo = max(message.photo, key=lambda p: p.file_size)
-    file_path = bot.get_file(max_size_photo.file_id).file_path
-    downloaded_file = bot.download_file(file_path)
-    downloaded_file = bot.download_file(file_path)
-    with open("fake.jpg", "wb") as temp_file:
-        temp_file.write(downloaded_file)
+    downloaded_file = download_photo(message, bot)
     renderer = ImageRenderer()
-    rendered_image = renderer.render_image("fake.jpg", prompt)
-    renderer.save_image(rendered_image)
-    with open("fake.jpg", "rb") as f:
-        bot.send_photo(
-            message.chat.id,
-            f,
-            reply_to_message_id=message.message_id,
-            caption="Generated image",
-        )
+    rendered_image = renderer.render_image(BytesIO(downloaded_file), prompt)
+    bot.send_photo(
+        message.chat.id,
+        upload_file(renderer.save_image(rendered_image), "fake.jpg"),
+        reply_to_message_id=message.message_id,
+        caption="Generated image",
+    )
 
 
 def register(bot: TeleBot) -> None:
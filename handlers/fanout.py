@@ -0,0 +1,109 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from telebot import TeleBot
+from telebot.types import Message
+
+from ._providers import Provider, available_providers
+from ._utils import bot_reply_first, bot_reply_markdown, enrich_text_with_urls, logger
+
+STREAMING_UPDATE_INTERVAL = 1.5
+# while streaming every section only shows its tail so the shared message stays
+# below the telegram limit, the final reply is split into several messages instead
+PREVIEW_LENGTH = 3000
+# every provider gets the pages, so they have to fit the smallest of them
+FANOUT_URL_TOKENS = 2000
+
+
+class FanoutAnswer:
+    """Collects the streamed answer of one provider."""
+
+    def __init__(self, provider: Provider) -> None:
+        self.provider = provider
+        self.text = ""
+        self.first_token: float | None = None
+        self.error: str | None = None
+        self.done = False
+
+    def render(self, limit: int | None = None) -> str:
+        text = self.text
+        if limit is not None and len(text) > limit:
+            text = "…" + text[-limit:]
+        if self.error:
+            text = f"{text}\n\n_error: {self.error}_".strip()
+        elif not text:
+            text = "_thinking..._" if not self.done else "_no answer_"
+        return f"**{self.provider.name}**\n{text}"
+
+    def timing(self) -> str:
+        if self.first_token is None:
+            return f"{self.provider.name}: failed" if self.error else "-"
+        return f"{self.provider.name}: {self.first_token:.2f}s"
+
+
+def _stream_answer(answer: FanoutAnswer, messages: list, lock: threading.Lock) -> None:
+    start = time.time()
+    try:
+        for piece in answer.provider.stream(messages):
+            with lock:
+                if answer.first_token is None:
+                    answer.first_token = time.time() - start
+                answer.text += piece
+    except Exception as e:
+        logger.exception("Fanout %s error", answer.provider.name)
+        answer.error = str(e) or e.__class__.__name__
+    finally:
+        answer.done = True
+
+
+def _render_answers(answers: list[FanoutAnswer], final: bool = False) -> str:
+    limit = None if final else PREVIEW_LENGTH // len(answers)
+    text = "\n\n".join(answer.render(limit) for answer in answers)
+    if final:
+        timings = " · ".join(answer.timing() for answer in answers)
+        text += f"\n\n---\nfirst token: {timings}"
+    return text
+
+
+def fanout_handler(message: Message, bot: TeleBot) -> None:
+    """all : /all <question> ask every configured LLM at once"""
+    m = message.text.strip()
+    providers = available_providers()
+    if not providers:
+        bot.reply_to(message, "No LLM is configured.")
+        return
+
+    who = "All"
+    # show something, make it more responsible
+    reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m, token_budget=FANOUT_URL_TOKENS)
+
+    messages = [{"role": "user", "content": m}]
+    answers = [FanoutAnswer(p) for p in providers]
+    lock = threading.Lock()
+    with ThreadPoolExecutor(
+        max_workers=len(answers), thread_name_prefix="fanout"
+    ) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run, _stream_answer, answer, messages, lock
+            )
+            for answer in answers
+        ]
+        # only this thread edits the message so all providers share one edit stream
+        while True:
+            _, not_done = wait(futures, timeout=STREAMING_UPDATE_INTERVAL)
+            if not not_done:
+                break
+            with lock:
+                text = _render_answers(answers)
+            bot_reply_markdown(reply_id, who, text, bot, split_text=False)
+
+    bot_reply_markdown(reply_id, who, _render_answers(answers, final=True), bot)
+
+
+def register(bot: TeleBot) -> None:
+    bot.register_message_handler(fanout_handler, commands=["all"], pass_bot=True)
+    bot.register_message_handler(fanout_handler, regexp="^all:", pass_bot=True)
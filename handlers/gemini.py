@@ -1,6 +1,12 @@
+import hashlib
 import re
+import threading
 import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from os import environ
+from tempfile import NamedTemporaryFile
+from typing import Any, Iterator
 
 import google.generativeai as genai
 from expiringdict import ExpiringDict
@@ -9,7 +15,22 @@ from google.generativeai.types.generation_types import StopCandidateException
 from telebot import TeleBot
 from telebot.types import Message
 
-from ._utils import bot_reply_first, bot_reply_markdown, enrich_text_with_urls, logger
+from config import settings
+
+from ._clients import client_pool
+from ._providers import CircuitBreaker, CircuitOpenError, register_provider
+from ._sessions import SessionStore
+from ._utils import (
+    SingleFlight,
+    bot_reply_first,
+    bot_reply_markdown,
+    current_deadline,
+    download_photo,
+    enrich_text_with_urls,
+    logger,
+    stream_telegram_file,
+)
+from ._vision import replied_photo
 
 
 GOOGLE_GEMINI_KEY = environ.get("GEMIMI_PRO_KEY")
@@ -29,49 +50,204 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
 ]
 
-# Global history cache
-gemini_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
-gemini_pro_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
+# conversations are kept as json turns and a session is rebuilt per message
+gemini_sessions = SessionStore(settings.gemini_sessions_db)
+# keep the last 5, every has two ask and answer.
+MAX_GEMINI_TURNS = 10
+# the long context takes whole linked pages
+GEMINI_URL_TOKENS = 16000
 gemini_file_player_dict = ExpiringDict(max_len=100, max_age_seconds=600)
+# gemini deletes uploads after 48 hours, they are reused until an hour before
+GEMINI_FILE_AGE = 48 * 60 * 60
+GEMINI_FILE_MARGIN = timedelta(hours=1)
+MAX_GEMINI_FILES = 100
+
+# shared by the handlers and the provider so a dead upstream fails fast everywhere
+gemini_breaker = CircuitBreaker("Gemini")
+
+
+def get_gemini_model(model_name: str, configured: bool = True) -> genai.GenerativeModel:
+    """Models keep no conversation, so one of each is shared by everybody."""
 
+    def make_model() -> genai.GenerativeModel:
+        if not configured:
+            return genai.GenerativeModel(model_name)
+        return genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+        )
+
+    key = ("gemini", GOOGLE_GEMINI_KEY, model_name, configured)
+    return client_pool.get(key, make_model)
 
-def make_new_gemini_convo(is_pro=False) -> ChatSession:
+
+def make_new_gemini_convo(
+    is_pro=False, history: list[dict[str, Any]] | None = None
+) -> ChatSession:
     model_name = "gemini-1.5-flash-002"
     if is_pro:
         model_name = "gemini-2.0-flash-exp"
 
-    model = genai.GenerativeModel(
-        model_name=model_name,
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-    )
-    convo = model.start_chat()
+    model = get_gemini_model(model_name)
+    convo = model.start_chat(history=history)
     return convo
 
 
+def _session_kind(is_pro: bool) -> str:
+    return "gemini_pro" if is_pro else "gemini"
+
+
 def remove_gemini_player(player_id: str, is_pro: bool) -> None:
-    if is_pro:
-        if player_id in gemini_pro_player_dict:
-            del gemini_pro_player_dict[player_id]
-        if player_id in gemini_file_player_dict:
-            del gemini_file_player_dict[player_id]
-    else:
-        if player_id in gemini_player_dict:
-            del gemini_player_dict[player_id]
+    gemini_sessions.clear(_session_kind(is_pro), player_id)
+    if is_pro and player_id in gemini_file_player_dict:
+        del gemini_file_player_dict[player_id]
 
 
 def get_gemini_player(player_id: str, is_pro: bool) -> ChatSession:
-    player = None
-    if is_pro:
-        if player_id not in gemini_pro_player_dict:
-            gemini_pro_player_dict[player_id] = make_new_gemini_convo(is_pro)
-        player = gemini_pro_player_dict[player_id]
-    else:
-        if player_id not in gemini_player_dict:
-            gemini_player_dict[player_id] = make_new_gemini_convo()
-        player = gemini_player_dict[player_id]
+    """A session with the stored conversation, `save_gemini_player` keeps it."""
+    turns = gemini_sessions.load(_session_kind(is_pro), player_id)
+    return make_new_gemini_convo(is_pro, history=turns)
+
+
+def save_gemini_player(player_id: str, is_pro: bool, player: ChatSession) -> None:
+    turns = [_content_to_turn(content) for content in player.history]
+    gemini_sessions.save(_session_kind(is_pro), player_id, turns[-MAX_GEMINI_TURNS:])
+
+
+def _content_to_turn(content: Any) -> dict[str, Any]:
+    # text and references to uploaded files only, inline data would make the
+    # sessions as large as the live ones
+    parts: list[dict[str, Any]] = []
+    for part in content.parts:
+        if part.text:
+            parts.append({"text": part.text})
+        elif part.file_data.file_uri:
+            parts.append(
+                {
+                    "file_data": {
+                        "mime_type": part.file_data.mime_type,
+                        "file_uri": part.file_data.file_uri,
+                    }
+                }
+            )
+    return {"role": content.role, "parts": parts or [{"text": ""}]}
+
+
+class GeminiFileManager:
+    """
+    Files uploaded to gemini by the sha256 of their content, so the same file
+    is uploaded once while gemini still keeps it. genai only uploads from a
+    path, the temporary file is deleted right after. When more than
+    `max_files` are kept the least recently used ones are forgotten here, but
+    not deleted on gemini, stored sessions and audio follow-ups may still
+    refer to them, gemini deletes them itself when they expire.
+    """
+
+    def __init__(self, max_files: int = MAX_GEMINI_FILES) -> None:
+        self.max_files = max_files
+        # sha256 -> uploaded file, least recently used first
+        self._files: OrderedDict[str, Any] = OrderedDict()
+        # telegram file_unique_id -> sha256, to skip the download as well
+        self._digests = ExpiringDict(max_len=1000, max_age_seconds=GEMINI_FILE_AGE)
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def get(self, digest: str) -> Any | None:
+        with self._lock:
+            handle = self._files.get(digest)
+            if handle is None:
+                return None
+            if _gemini_file_expired(handle):
+                del self._files[digest]
+                return None
+            self._files.move_to_end(digest)
+            return handle
+
+    def upload_telegram_file(
+        self, bot: TeleBot, file_id: str, file_unique_id: str, suffix: str
+    ) -> Any:
+        """Upload a telegram file, streamed to disk, unless gemini already has it."""
+        digest = self._digests.get(file_unique_id)
+        if digest is not None and (handle := self.get(digest)) is not None:
+            return handle
+        return self._flight.do(
+            file_unique_id,
+            self._upload_telegram_file,
+            bot,
+            file_id,
+            file_unique_id,
+            suffix,
+        )
 
-    return player
+    def upload_bytes(self, data: bytes, suffix: str) -> Any:
+        digest = hashlib.sha256(data).hexdigest()
+        if (handle := self.get(digest)) is not None:
+            return handle
+
+        def upload() -> Any:
+            with NamedTemporaryFile(suffix=suffix) as temp_file:
+                temp_file.write(data)
+                temp_file.flush()
+                return self._upload(digest, temp_file.name)
+
+        return self._flight.do(digest, upload)
+
+    def _upload_telegram_file(
+        self, bot: TeleBot, file_id: str, file_unique_id: str, suffix: str
+    ) -> Any:
+        with NamedTemporaryFile(suffix=suffix) as temp_file:
+            digest = stream_telegram_file(bot, file_id, temp_file)
+            temp_file.flush()
+            handle = self.get(digest)
+            if handle is None:
+                handle = self._upload(digest, temp_file.name)
+        self._digests[file_unique_id] = digest
+        return handle
+
+    def _upload(self, digest: str, path: str) -> Any:
+        handle = genai.upload_file(path=path)
+        with self._lock:
+            self._files[digest] = handle
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+        return handle
+
+
+def _gemini_file_expired(handle: Any) -> bool:
+    expiration_time = getattr(handle, "expiration_time", None)
+    if expiration_time is None:
+        return False
+    return expiration_time - GEMINI_FILE_MARGIN < datetime.now(timezone.utc)
+
+
+gemini_files = GeminiFileManager()
+
+
+def upload_photo_to_gemini(message: Message, bot: TeleBot) -> Any:
+    """The photo in `message` uploaded to gemini, once for all the follow-ups."""
+    image = download_photo(message, bot, provider="gemini")
+    return gemini_files.upload_bytes(image, ".jpg")
+
+
+def gemini_stream(messages: list[dict[str, Any]]) -> Iterator[str]:
+    model = get_gemini_model("gemini-1.5-flash-002")
+    # gemini calls the assistant `model` and wants the text inside `parts`
+    contents = [
+        {
+            "role": "model" if m["role"] == "assistant" else "user",
+            "parts": [m["content"]],
+        }
+        for m in messages
+    ]
+    with current_deadline().stage("provider") as timeout:
+        for e in model.generate_content(
+            contents=contents, stream=True, request_options={"timeout": timeout}
+        ):
+            yield e.text
 
 
 def gemini_handler(message: Message, bot: TeleBot) -> None:
@@ -87,26 +263,37 @@ def gemini_handler(message: Message, bot: TeleBot) -> None:
         m = m[4:].strip()
         remove_gemini_player(player_id, is_pro)
 
-    # restart will lose all TODO
     player = get_gemini_player(player_id, is_pro)
-    m = enrich_text_with_urls(m)
 
     who = "Gemini"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m, token_budget=GEMINI_URL_TOKENS)
+    if (photo := replied_photo(message)) is not None:
+        m = [m, upload_photo_to_gemini(photo, bot)]
 
-    # keep the last 5, every has two ask and answer.
-    if len(player.history) > 10:
-        player.history = player.history[2:]
-
+    blocked = None
     try:
-        player.send_message(m)
+        with gemini_breaker.call():
+            try:
+                player.send_message(
+                    m,
+                    request_options={"timeout": current_deadline().timeout("provider")},
+                )
+            except StopCandidateException as e:
+                # blocked by gemini itself, the upstream is fine
+                blocked = e
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        return
+    if blocked is None:
+        save_gemini_player(player_id, is_pro, player)
         gemini_reply_text = player.last.text.strip()
         # Gemini is often using ':' in **Title** which not work in Telegram Markdown
         gemini_reply_text = gemini_reply_text.replace(":**", "\\:**")
         gemini_reply_text = gemini_reply_text.replace("：**", "**\\: ")
-    except StopCandidateException as e:
-        match = re.search(r'content\s*{\s*parts\s*{\s*text:\s*"([^"]+)"', str(e))
+    else:
+        match = re.search(r'content\s*{\s*parts\s*{\s*text:\s*"([^"]+)"', str(blocked))
         if match:
             gemini_reply_text = match.group(1)
             gemini_reply_text = re.sub(r"\\n", "\n", gemini_reply_text)
@@ -132,42 +319,46 @@ def gemini_pro_handler(message: Message, bot: TeleBot) -> None:
         m = m[4:].strip()
         remove_gemini_player(player_id, is_pro)
 
-    # restart will lose all TODO
     player = get_gemini_player(player_id, is_pro)
-    m = enrich_text_with_urls(m)
 
     who = "Gemini Pro"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
-
-    # keep the last 5, every has two ask and answer.
-    if len(player.history) > 10:
-        player.history = player.history[2:]
+    m = enrich_text_with_urls(m, token_budget=GEMINI_URL_TOKENS)
 
     try:
+        if (photo := replied_photo(message)) is not None:
+            m = [m, upload_photo_to_gemini(photo, bot)]
         if path := gemini_file_player_dict.get(player_id):
-            m = [m, path]
-        r = player.send_message(m, stream=True)
-        s = ""
-        start = time.time()
-        for e in r:
-            s += e.text
-            if time.time() - start > 1.7:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
+            m = [*m, path] if isinstance(m, list) else [m, path]
+        with gemini_breaker.call() as first_token:
+            r = player.send_message(
+                m,
+                stream=True,
+                request_options={"timeout": current_deadline().timeout("provider")},
+            )
+            s = ""
+            start = time.time()
+            for e in r:
+                first_token()
+                s += e.text
+                if time.time() - start > 1.7:
+                    start = time.time()
+                    bot_reply_markdown(reply_id, who, s, bot, split_text=False)
 
         if not bot_reply_markdown(reply_id, who, s, bot):
             # maybe not complete
             # maybe the same message
-            player.history.clear()
+            gemini_sessions.clear(_session_kind(is_pro), player_id)
             return
+        save_gemini_player(player_id, is_pro, player)
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        return
     except Exception as e:
-        logger.exception("Gemini audio handler error")
+        logger.exception("Gemini pro handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
-        try:
-            player.history.clear()
-        except Exception:
-            print(f"\n------\n{who} history.clear() Error / Unstoppable\n------\n")
+        gemini_sessions.clear(_session_kind(is_pro), player_id)
         return
 
 
@@ -177,34 +368,36 @@ def gemini_photo_handler(message: Message, bot: TeleBot) -> None:
     who = "Gemini Vision"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
-    # get the high quaility picture.
-    max_size_photo = max(message.photo, key=lambda p: p.file_size)
-    file_path = bot.get_file(max_size_photo.file_id).file_path
-    downloaded_file = bot.download_file(file_path)
-    with open("gemini_temp.jpg", "wb") as temp_file:
-        temp_file.write(downloaded_file)
-
-    model = genai.GenerativeModel("gemini-2.0-flash-exp")
-    with open("gemini_temp.jpg", "rb") as image_file:
-        image_data = image_file.read()
+    # the smallest picture the model still sees in full
+    image_data = download_photo(message, bot, provider="gemini")
+
+    model = get_gemini_model("gemini-2.0-flash-exp", configured=False)
     contents = {
         "parts": [{"mime_type": "image/jpeg", "data": image_data}, {"text": prompt}]
     }
     try:
-        r = model.generate_content(contents=contents, stream=True)
-        s = ""
-        start = time.time()
-        for e in r:
-            s += e.text
-            if time.time() - start > 1.7:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
+        with gemini_breaker.call() as first_token:
+            r = model.generate_content(
+                contents=contents,
+                stream=True,
+                request_options={"timeout": current_deadline().timeout("provider")},
+            )
+            s = ""
+            start = time.time()
+            for e in r:
+                first_token()
+                s += e.text
+                if time.time() - start > 1.7:
+                    start = time.time()
+                    bot_reply_markdown(reply_id, who, s, bot, split_text=False)
 
         # maybe not complete
         try:
             bot_reply_markdown(reply_id, who, s, bot)
         except Exception:
             pass
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
     except Exception as e:
         logger.exception("Gemini photo handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
@@ -215,45 +408,53 @@ def gemini_audio_handler(message: Message, bot: TeleBot) -> None:
     prompt = s.strip()
     who = "Gemini File Audio"
     player_id = str(message.from_user.id)
-    # restart will lose all TODO
-    player = get_gemini_player(player_id, is_pro=True)
-    file_path = None
-    # for file handler like {user_id: [player, file_path], user_id2: [player, file_path]}
+    is_pro = True
+    player = get_gemini_player(player_id, is_pro)
     reply_id = bot_reply_first(message, who, bot)
-    file_path = bot.get_file(message.audio.file_id).file_path
-    downloaded_file = bot.download_file(file_path)
-    path = f"{player_id}_gemini.mp3"
-    with open(path, "wb") as temp_file:
-        temp_file.write(downloaded_file)
-    gemini_mp3_file = genai.upload_file(path=path)
-    r = player.send_message([prompt, gemini_mp3_file], stream=True)
+    gemini_mp3_file = gemini_files.upload_telegram_file(
+        bot, message.audio.file_id, message.audio.file_unique_id, ".mp3"
+    )
     # need set it for the conversation
     gemini_file_player_dict[player_id] = gemini_mp3_file
     try:
-        s = ""
-        start = time.time()
-        for e in r:
-            s += e.text
-            if time.time() - start > 1.7:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
+        with gemini_breaker.call() as first_token:
+            r = player.send_message(
+                [prompt, gemini_mp3_file],
+                stream=True,
+                request_options={"timeout": current_deadline().timeout("provider")},
+            )
+            s = ""
+            start = time.time()
+            for e in r:
+                first_token()
+                s += e.text
+                if time.time() - start > 1.7:
+                    start = time.time()
+                    bot_reply_markdown(reply_id, who, s, bot, split_text=False)
 
         if not bot_reply_markdown(reply_id, who, s, bot):
             # maybe not complete
             # maybe the same message
-            player.history.clear()
+            gemini_sessions.clear(_session_kind(is_pro), player_id)
             return
+        save_gemini_player(player_id, is_pro, player)
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        return
     except Exception as e:
         logger.exception("Gemini audio handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
-        try:
-            player.history.clear()
-        except Exception:
-            print(f"\n------\n{who} history.clear() Error / Unstoppable\n------\n")
+        gemini_sessions.clear(_session_kind(is_pro), player_id)
         return
 
 
 if GOOGLE_GEMINI_KEY:
+    register_provider(
+        "Gemini",
+        gemini_stream,
+        breaker=gemini_breaker,
+        warmup=lambda: next(iter(genai.list_models(page_size=1)), None),
+    )
 
     def register(bot: TeleBot) -> None:
         bot.register_message_handler(gemini_handler, commands=["gemini"], pass_bot=True)
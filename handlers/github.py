@@ -3,17 +3,16 @@ import subprocess
 from telebot import TeleBot
 from telebot.types import Message
 
+from ._jobs import Job, register_job_type, submit_job
 
-def github_poster_handler(message: Message, bot: TeleBot):
-    """github poster: /github <github_user_name> [<start>-<end>]"""
-    m = message.text.strip()
-    message_list = m.split(",")
-    name = message_list[0].strip()
+
+def run_github_poster_job(job: Job, bot: TeleBot) -> None:
+    name = job.payload["name"]
     cmd_list = ["github_poster", "github", "--github_user_name", name, "--me", name]
-    if len(message_list) > 1:
-        years = message_list[1]
+    if years := job.payload.get("years"):
         cmd_list.append("--year")
-        cmd_list.append(years.strip())
+        cmd_list.append(years)
+    job.progress(bot, f"Drawing the github poster of {name}")
     r = subprocess.check_output(cmd_list).decode("utf-8")
     if "done" in r:
         # TODO windows path
@@ -21,9 +20,23 @@ def github_poster_handler(message: Message, bot: TeleBot):
             ["cairosvg", "OUT_FOLDER/github.svg", "-o", f"github_{name}.png"]
         ).decode("utf-8")
         with open(f"github_{name}.png", "rb") as photo:
-            bot.send_photo(
-                message.chat.id, photo, reply_to_message_id=message.message_id
-            )
+            bot.send_photo(job.chat_id, photo, reply_to_message_id=job.message_id)
+
+
+# github_poster always writes to OUT_FOLDER/github.svg, draw one at a time
+register_job_type("github", run_github_poster_job, concurrency=1, resumable=True)
+
+
+def github_poster_handler(message: Message, bot: TeleBot):
+    """github poster: /github <github_user_name> [<start>-<end>]"""
+    m = message.text.strip()
+    message_list = m.split(",")
+    payload = {"name": message_list[0].strip()}
+    if len(message_list) > 1:
+        payload["years"] = message_list[1].strip()
+    submit_job(
+        bot, message, "github", payload, "Generating the github poster please wait"
+    )
 
 
 def register(bot: TeleBot) -> None:
@@ -1,54 +1,398 @@
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from os import environ
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from typing import Any, Callable, Iterator
 
 import requests
 from expiringdict import ExpiringDict
-from kling import ImageGen, VideoGen
+from kling import BaseGen, TaskStatus
 from telebot import TeleBot
-from telebot.types import InputMediaPhoto, Message
+from telebot.types import InputFile, InputMediaPhoto, Message
 
-from ._utils import logger
+from ._jobs import (
+    Job,
+    JobError,
+    detach_job,
+    finish_job,
+    register_job_type,
+    store,
+    submit_job,
+)
+from ._utils import download_telegram_file, logger
 
 KLING_COOKIE = environ.get("KLING_COOKIE")
 pngs_link_dict = ExpiringDict(max_len=100, max_age_seconds=60 * 10)
 
+# kling-creator polls videos every 5s and images every 2s, the tracker starts
+# there and backs off, it gives up after as long as kling-creator does
+VIDEO_POLL_INTERVAL = 5.0
+IMAGE_POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 20.0
+POLL_BACKOFF = 1.25
+VIDEO_TIMEOUT = 1200
+IMAGE_TIMEOUT = 600
+VIDEO_DOWNLOAD_TIMEOUT = 60
+KLING_REQUEST_TIMEOUT = 30
+VIDEO_CHUNK_SIZE = 64 * 1024
+VIDEO_SPOOL_SIZE = 8 * 1024 * 1024
 
-def kling_handler(message: Message, bot: TeleBot):
-    """kling: /kling <address>"""
-    bot.reply_to(
-        message,
-        "Generating pretty kling image may take some time please wait",
+Deliver = Callable[[Job, TeleBot, list[str]], None]
+
+
+# what kling-creator sends for its defaults, only the submit is done here
+KLING_CAMERA_JSON = (
+    '{"type":"empty","horizontal":0,"vertical":0,"zoom":0,"tilt":0,"pan":0,"roll":0}'
+)
+# the submit response status of a refused task
+KLING_REFUSED = 7
+# task statuses as kling-creator's `fetch_metadata` reads them
+KLING_COMPLETED = 90
+KLING_FAILED = (9, 50)
+
+
+def kling_task_payload(
+    video: bool, prompt: str, image_url: str | None = None
+) -> dict[str, Any]:
+    """The submit request of kling-creator's `get_video` and `get_images`."""
+    if video:
+        kind = "m2v_img2video" if image_url else "m2v_txt2video"
+        arguments = {
+            "prompt": prompt,
+            "negative_prompt": "",
+            "cfg": "0.5",
+            "duration": "5",
+            **(
+                {"tail_image_enabled": "false"}
+                if image_url
+                else {"aspect_ratio": "16:9"}
+            ),
+            "camera_json": KLING_CAMERA_JSON,
+            "biz": "klingai",
+        }
+    else:
+        kind = "mmu_img2img_aiweb" if image_url else "mmu_txt2img_aiweb"
+        arguments = {
+            "prompt": prompt,
+            "style": "默认",
+            "aspect_ratio": "1:1",
+            "imageCount": "4",
+            **({"fidelity": "0.5"} if image_url else {}),
+            "biz": "klingai",
+        }
+    return {
+        "type": kind,
+        "arguments": [{"name": k, "value": v} for k, v in arguments.items()],
+        "inputs": (
+            [{"inputType": "URL", "url": image_url, "name": "input"}]
+            if image_url
+            else []
+        ),
+    }
+
+
+def submit_kling_task(
+    client: BaseGen,
+    video: bool,
+    prompt: str,
+    image_path: str | None = None,
+    image_url: str | None = None,
+) -> str:
+    """Submit a generation and return its task id without waiting for it."""
+    if image_path:
+        image_url = client.image_uploader(image_path)
+    response = client.session.post(
+        client.submit_url,
+        json=kling_task_payload(video, prompt, image_url),
+        timeout=KLING_REQUEST_TIMEOUT,
     )
-    m = message.text.strip()
-    prompt = m.strip()
-    links = None
-    try:
-        i = ImageGen(KLING_COOKIE)
-        links = i.get_images(prompt)
-        # set the dict
+    response.raise_for_status()
+    data = response.json().get("data") or {}
+    if data.get("status") == KLING_REFUSED:
+        raise Exception(f"kling refused the task: {data.get('message')}")
+    task_id = (data.get("task") or {}).get("id")
+    if not task_id:
+        raise Exception("kling did not return a task id")
+    return task_id
+
+
+def fetch_kling_status(
+    session: requests.Session, base_url: str, task_id: str
+) -> tuple[dict[str, Any], TaskStatus]:
+    """kling-creator's `fetch_metadata`, but a hung check times out."""
+    response = session.get(
+        f"{base_url}api/task/status",
+        params={"taskId": task_id},
+        timeout=KLING_REQUEST_TIMEOUT,
+    )
+    response.raise_for_status()
+    data = response.json().get("data") or {}
+    status = data.get("status") or 0
+    if status >= KLING_COMPLETED:
+        return data, TaskStatus.COMPLETED
+    if status in KLING_FAILED:
+        return data, TaskStatus.FAILED
+    return data, TaskStatus.PENDING
+
+
+@dataclass
+class TrackedTask:
+    job: Job
+    bot: TeleBot
+    deliver: Deliver
+    interval: float
+    next_poll: float
+    expires_at: float
+
+
+class KlingTracker:
+    """
+    Waits for all outstanding kling tasks in one thread, instead of a worker
+    blocked in the polling loop of kling-creator for each of them. Kling has
+    no batch status api, so every due task is checked in turn and backs off.
+    """
+
+    def __init__(self, make_client: Callable[[], BaseGen] | None = None) -> None:
+        self._tasks: dict[str, TrackedTask] = {}
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._make_client = make_client or (lambda: BaseGen(KLING_COOKIE))
+        self._client: BaseGen | None = None
+        self._session: requests.Session | None = None
+        self._client_lock = threading.Lock()
+        # downloads and uploads do not hold up the polling
+        self._delivery = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="kling-delivery"
+        )
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def client(self) -> BaseGen:
+        """One logged in kling client for the submits."""
+        with self._client_lock:
+            if self._client is None:
+                self._client = self._make_client()
+            return self._client
+
+    def session(self) -> requests.Session:
+        """The connections of the polling, logged in like the submit client."""
+        client = self.client()
+        with self._client_lock:
+            if self._session is None:
+                session = requests.Session()
+                session.headers.update(client.session.headers)
+                session.cookies.update(client.session.cookies)
+                self._session = session
+            return self._session
+
+    def track(
+        self, job: Job, bot: TeleBot, deliver: Deliver, interval: float, timeout: float
+    ) -> None:
+        now = time.monotonic()
+        task = TrackedTask(job, bot, deliver, interval, now + interval, now + timeout)
+        with self._cond:
+            self._tasks[job.payload["task_id"]] = task
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="kling-tracker", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _due(self) -> list[tuple[str, TrackedTask]]:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                due = [(k, t) for k, t in self._tasks.items() if t.next_poll <= now]
+                if due:
+                    return due
+                next_poll = min((t.next_poll for t in self._tasks.values()), default=0)
+                self._cond.wait(next_poll - now if self._tasks else None)
+
+    def _run(self) -> None:
+        while True:
+            for task_id, task in self._due():
+                try:
+                    self._poll(task_id, task)
+                except Exception:
+                    logger.exception("Kling tracker error for task %s", task_id)
+                    with self._cond:
+                        task.next_poll = time.monotonic() + MAX_POLL_INTERVAL
+
+    def _poll(self, task_id: str, task: TrackedTask) -> None:
+        data, status = None, TaskStatus.PENDING
         try:
-            pngs_link_dict[str(message.from_user.id)] = links
+            data, status = fetch_kling_status(
+                self.session(), self.client().base_url, task_id
+            )
         except Exception as e:
-            print(str(e))
-    except Exception as e:
-        print(str(e))
-        bot.reply_to(message, "kling error maybe block the prompt")
+            logger.warning("Checking kling task %s failed: %s", task_id, e)
+        now = time.monotonic()
+        if status == TaskStatus.PENDING and now < task.expires_at:
+            with self._cond:
+                task.interval = min(task.interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+                task.next_poll = now + task.interval
+            return
+
+        with self._cond:
+            self._tasks.pop(task_id, None)
+        job, bot = task.job, task.bot
+        if status == TaskStatus.PENDING:
+            job.progress(bot, "kling takes too long, please try again later")
+            finish_job(job, "timeout")
+            return
+        links = []
+        if status == TaskStatus.COMPLETED:
+            for work in data.get("works", []):
+                if resource := work.get("resource", {}).get("resource"):
+                    links.append(resource)
+        if not links:
+            job.progress(bot, "kling error maybe block the prompt")
+            finish_job(job, "kling task failed")
+            return
+        self._delivery.submit(self._deliver, task, links)
+
+    @staticmethod
+    def _deliver(task: TrackedTask, links: list[str]) -> None:
+        try:
+            task.deliver(task.job, task.bot, links)
+        except Exception as e:
+            logger.exception("Kling delivery error")
+            task.job.progress(task.bot, "Something wrong, please check the log")
+            finish_job(task.job, str(e))
+        else:
+            finish_job(task.job)
+
+
+tracker = KlingTracker()
+
+
+@contextmanager
+def _job_image(job: Job, bot: TeleBot) -> Iterator[str | None]:
+    """kling-creator uploads from a path, so the photo gets a file of this job."""
+    file_id = job.payload.get("photo_file_id")
+    if file_id is None:
+        yield None
         return
+    with NamedTemporaryFile(suffix=".jpg") as image:
+        image.write(
+            download_telegram_file(bot, file_id, job.payload.get("photo_unique_id"))
+        )
+        image.flush()
+        yield image.name
+
+
+def _submit_and_track(
+    job: Job,
+    bot: TeleBot,
+    video: bool,
+    deliver: Deliver,
+    interval: float,
+    timeout: float,
+) -> str:
+    # a resumed job already has its task, it must not be paid for twice
+    if "task_id" not in job.payload:
+        try:
+            with _job_image(job, bot) as image_path:
+                job.payload["task_id"] = submit_kling_task(
+                    tracker.client(),
+                    video,
+                    job.payload["prompt"],
+                    image_path=image_path,
+                    image_url=job.payload.get("image_url"),
+                )
+        except Exception as e:
+            logger.exception("Kling submit error")
+            raise JobError("kling error maybe block the prompt") from e
+        store.update_payload(job.id, job.payload)
+    state = detach_job(job)
+    tracker.track(job, bot, deliver, interval, timeout)
+    return state
+
+
+def deliver_kling_images(job: Job, bot: TeleBot, links: list[str]) -> None:
+    # set the dict
+    pngs_link_dict[str(job.payload["user_id"])] = links
     photos_list = [InputMediaPhoto(i) for i in links]
     bot.send_media_group(
-        message.chat.id,
+        job.chat_id,
         photos_list,
-        reply_to_message_id=message.message_id,
+        reply_to_message_id=job.message_id,
         disable_notification=True,
     )
 
 
-def kling_pro_handler(message: Message, bot: TeleBot):
+def deliver_kling_video(job: Job, bot: TeleBot, links: list[str]) -> None:
+    job.progress(bot, "Sending the kling video")
+    try:
+        # telegram fetches the url itself, nothing passes through here
+        bot.send_video(
+            job.chat_id,
+            links[0],
+            caption=job.payload["prompt"],
+            reply_to_message_id=job.message_id,
+        )
+        return
+    except Exception as e:
+        logger.info("Telegram could not fetch the kling video, uploading it: %s", e)
+    # fall back to streaming it through a buffer of this job only, small videos
+    # stay in memory and larger ones spill to a temporary file
+    with (
+        requests.get(links[0], stream=True, timeout=VIDEO_DOWNLOAD_TIMEOUT) as response,
+        SpooledTemporaryFile(max_size=VIDEO_SPOOL_SIZE) as video,
+    ):
+        if response.status_code != 200:
+            job.reply(bot, "could not fetch the video")
+            return
+        for chunk in response.iter_content(chunk_size=VIDEO_CHUNK_SIZE):
+            video.write(chunk)
+        video.seek(0)
+        bot.send_video(
+            job.chat_id,
+            InputFile(video, file_name="kling.mp4"),
+            caption=job.payload["prompt"],
+            reply_to_message_id=job.message_id,
+        )
+
+
+def run_kling_images_job(job: Job, bot: TeleBot) -> str:
+    return _submit_and_track(
+        job, bot, False, deliver_kling_images, IMAGE_POLL_INTERVAL, IMAGE_TIMEOUT
+    )
+
+
+def run_kling_video_job(job: Job, bot: TeleBot) -> str:
+    return _submit_and_track(
+        job, bot, True, deliver_kling_video, VIDEO_POLL_INTERVAL, VIDEO_TIMEOUT
+    )
+
+
+# only the submits run in these pools, the tracker waits for the results, and
+# the task id is stored before waiting so a restart keeps tracking it
+register_job_type("kling", run_kling_images_job, concurrency=2, resumable=True)
+register_job_type("kling_pro", run_kling_video_job, concurrency=2, resumable=True)
+
+
+def kling_handler(message: Message, bot: TeleBot):
     """kling: /kling <address>"""
-    bot.reply_to(
+    m = message.text.strip()
+    prompt = m.strip()
+    submit_job(
+        bot,
         message,
-        "Generating pretty kling video may take a long time about 2mins to 5mins please wait",
+        "kling",
+        {"prompt": prompt, "user_id": message.from_user.id},
+        "Generating pretty kling image may take some time please wait",
     )
+
+
+def kling_pro_handler(message: Message, bot: TeleBot):
+    """kling: /kling <address>"""
     m = message.text.strip()
     prompt = m.strip()
     # drop all the spaces
@@ -58,70 +402,37 @@ def kling_pro_handler(message: Message, bot: TeleBot):
     number = number[0] if number else None
     if number:
         number = int(number.replace("图", ""))
-    v = VideoGen(KLING_COOKIE)
-    video_links = None
     image_url = None
     if number and number <= 9 and pngs_link_dict.get(str(message.from_user.id)):
         if number - 1 <= len(pngs_link_dict.get(str(message.from_user.id))):
             image_url = pngs_link_dict.get(str(message.from_user.id))[number - 1]
             print(image_url)
-    try:
-        video_links = v.get_video(prompt, image_url=image_url)
-    except Exception as e:
-        print(str(e))
-        bot.reply_to(message, "kling error maybe block the prompt")
-        return
-    if not video_links:
-        bot.reply_to(message, "video not generate")
-        return
-    response = requests.get(video_links[0])
-    if response.status_code != 200:
-        bot.reply_to(message, "could not fetch the video")
-    # save response to file
-    with open("kling.mp4", "wb") as output_file:
-        output_file.write(response.content)
-    bot.send_video(
-        message.chat.id,
-        open("kling.mp4", "rb"),
-        caption=prompt,
-        reply_to_message_id=message.message_id,
+    submit_job(
+        bot,
+        message,
+        "kling_pro",
+        {"prompt": prompt, "image_url": image_url},
+        "Generating pretty kling video may take a long time about 2mins to 5mins please wait",
     )
 
 
 def kling_photo_handler(message: Message, bot: TeleBot) -> None:
     s = message.caption
     prompt = s.strip()
-    # show something, make it more responsible
-    # get the high quaility picture.
+    # get the high quaility picture, the job downloads it
     max_size_photo = max(message.photo, key=lambda p: p.file_size)
-    file_path = bot.get_file(max_size_photo.file_id).file_path
-    downloaded_file = bot.download_file(file_path)
-    bot.reply_to(
+    submit_job(
+        bot,
         message,
+        "kling",
+        {
+            "prompt": prompt,
+            "user_id": message.from_user.id,
+            "photo_file_id": max_size_photo.file_id,
+            "photo_unique_id": max_size_photo.file_unique_id,
+        },
         "Generating pretty kling image using your photo may take some time please wait",
     )
-    with open("kling.jpg", "wb") as temp_file:
-        temp_file.write(downloaded_file)
-    i = ImageGen(KLING_COOKIE)
-    links = None
-    try:
-        links = i.get_images(prompt, "kling.jpg")
-        # set the dict
-        try:
-            pngs_link_dict[str(message.from_user.id)] = links
-        except Exception:
-            logger.exception("Kling photo handler error")
-    except Exception:
-        logger.exception("Kling photo handler error")
-        bot.reply_to(message, "kling error maybe block the prompt")
-        return
-    photos_list = [InputMediaPhoto(i) for i in links]
-    bot.send_media_group(
-        message.chat.id,
-        photos_list,
-        reply_to_message_id=message.message_id,
-        disable_notification=True,
-    )
 
 
 if KLING_COOKIE:
@@ -1,27 +1,63 @@
 import time
 from os import environ
+from typing import Any, Iterator
 
 from expiringdict import ExpiringDict
-from groq import Groq
+from groq import DefaultHttpxClient, Groq
 from telebot import TeleBot
 from telebot.types import Message
 from telegramify_markdown import markdownify
 
-from ._utils import bot_reply_first, bot_reply_markdown, enrich_text_with_urls, logger
+from config import KEEPALIVE_LIMITS
+
+from ._providers import (
+    CircuitBreaker,
+    CircuitOpenError,
+    close_on_cancel,
+    register_provider,
+)
+from ._utils import (
+    TIMEOUT_MARK,
+    bot_reply_first,
+    bot_reply_markdown,
+    current_deadline,
+    enrich_text_with_urls,
+    logger,
+)
 
 
 LLAMA_API_KEY = environ.get("GROQ_API_KEY")
 LLAMA_MODEL = "llama-3.1-70b-versatile"
 LLAMA_PRO_MODEL = "llama-3.1-70b-versatile"
+# groq has tight tokens per minute limits
+LLAMA_URL_TOKENS = 2000
 
 if LLAMA_API_KEY:
-    client = Groq(api_key=LLAMA_API_KEY)
+    client = Groq(
+        api_key=LLAMA_API_KEY,
+        http_client=DefaultHttpxClient(limits=KEEPALIVE_LIMITS),
+    )
+
+# shared by the handlers and the provider so a dead upstream fails fast everywhere
+llama_breaker = CircuitBreaker("llama")
 
 # Global history cache
 llama_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
 llama_pro_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
 
 
+def llama_stream(messages: list[dict[str, Any]]) -> Iterator[str]:
+    with current_deadline().stage("provider") as timeout:
+        r = close_on_cancel(
+            client.chat.completions.create(
+                messages=messages, model=LLAMA_MODEL, stream=True, timeout=timeout
+            )
+        )
+        for chunk in r:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
 def llama_handler(message: Message, bot: TeleBot) -> None:
     """llama : /llama <question>"""
     m = message.text.strip()
@@ -44,11 +80,11 @@ def llama_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "llama"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m, token_budget=LLAMA_URL_TOKENS)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -57,7 +93,12 @@ def llama_handler(message: Message, bot: TeleBot) -> None:
 
     llama_reply_text = ""
     try:
-        r = client.chat.completions.create(messages=player_message, model=LLAMA_MODEL)
+        with llama_breaker.call():
+            r = client.chat.completions.create(
+                messages=player_message,
+                model=LLAMA_MODEL,
+                timeout=current_deadline().timeout("provider"),
+            )
         content = r.choices[0].message.content.encode("utf8").decode()
         if not content:
             llama_reply_text = f"{who} did not answer."
@@ -71,6 +112,10 @@ def llama_handler(message: Message, bot: TeleBot) -> None:
                 }
             )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.pop()
+        return
     except Exception:
         logger.exception("Llama handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
@@ -104,10 +149,10 @@ def llama_pro_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "llama Pro"
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m, token_budget=LLAMA_URL_TOKENS)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -115,21 +160,28 @@ def llama_pro_handler(message: Message, bot: TeleBot) -> None:
         player_message = player_message[2:]
 
     try:
-        r = client.chat.completions.create(
-            messages=player_message,
-            model=LLAMA_PRO_MODEL,
-            stream=True,
-        )
-        s = ""
-        start = time.time()
-        for chunk in r:
-            if chunk.choices[0].delta.content is None:
-                break
-            s += chunk.choices[0].delta.content
-            # 0.7 is enough for llama3 here its very fast
-            if time.time() - start > 0.7:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
+        deadline = current_deadline()
+        with llama_breaker.call() as first_token:
+            r = client.chat.completions.create(
+                messages=player_message,
+                model=LLAMA_PRO_MODEL,
+                stream=True,
+                timeout=deadline.timeout("provider"),
+            )
+            s = ""
+            start = time.time()
+            for chunk in r:
+                if deadline.expired():
+                    s += TIMEOUT_MARK
+                    break
+                if chunk.choices[0].delta.content is None:
+                    break
+                first_token()
+                s += chunk.choices[0].delta.content
+                # 0.7 is enough for llama3 here its very fast
+                if time.time() - start > 0.7:
+                    start = time.time()
+                    bot_reply_markdown(reply_id, who, s, bot, split_text=False)
 
         if not bot_reply_markdown(reply_id, who, s, bot):
             # maybe not complete
@@ -144,6 +196,10 @@ def llama_pro_handler(message: Message, bot: TeleBot) -> None:
             }
         )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.clear()
+        return
     except Exception:
         logger.exception("Llama Pro handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
@@ -152,6 +208,9 @@ def llama_pro_handler(message: Message, bot: TeleBot) -> None:
 
 
 if LLAMA_API_KEY:
+    register_provider(
+        "llama", llama_stream, breaker=llama_breaker, warmup=client.models.list
+    )
 
     def register(bot: TeleBot) -> None:
         bot.register_message_handler(llama_handler, commands=["llama"], pass_bot=True)
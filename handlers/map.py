@@ -1,6 +1,5 @@
 import gc
 import random
-import shutil
 from tempfile import SpooledTemporaryFile
 
 import numpy as np
@@ -13,6 +12,8 @@ from prettymapp.settings import STYLES
 from telebot import TeleBot
 from telebot.types import Message
 
+from ._jobs import Job, register_job_type, submit_job
+
 MAX_IN_MEMORY = 10 * 1024 * 1024  # 10MiB
 PIL.Image.MAX_IMAGE_PIXELS = 933120000
 
@@ -83,47 +84,49 @@ def draw_pretty_map(location, style, output_file):
         )
 
 
-def map_handler(message: Message, bot: TeleBot):
-    """pretty map: /map <address>"""
-    bot.reply_to(message, "Generating pretty map may take some time please wait:")
-    m = message.text.strip()
-    location = m.strip()
-    styles_list = list(STYLES.keys())
-    style = random.choice(styles_list)
-    with SpooledTemporaryFile(max_size=MAX_IN_MEMORY) as out_image:
-        try:
-            draw_pretty_map(location, style, out_image)
-            # tg can only send image less than 10MB
-            with open("map_out.jpg", "wb") as f:  # for debug
-                shutil.copyfileobj(out_image, f)
-            out_image.seek(0)
-            bot.send_photo(
-                message.chat.id, out_image, reply_to_message_id=message.message_id
-            )
-        finally:
-            gc.collect()
-
-
-def map_location_handler(message: Message, bot: TeleBot):
-    # TODO refactor the function
-    location = "{0}, {1}".format(message.location.latitude, message.location.longitude)
+def run_map_job(job: Job, bot: TeleBot) -> None:
     styles_list = list(STYLES.keys())
     style = random.choice(styles_list)
+    job.progress(bot, "Drawing the pretty map, please wait:")
     try:
         with SpooledTemporaryFile(max_size=MAX_IN_MEMORY) as out_image:
-            draw_pretty_map(location, style, out_image)
+            draw_pretty_map(job.payload["location"], style, out_image)
             # tg can only send image less than 10MB
-            with open("map_out.jpg", "wb") as f:  # for debug
-                shutil.copyfileobj(out_image, f)
             out_image.seek(0)
-            bot.send_photo(
-                message.chat.id, out_image, reply_to_message_id=message.message_id
-            )
-
+            job.progress(bot, "Sending the pretty map")
+            bot.send_photo(job.chat_id, out_image, reply_to_message_id=job.message_id)
     finally:
         gc.collect()
 
 
+# a 1200 dpi map takes a lot of memory, draw one at a time
+register_job_type("map", run_map_job, concurrency=1, resumable=True)
+
+
+def map_handler(message: Message, bot: TeleBot):
+    """pretty map: /map <address>"""
+    m = message.text.strip()
+    location = m.strip()
+    submit_job(
+        bot,
+        message,
+        "map",
+        {"location": location},
+        "Generating pretty map may take some time please wait:",
+    )
+
+
+def map_location_handler(message: Message, bot: TeleBot):
+    location = "{0}, {1}".format(message.location.latitude, message.location.longitude)
+    submit_job(
+        bot,
+        message,
+        "map",
+        {"location": location},
+        "Generating pretty map may take some time please wait:",
+    )
+
+
 def register(bot: TeleBot) -> None:
     bot.register_message_handler(map_handler, commands=["map"], pass_bot=True)
     bot.register_message_handler(map_handler, regexp="^map:", pass_bot=True)
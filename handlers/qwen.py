@@ -1,6 +1,7 @@
 # qwen use https://api.together.xyz
 import time
 from os import environ
+from typing import Any, Iterator
 
 from expiringdict import ExpiringDict
 from telebot import TeleBot
@@ -8,20 +9,47 @@ from telebot.types import Message
 from telegramify_markdown import markdownify
 from together import Together
 
-from ._utils import bot_reply_first, bot_reply_markdown, enrich_text_with_urls, logger
+from config import settings
+
+from ._providers import CircuitBreaker, CircuitOpenError, register_provider
+from ._utils import (
+    TIMEOUT_MARK,
+    bot_reply_first,
+    bot_reply_markdown,
+    current_deadline,
+    enrich_text_with_urls,
+    logger,
+)
 
 
 QWEN_API_KEY = environ.get("TOGETHER_API_KEY")
 QWEN_MODEL = "Qwen/Qwen2-72B-Instruct"
 
 if QWEN_API_KEY:
-    client = Together(api_key=QWEN_API_KEY)
+    # together takes no timeout per call, the streams check the deadline instead
+    client = Together(api_key=QWEN_API_KEY, timeout=settings.request_deadline)
+
+# shared by the handlers and the provider so a dead upstream fails fast everywhere
+qwen_breaker = CircuitBreaker("qwen")
 
 # Global history cache
 qwen_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
 qwen_pro_player_dict = ExpiringDict(max_len=1000, max_age_seconds=600)
 
 
+def qwen_stream(messages: list[dict[str, Any]]) -> Iterator[str]:
+    deadline = current_deadline()
+    with deadline.stage("provider"):
+        r = client.chat.completions.create(
+            messages=messages, model=QWEN_MODEL, stream=True
+        )
+        for chunk in r:
+            if deadline.expired():
+                break
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
 def qwen_handler(message: Message, bot: TeleBot) -> None:
     """qwen : /qwen <question>"""
     m = message.text.strip()
@@ -44,11 +72,11 @@ def qwen_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "qwen"
     # show something, make it more responsible
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -57,9 +85,10 @@ def qwen_handler(message: Message, bot: TeleBot) -> None:
 
     qwen_reply_text = ""
     try:
-        r = client.chat.completions.create(
-            messages=player_message, max_tokens=8192, model=QWEN_MODEL
-        )
+        with qwen_breaker.call():
+            r = client.chat.completions.create(
+                messages=player_message, max_tokens=8192, model=QWEN_MODEL
+            )
         content = r.choices[0].message.content.encode("utf8").decode()
         if not content:
             qwen_reply_text = f"{who} did not answer."
@@ -73,6 +102,10 @@ def qwen_handler(message: Message, bot: TeleBot) -> None:
                 }
             )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.pop()
+        return
     except Exception:
         logger.exception("Qwen handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
@@ -106,10 +139,10 @@ def qwen_pro_handler(message: Message, bot: TeleBot) -> None:
     if m[:4].lower() == "new ":
         m = m[4:].strip()
         player_message.clear()
-    m = enrich_text_with_urls(m)
 
     who = "qwen Pro"
     reply_id = bot_reply_first(message, who, bot)
+    m = enrich_text_with_urls(m)
 
     player_message.append({"role": "user", "content": m})
     # keep the last 5, every has two ask and answer.
@@ -117,21 +150,27 @@ def qwen_pro_handler(message: Message, bot: TeleBot) -> None:
         player_message = player_message[2:]
 
     try:
-        r = client.chat.completions.create(
-            messages=player_message,
-            max_tokens=8192,
-            model=QWEN_MODEL,
-            stream=True,
-        )
-        s = ""
-        start = time.time()
-        for chunk in r:
-            if chunk.choices[0].delta.content is None:
-                break
-            s += chunk.choices[0].delta.content
-            if time.time() - start > 1.7:
-                start = time.time()
-                bot_reply_markdown(reply_id, who, s, bot, split_text=False)
+        deadline = current_deadline()
+        with qwen_breaker.call() as first_token:
+            r = client.chat.completions.create(
+                messages=player_message,
+                max_tokens=8192,
+                model=QWEN_MODEL,
+                stream=True,
+            )
+            s = ""
+            start = time.time()
+            for chunk in r:
+                if deadline.expired():
+                    s += TIMEOUT_MARK
+                    break
+                if chunk.choices[0].delta.content is None:
+                    break
+                first_token()
+                s += chunk.choices[0].delta.content
+                if time.time() - start > 1.7:
+                    start = time.time()
+                    bot_reply_markdown(reply_id, who, s, bot, split_text=False)
 
         if not bot_reply_markdown(reply_id, who, s, bot):
             # maybe not complete
@@ -146,6 +185,10 @@ def qwen_pro_handler(message: Message, bot: TeleBot) -> None:
             }
         )
 
+    except CircuitOpenError as e:
+        bot_reply_markdown(reply_id, who, str(e), bot)
+        player_message.clear()
+        return
     except Exception:
         logger.exception("Qwen Pro handler error")
         bot.reply_to(message, "answer wrong maybe up to the max token")
@@ -154,6 +197,9 @@ def qwen_pro_handler(message: Message, bot: TeleBot) -> None:
 
 
 if QWEN_API_KEY:
+    register_provider(
+        "qwen", qwen_stream, breaker=qwen_breaker, warmup=client.models.list
+    )
 
     def register(bot: TeleBot) -> None:
         bot.register_message_handler(qwen_handler, commands=["qwen"], pass_bot=True)
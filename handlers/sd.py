@@ -6,6 +6,8 @@ from telebot.types import Message
 
 from config import settings
 
+from ._utils import upload_file
+
 SD_API_KEY = environ.get("SD3_KEY")
 
 # TODO refactor this shit to __init__
@@ -26,7 +28,7 @@ def get_user_balance():
     return payload["credits"]
 
 
-def generate_sd3_image(prompt):
+def generate_sd3_image(prompt) -> bytes | None:
     response = requests.post(
         "https://api.stability.ai/v2beta/stable-image/generate/sd3",
         headers={"authorization": f"Bearer {SD_API_KEY}", "accept": "image/*"},
@@ -39,12 +41,10 @@ def generate_sd3_image(prompt):
     )
 
     if response.status_code == 200:
-        with open("sd3.jpeg", "wb") as file:
-            file.write(response.content)
-        return True
+        return response.content
     else:
         print(str(response.json()))
-        return False
+        return None
 
 
 def sd_handler(message: Message, bot: TeleBot):
@@ -58,10 +58,11 @@ def sd_handler(message: Message, bot: TeleBot):
     prompt = m.strip()
     r = generate_sd3_image(prompt)
     if r:
-        with open("sd3.jpeg", "rb") as photo:
-            bot.send_photo(
-                message.chat.id, photo, reply_to_message_id=message.message_id
-            )
+        bot.send_photo(
+            message.chat.id,
+            upload_file(r, "sd3.jpeg"),
+            reply_to_message_id=message.message_id,
+        )
     else:
         bot.reply_to(message, "prompt error")
 
@@ -88,10 +89,11 @@ def sd_pro_handler(message: Message, bot: TeleBot):
     )
     r = generate_sd3_image(sd_prompt)
     if r:
-        with open("sd3.jpeg", "rb") as photo:
-            bot.send_photo(
-                message.chat.id, photo, reply_to_message_id=message.message_id
-            )
+        bot.send_photo(
+            message.chat.id,
+            upload_file(r, "sd3.jpeg"),
+            reply_to_message_id=message.message_id,
+        )
     else:
         bot.reply_to(message, "prompt error")
 
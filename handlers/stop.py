@@ -0,0 +1,43 @@
+from telebot import TeleBot
+from telebot.types import CallbackQuery, Message
+
+from ._utils import (
+    STOP_CALLBACK_DATA,
+    cancel_generations,
+    drop_debounced_prompts,
+    non_llm_handler,
+)
+
+
+@non_llm_handler
+def stop_handler(message: Message, bot: TeleBot) -> None:
+    """stop : /stop stop your running answers, reply to one to stop only it"""
+    message_id = None
+    dropped = 0
+    if message.reply_to_message is not None:
+        message_id = message.reply_to_message.message_id
+    else:
+        # and the prompts not answered yet, see `settings.debounce_ms`
+        dropped = drop_debounced_prompts(message.chat.id, message.from_user.id)
+    cancelled = cancel_generations(message.chat.id, message.from_user.id, message_id)
+    if not cancelled and not dropped:
+        bot.reply_to(message, "Nothing to stop.")
+
+
+def stop_callback_handler(call: CallbackQuery, bot: TeleBot) -> None:
+    # only the user who asked can stop the answer
+    if cancel_generations(
+        call.message.chat.id, call.from_user.id, call.message.message_id
+    ):
+        bot.answer_callback_query(call.id, "Stopping...")
+    else:
+        bot.answer_callback_query(call.id, "Nothing to stop.")
+
+
+def register(bot: TeleBot) -> None:
+    bot.register_message_handler(stop_handler, commands=["stop"], pass_bot=True)
+    bot.register_callback_query_handler(
+        stop_callback_handler,
+        func=lambda call: call.data == STOP_CALLBACK_DATA,
+        pass_bot=True,
+    )
@@ -1,16 +1,14 @@
 from telebot import TeleBot
 from telebot.types import Message
-from urlextract import URLExtract
 
-from ._utils import bot_reply_first, bot_reply_markdown
+from ._utils import bot_reply_first, bot_reply_markdown, extract_url_from_text
 
 
 def tweet_handler(message: Message, bot: TeleBot):
     """tweet: /t <twitter/x web link>"""
     who = "tweet"
 
-    extractor = URLExtract()
-    links = extractor.find_urls(message.text)
+    links = extract_url_from_text(message.text)
 
     only_links = len("".join(links)) == len(message.text.strip())
     if links:
@@ -0,0 +1,12 @@
+import os
+import tempfile
+
+# config reads the token at import, the tests never talk to telegram
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test")
+# and the stores of the handlers keep out of the checkout
+_data_dir = tempfile.mkdtemp(prefix="tg-bot-tests-")
+os.environ.setdefault("JOBS_DB", os.path.join(_data_dir, "jobs.db"))
+os.environ.setdefault(
+    "GEMINI_SESSIONS_DB", os.path.join(_data_dir, "gemini_sessions.db")
+)
+os.environ.setdefault("URL_CACHE_DIR", os.path.join(_data_dir, "url_cache"))
@@ -0,0 +1,169 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from handlers import _utils
+from handlers._utils import MessageBatcher
+
+WINDOW = 0.05
+
+
+def photo(message_id, group="album", caption=None):
+    return SimpleNamespace(message_id=message_id, media_group_id=group, caption=caption)
+
+
+class FakePool:
+    def __init__(self):
+        self.tasks = []
+        self.put_called = threading.Event()
+
+    def put(self, func, *args):
+        self.tasks.append((func, args))
+        self.put_called.set()
+
+
+class FakeBot:
+    def __init__(self, threaded=True):
+        self.threaded = threaded
+        self.worker_pool = FakePool() if threaded else None
+
+
+def test_album_goes_to_the_workers_in_order():
+    batcher = MessageBatcher(WINDOW)
+    bot = FakeBot()
+    answered = []
+    batcher.add(photo(3))
+    batcher.add(photo(1, caption="what is this"), answered.append, bot=bot)
+    batcher.add(photo(2))
+    batcher.add(photo(9, group="other"))
+    assert bot.worker_pool.put_called.wait(1)
+
+    ((func, (messages,)),) = bot.worker_pool.tasks
+    # the timer thread only handed it over
+    assert answered == []
+    func(messages)
+    assert [m.message_id for m in answered[0]] == [1, 2, 3]
+
+
+def test_every_message_restarts_the_window():
+    batcher = MessageBatcher(WINDOW)
+    done = threading.Event()
+    batches = []
+
+    def answer(messages):
+        batches.append(messages)
+        done.set()
+
+    batcher.add(photo(1), answer, key="prompt")
+    for message_id in range(2, 6):
+        assert not done.wait(WINDOW / 2)
+        batcher.add(photo(message_id), key="prompt")
+    assert done.wait(1)
+    assert [len(batch) for batch in batches] == [5]
+    assert len(batcher) == 0
+
+
+def test_without_a_threaded_bot_the_timer_answers():
+    batcher = MessageBatcher(WINDOW)
+    done = threading.Event()
+    threads = []
+
+    def answer(messages):
+        threads.append(threading.current_thread())
+        done.set()
+
+    batcher.add(photo(1), answer, bot=FakeBot(threaded=False))
+    assert done.wait(1)
+    assert threads[0] is not threading.main_thread()
+
+
+def test_album_nobody_asked_about_is_dropped():
+    batcher = MessageBatcher(WINDOW)
+    batcher.add(photo(1))
+    batcher.add(photo(2))
+    assert len(batcher) == 1
+    threading.Event().wait(WINDOW * 4)
+    assert len(batcher) == 0
+
+
+def prompt(message_id, text):
+    return SimpleNamespace(
+        message_id=message_id,
+        text=f"/gpt {text}",
+        caption=None,
+        location=None,
+        chat=SimpleNamespace(id=1),
+        from_user=SimpleNamespace(id=2),
+    )
+
+
+class FakeTelegram(FakeBot):
+    def __init__(self):
+        super().__init__(threaded=False)
+
+    def get_me(self):
+        return SimpleNamespace(username="testbot")
+
+
+@pytest.fixture
+def debounced(monkeypatch):
+    monkeypatch.setattr(_utils.settings, "debounce_ms", WINDOW * 1000)
+    monkeypatch.setattr(_utils, "debounced_prompts", MessageBatcher(WINDOW))
+    answered = []
+
+    def handler(message, bot):
+        answered.append(message.text)
+
+    return _utils.wrap_handler(handler, FakeTelegram()), answered
+
+
+def test_flush_answers_right_away_in_this_thread():
+    batcher = MessageBatcher(60)
+    answered = []
+    batcher.add(photo(2), key="k")
+    batcher.add(photo(1), lambda messages: answered.append(messages), key="k")
+    batcher.flush("k")
+    assert [m.message_id for m in answered[0]] == [1, 2]
+    assert len(batcher) == 0
+    # nothing left for the timer or another flush
+    batcher.flush("k")
+    assert len(answered) == 1
+
+
+def test_drop_forgets_matching_batches():
+    batcher = MessageBatcher(WINDOW)
+    answered = []
+    batcher.add(photo(1), answered.append, key=(1, 2, "a"))
+    batcher.add(photo(2), key=(1, 2, "a"))
+    batcher.add(photo(3), answered.append, key=(1, 3, "a"))
+    assert batcher.drop(lambda key: key[:2] == (1, 2)) == 2
+    threading.Event().wait(WINDOW * 4)
+    assert [[m.message_id for m in batch] for batch in answered] == [[3]]
+
+
+def test_prompts_in_quick_succession_are_merged(debounced):
+    wrapper, answered = debounced
+    wrapper(prompt(1, "first part"), FakeTelegram())
+    wrapper(prompt(2, "second part"), FakeTelegram())
+    assert answered == []
+    threading.Event().wait(WINDOW * 4)
+    assert answered == ["first part\nsecond part"]
+
+
+def test_clear_and_new_are_not_merged(debounced):
+    wrapper, answered = debounced
+    wrapper(prompt(1, "a question"), FakeTelegram())
+    wrapper(prompt(2, "clear"), FakeTelegram())
+    # the waiting prompt is answered before the history is cleared
+    assert answered == ["a question", "clear"]
+    wrapper(prompt(3, "new another one"), FakeTelegram())
+    assert answered[-1] == "new another one"
+
+
+def test_stop_drops_waiting_prompts(debounced):
+    wrapper, answered = debounced
+    wrapper(prompt(1, "never mind"), FakeTelegram())
+    assert _utils.drop_debounced_prompts(1, 2) == 1
+    threading.Event().wait(WINDOW * 4)
+    assert answered == []
@@ -0,0 +1,18 @@
+import os
+
+from handlers._files import FileCache
+
+
+def test_spill_dir_is_read_on_first_lookup(tmp_path):
+    spill_dir = tmp_path / "spill"
+    cache = FileCache(10, str(spill_dir), 100)
+    # nothing touches the disk at import
+    assert not spill_dir.exists()
+
+    cache.put("a", b"12345678")
+    cache.put("b", b"12345678")
+    assert os.listdir(spill_dir) == ["a"]
+
+    restarted = FileCache(10, str(spill_dir), 100)
+    assert restarted.get("a") == b"12345678"
+    assert restarted.hits == 1
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from handlers import gemini
+from handlers.gemini import GeminiFileManager
+
+
+@pytest.fixture
+def genai(monkeypatch):
+    uploads, deletes = [], []
+
+    def upload_file(path):
+        uploads.append(path)
+        return SimpleNamespace(
+            name=f"files/{len(uploads)}",
+            expiration_time=datetime.now(timezone.utc) + timedelta(hours=48),
+        )
+
+    monkeypatch.setattr(gemini.genai, "upload_file", upload_file)
+    monkeypatch.setattr(gemini.genai, "delete_file", deletes.append)
+    return SimpleNamespace(uploads=uploads, deletes=deletes)
+
+
+def test_same_content_is_uploaded_once(genai):
+    files = GeminiFileManager()
+    first = files.upload_bytes(b"photo", ".jpg")
+    assert files.upload_bytes(b"photo", ".jpg") is first
+    assert len(genai.uploads) == 1
+
+
+def test_least_recently_used_is_forgotten_but_kept_on_gemini(genai):
+    files = GeminiFileManager(max_files=2)
+    a = files.upload_bytes(b"a", ".jpg")
+    files.upload_bytes(b"b", ".jpg")
+    # a was used last, so b goes
+    assert files.upload_bytes(b"a", ".jpg") is a
+    files.upload_bytes(b"c", ".jpg")
+    assert len(files) == 2
+    assert files.upload_bytes(b"a", ".jpg") is a
+    assert len(genai.uploads) == 3
+
+    # sessions may still refer to b, only gemini's expiry removes it
+    assert genai.deletes == []
+    files.upload_bytes(b"b", ".jpg")
+    assert len(genai.uploads) == 4
+
+
+def test_expired_files_are_uploaded_again(genai):
+    files = GeminiFileManager()
+    old = files.upload_bytes(b"photo", ".jpg")
+    old.expiration_time = datetime.now(timezone.utc) + timedelta(minutes=5)
+    assert files.upload_bytes(b"photo", ".jpg") is not old
+    assert len(genai.uploads) == 2
@@ -0,0 +1,72 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from handlers._utils import (
+    Deadline,
+    _current_deadline,
+    cancel_generations,
+    cancellable_generation,
+)
+
+
+class HangingStream:
+    """An sdk stream that sends nothing until it is closed."""
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+    def __iter__(self):
+        self.closed.wait(5)
+        raise ConnectionError("stream closed")
+        yield
+
+
+class FakeBot:
+    def __init__(self):
+        self.markups = []
+
+    def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None):
+        self.markups.append((chat_id, message_id, reply_markup))
+
+
+def placeholder(message_id=1):
+    return SimpleNamespace(chat=SimpleNamespace(id=10), message_id=message_id)
+
+
+def test_stop_closes_a_silent_stream_at_once():
+    stream = HangingStream()
+    with cancellable_generation(placeholder(), 7, FakeBot()) as cancel:
+        cancel.close_on_stop(stream)
+        threading.Timer(0.05, cancel_generations, args=(10, 7)).start()
+        with pytest.raises(ConnectionError):
+            list(stream)
+        assert cancel.is_set()
+
+
+def test_deadline_closes_a_silent_stream():
+    stream = HangingStream()
+    token = _current_deadline.set(Deadline(0.1))
+    try:
+        with cancellable_generation(placeholder(), 7, FakeBot()) as cancel:
+            cancel.close_on_stop(stream)
+            with pytest.raises(ConnectionError):
+                list(stream)
+            # running out of time is not a stop
+            assert not cancel.is_set()
+    finally:
+        _current_deadline.reset(token)
+
+
+def test_failed_answer_loses_its_stop_button():
+    bot = FakeBot()
+    with pytest.raises(RuntimeError):
+        with cancellable_generation(placeholder(3), 7, bot):
+            raise RuntimeError("upstream failed")
+    assert bot.markups == [(10, 3, None)]
+    # and nothing is left to stop
+    assert cancel_generations(10, 7) == 0
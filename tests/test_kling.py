@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+from kling import BaseGen
+
+from handlers._jobs import DONE, FAILED, store
+from handlers import kling as kling_module
+from handlers.kling import KlingTracker, submit_kling_task
+
+RESULT = "https://example.com/kling/0.png"
+
+
+class FakeKling(ThreadingHTTPServer):
+    """Kling's submit and status apis, every task is pending `polls` times."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), FakeKlingHandler)
+        self.submitted: list[dict] = []
+        # task id -> [status checks left while pending, final status]
+        self.tasks: dict[int, list[int]] = {}
+        # seconds the next status check hangs before it answers
+        self.stall = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def handle_error(self, request, client_address) -> None:
+        # the client gave up on a stalled check before its answer
+        pass
+
+
+class FakeKlingHandler(BaseHTTPRequestHandler):
+    server: FakeKling
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _json(self, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        assert self.path == "/api/task/submit"
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = payload["arguments"][0]["value"]
+        with self.server.lock:
+            self.server.submitted.append(payload)
+            if prompt == "refused":
+                self._json({"data": {"status": 7, "message": "blocked"}})
+                return
+            task_id = len(self.server.submitted)
+            # e.g. "pending 2 done" or "failed"
+            words = prompt.split()
+            polls = int(words[1]) if words[0] == "pending" else 0
+            self.server.tasks[task_id] = [polls, 50 if words[-1] == "failed" else 99]
+        self._json({"data": {"status": 5, "task": {"id": task_id}}})
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        assert url.path == "/api/task/status"
+        task_id = int(parse_qs(url.query)["taskId"][0])
+        with self.server.lock:
+            stall, self.server.stall = self.server.stall, 0.0
+        time.sleep(stall)
+        with self.server.lock:
+            task = self.server.tasks[task_id]
+            if task[0] > 0:
+                task[0] -= 1
+                self._json({"data": {"status": 5, "works": []}})
+                return
+        works = [{"resource": {"resource": RESULT}}] if task[1] == 99 else []
+        self._json({"data": {"status": task[1], "works": works}})
+
+
+class LocalGen(BaseGen):
+    """A kling client of the fake server, without the daily login check."""
+
+    def __init__(self, base_url: str) -> None:
+        self.session = requests.Session()
+        self.base_url = base_url
+        self.submit_url = f"{base_url}api/task/submit"
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.progress: list[str] = []
+
+    def edit_message_text(self, text: str, **kwargs) -> None:
+        self.progress.append(text)
+
+
+@pytest.fixture
+def kling():
+    server = FakeKling()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def job_state(job_id: int) -> str:
+    with store.connect() as conn:
+        return conn.execute(
+            "SELECT state FROM jobs WHERE id = ?;", (job_id,)
+        ).fetchone()[0]
+
+
+def wait_for_state(job_id: int, timeout: float = 5.0) -> str:
+    deadline = time.monotonic() + timeout
+    while (state := job_state(job_id)) not in (DONE, FAILED):
+        assert time.monotonic() < deadline, f"job {job_id} is still {state}"
+        time.sleep(0.01)
+    return state
+
+
+def track(kling: FakeKling, prompt: str, tracker: KlingTracker | None = None):
+    tracker = tracker or KlingTracker(lambda: LocalGen(kling.base_url))
+    task_id = submit_kling_task(tracker.client(), False, prompt)
+    job = store.add("kling", 1, 2, 3, {"prompt": prompt, "task_id": task_id})
+    bot, delivered = FakeBot(), []
+    tracker.track(job, bot, lambda job, bot, links: delivered.append(links), 0.01, 5.0)
+    return job, bot, delivered
+
+
+def test_submit_sends_the_kling_creator_request(kling):
+    client = LocalGen(kling.base_url)
+    assert submit_kling_task(client, False, "a cat") == 1
+    assert submit_kling_task(client, True, "a cat", image_url=RESULT) == 2
+
+    images, video = kling.submitted
+    assert images["type"] == "mmu_txt2img_aiweb"
+    assert images["inputs"] == []
+    assert {"name": "imageCount", "value": "4"} in images["arguments"]
+    assert video["type"] == "m2v_img2video"
+    assert video["inputs"] == [{"inputType": "URL", "url": RESULT, "name": "input"}]
+
+
+def test_submit_refused(kling):
+    with pytest.raises(Exception, match="blocked"):
+        submit_kling_task(LocalGen(kling.base_url), False, "refused")
+
+
+def test_pending_then_done(kling):
+    job, _, delivered = track(kling, "pending 3 done")
+    assert wait_for_state(job.id) == DONE
+    assert delivered == [[RESULT]]
+    # every pending check was answered before the result
+    assert kling.tasks[job.payload["task_id"]][0] == 0
+
+
+def test_failed(kling):
+    job, bot, delivered = track(kling, "failed")
+    assert wait_for_state(job.id) == FAILED
+    assert delivered == []
+    assert bot.progress == ["kling error maybe block the prompt"]
+
+
+def test_hung_status_check_times_out(kling, monkeypatch):
+    monkeypatch.setattr(kling_module, "KLING_REQUEST_TIMEOUT", 0.1)
+    kling.stall = 1.0
+    tracker = KlingTracker(lambda: LocalGen(kling.base_url))
+    start = time.monotonic()
+    job, _, delivered = track(kling, "pending 1 done", tracker)
+    assert wait_for_state(job.id) == DONE
+    # the next checks did not wait for the hung one
+    assert time.monotonic() - start < 1.0
+    assert delivered == [[RESULT]]
+    # the polling does not share the connections of the submits
+    assert tracker.session() is not tracker.client().session
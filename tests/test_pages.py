@@ -0,0 +1,31 @@
+import os
+
+from handlers._pages import PageCache
+
+
+def test_nothing_is_created_before_first_use(tmp_path):
+    cache_dir = tmp_path / "url_cache"
+    PageCache(str(cache_dir), ttl=60, max_bytes=1024)
+    assert not os.path.exists(cache_dir)
+
+
+def test_pages_outlive_a_new_cache(tmp_path):
+    cache_dir = str(tmp_path / "url_cache")
+    cache = PageCache(cache_dir, ttl=60, max_bytes=1024)
+    assert cache.get("https://example.com") is None
+    cache.put("https://example.com", "example")
+    assert cache.get("https://example.com") == "example"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    reopened = PageCache(cache_dir, ttl=60, max_bytes=1024)
+    assert reopened.get("https://example.com") == "example"
+    assert len(reopened) == 1
+
+
+def test_oldest_pages_are_removed_past_max_bytes(tmp_path):
+    cache = PageCache(str(tmp_path / "url_cache"), ttl=60, max_bytes=10)
+    cache.put("https://a.example", "aaaaaa")
+    cache.put("https://b.example", "bbbbbb")
+    assert cache.get("https://a.example") is None
+    assert cache.get("https://b.example") == "bbbbbb"
+    assert cache.size == 6
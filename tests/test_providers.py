@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+from handlers._providers import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Provider,
+    close_on_cancel,
+    hedged_stream,
+)
+
+
+class HangingStream:
+    """An sdk stream that sends nothing until it is closed."""
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+    def __iter__(self):
+        self.closed.wait(5)
+        raise ConnectionError("stream closed")
+        yield
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_cancelled_primary_keeps_its_slow_sample():
+    stream = HangingStream()
+
+    def hanging(messages):
+        yield from close_on_cancel(stream)
+
+    def answering(messages):
+        yield "hi"
+
+    # one failure would open it
+    primary = Provider(
+        "primary", hanging, breaker=CircuitBreaker("primary", min_calls=1)
+    )
+    fallback = Provider("fallback", answering)
+
+    answer = list(hedged_stream(primary, fallback, [], budget=0.1))
+
+    assert answer == [("fallback", "hi")]
+    assert stream.closed.is_set()
+    wait_until(lambda: len(primary.latency) == 1)
+    assert primary.latency.percentile(100) >= 0.1
+    # closing the loser is not a failure of its backend
+    assert primary.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_call_records_and_gives_back_the_probe():
+    breaker = CircuitBreaker("test", min_calls=2, reset_timeout=0.05)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            with breaker.call():
+                raise ValueError
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        with breaker.call():
+            pass
+
+    time.sleep(0.1)
+    with breaker.call() as first_token:
+        first_token()
+    assert breaker.state == CircuitBreaker.CLOSED
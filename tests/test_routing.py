@@ -0,0 +1,69 @@
+import time
+
+from config import ModelRoute
+from handlers import _routing
+from handlers._providers import MIN_LATENCY_SAMPLES
+from handlers._routing import ModelRouter, estimate_prompt
+
+ROUTES = [
+    ModelRoute(model="test-mini", max_tokens=100, target_ttft=1.0),
+    ModelRoute(model="test-large"),
+]
+
+
+def ask(text, image=False):
+    content = [{"type": "text", "text": text}]
+    if image:
+        content.append({"type": "image_url", "image_url": {"url": "data:"}})
+    return [{"role": "user", "content": content}]
+
+
+def test_estimate_prompt_counts_pictures():
+    tokens, attachments = estimate_prompt(ask("hello", image=True))
+    assert attachments == 1
+    assert tokens > estimate_prompt(ask("hello"))[0]
+
+
+def test_long_prompts_go_to_the_long_context_route():
+    router = ModelRouter("test", "default", ROUTES)
+    assert router.choose(ask("hi")) == "test-mini"
+    assert router.choose(ask("word " * 1000)) == "test-large"
+
+
+def test_no_routes_keeps_the_default():
+    assert ModelRouter("test", "default", []).choose(ask("hi")) == "default"
+
+
+def test_routers_share_the_latency_of_a_model():
+    # models of their own, the histograms are global
+    routes = [
+        ModelRoute(model="shared-mini", target_ttft=1.0),
+        ModelRoute(model="shared-large"),
+    ]
+    chat = ModelRouter("test-chat", "default", routes)
+    pro = ModelRouter("test-chat-pro", "default", routes)
+    for _ in range(MIN_LATENCY_SAMPLES):
+        chat.record("shared-mini", 5.0)
+    # the slow first tokens seen by one router steer the other one as well
+    assert pro.ttft("shared-mini") == 5.0
+    assert pro.choose(ask("hi")) == "shared-large"
+
+
+def test_a_slow_route_gets_requests_again_once_it_recovered(monkeypatch):
+    monkeypatch.setattr(_routing, "ROUTE_LATENCY_WINDOW", 0.1)
+    routes = [
+        ModelRoute(model="recovering-mini", target_ttft=1.0),
+        ModelRoute(model="recovering-large"),
+    ]
+    router = ModelRouter("test", "default", routes)
+    for _ in range(MIN_LATENCY_SAMPLES):
+        router.record("recovering-mini", 5.0)
+    assert router.choose(ask("hi")) == "recovering-large"
+
+    # its slow samples age out, so the route is tried again
+    time.sleep(0.15)
+    assert router.choose(ask("hi")) == "recovering-mini"
+    for _ in range(MIN_LATENCY_SAMPLES):
+        router.record("recovering-mini", 0.2)
+    assert router.ttft("recovering-mini") == 0.2
+    assert router.choose(ask("hi")) == "recovering-mini"
@@ -0,0 +1,56 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from handlers._sessions import SessionStore
+
+
+def test_nothing_is_created_before_first_use(tmp_path):
+    db_file = tmp_path / "sessions" / "gemini.db"
+    SessionStore(str(db_file))
+    assert not os.path.exists(db_file.parent)
+
+
+def test_round_trip(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.db"))
+    turns = [
+        {"role": "user", "parts": [{"text": "你好"}]},
+        {"role": "model", "parts": [{"text": "hi"}]},
+    ]
+    store.save("gemini", "1", turns)
+    assert store.load("gemini", "1") == turns
+    # kinds and players are separate
+    assert store.load("gemini_pro", "1") == []
+    assert store.load("gemini", "2") == []
+
+    store.save("gemini", "1", turns[:1])
+    assert store.load("gemini", "1") == turns[:1]
+
+    store.clear("gemini", "1")
+    assert store.load("gemini", "1") == []
+
+
+def test_survives_a_new_store(tmp_path):
+    db_file = str(tmp_path / "sessions.db")
+    turns = [{"role": "user", "parts": [{"text": "hello"}]}]
+    SessionStore(db_file).save("gemini", "1", turns)
+    assert SessionStore(db_file).load("gemini", "1") == turns
+
+
+def test_idle_sessions_are_forgotten(tmp_path):
+    db_file = str(tmp_path / "sessions.db")
+    store = SessionStore(db_file, max_age=60)
+    store.save("gemini", "old", [{"role": "user", "parts": []}])
+    idle_since = datetime.now(timezone.utc) - timedelta(seconds=120)
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(
+            "UPDATE sessions SET updated_at = ? WHERE player_id = 'old';",
+            (idle_since.isoformat(),),
+        )
+    assert store.load("gemini", "old") == []
+
+    # saving another one deletes it for good
+    store.save("gemini", "new", [])
+    with sqlite3.connect(db_file) as conn:
+        players = [row[0] for row in conn.execute("SELECT player_id FROM sessions;")]
+    assert players == ["new"]
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from handlers._vision import (
+    known_description,
+    photo_descriptions,
+    remember_description,
+)
+
+
+def photo(unique_id, message_id=1):
+    size = SimpleNamespace(width=10, height=10, file_unique_id=unique_id)
+    return SimpleNamespace(
+        photo=[size], chat=SimpleNamespace(id=10), message_id=message_id
+    )
+
+
+def answer(message_id):
+    return SimpleNamespace(
+        photo=None, chat=SimpleNamespace(id=10), message_id=message_id
+    )
+
+
+def reply_to(message):
+    return SimpleNamespace(reply_to_message=message)
+
+
+def test_unknown_photos_are_not_described():
+    assert known_description(reply_to(photo("never-seen")), "openai") is None
+    assert known_description(SimpleNamespace(reply_to_message=None), "openai") is None
+
+
+def test_the_answer_is_reused_for_every_photo_of_the_album():
+    album = [photo("first", 1), photo("second", 2)]
+    remember_description(album, answer(3), "openai", "two cats")
+
+    # the same photo forwarded again is the same photo
+    assert known_description(reply_to(photo("second", 9)), "openai") == "two cats"
+    assert known_description(reply_to(album[0]), "openai") == "two cats"
+    assert known_description(reply_to(album[0]), "claude") is None
+    photo_descriptions.clear()
+
+
+def test_replies_to_the_answer_find_it():
+    remember_description([photo("cat")], answer(5), "openai", "a cat")
+
+    assert known_description(reply_to(answer(5)), "openai") == "a cat"
+    assert known_description(reply_to(answer(6)), "openai") is None
+    photo_descriptions.clear()
@@ -5,6 +5,7 @@ from telebot import TeleBot
 
 from config import settings
 from handlers import list_available_commands, load_handlers
+from handlers._providers import start_keepalive
 
 logger = logging.getLogger("bot")
 
@@ -29,6 +30,13 @@ def main():
     parser.add_argument(
         "--debug", "--verbose", "-v", action="store_true", help="Enable debug mode"
     )
+    # every running answer holds a worker, keep some free for /stop and new messages
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=8,
+        help="Number of worker threads handling updates",
+    )
 
     # 'disable-command' option
     # The action 'append' will allow multiple entries to be saved into a list
@@ -46,8 +54,10 @@ def main():
     setup_logging(options.debug)
 
     # Init bot
-    bot = TeleBot(options.tg_token)
+    bot = TeleBot(options.tg_token, num_threads=options.num_threads)
     load_handlers(bot, options.disable_commands)
+    if settings.provider_warmup:
+        start_keepalive(settings.provider_keepalive_interval)
     logger.info("Bot init done.")
 
     # Start bot